@@ -0,0 +1,194 @@
+import bisect
+import heapq
+from indexes import DerivedIndex, parse_timestamp
+
+# --- Dashboard Aggregates ---
+# Totals and histograms behind the admin dashboard and its chart APIs,
+# maintained from store change events so admin pages don't rescan every
+# collection on each load.
+
+EPOCH = '1970-01-01T00:00:00'
+
+
+class DashboardAggregates(DerivedIndex):
+    def __init__(self, store, users_file, videos_file, enrollments_file, likes_file):
+        self.users_file = users_file
+        self.videos_file = videos_file
+        self.enrollments_file = enrollments_file
+        self.likes_file = likes_file
+        super().__init__(store, users_file, videos_file, enrollments_file, likes_file)
+
+    def rebuild(self, collections):
+        for filepath in self.sources:
+            self.refresh(filepath, collections[filepath])
+
+    def refresh(self, filepath, rows):
+        if filepath == self.users_file:
+            self._user_count = 0
+            self._users_created = []  # sorted creation datetimes
+            self._users_per_month = {}
+            for user in rows:
+                self._add_user(user, bulk=True)
+            self._users_created.sort()
+        elif filepath == self.videos_file:
+            self._videos = {}  # id -> (title, category, views), in catalog order
+            self._videos_uploaded = []  # sorted upload datetimes
+            self._category_views = {}
+            for video in rows:
+                self._add_video(video, bulk=True)
+            self._videos_uploaded.sort()
+        elif filepath == self.enrollments_file:
+            self._enrollment_count = 0
+            self._enrollments_per_user = {}
+            self._enrollments_per_day = {}
+            for enrollment in rows:
+                self._add_enrollment(enrollment)
+        else:
+            self._like_count = 0
+            self._likes_per_video = {}
+            for like in rows:
+                self._add_like(like['user_id'], like['video_id'])
+        self._top_liked = None
+        return True
+
+    def apply(self, filepath, event):
+        op = event['op']
+        if filepath == self.users_file:
+            if op == 'insert':
+                self._add_user(event['row'])
+                return True
+            # Profile edits don't move any of the user aggregates
+            return op == 'update' and 'created_at' not in event['fields']
+        if filepath == self.videos_file:
+            if op == 'insert':
+                self._add_video(event['row'])
+                self._top_liked = None
+                return True
+            if op == 'update' and set(event['match']) == {'id'} and 'uploaded_at' not in event['fields']:
+                return self._update_video(event['match']['id'], event['fields'])
+            return False
+        if filepath == self.enrollments_file:
+            if op == 'insert':
+                self._add_enrollment(event['row'])
+                return True
+            return False
+        if filepath == self.likes_file:
+            if op == 'insert':
+                self._add_like(event['row']['user_id'], event['row']['video_id'])
+                return True
+            match = event['match']
+            if op == 'delete' and set(match) == {'user_id', 'video_id'}:
+                self._remove_like(match['user_id'], match['video_id'])
+                return True
+        return False
+
+    def totals(self):
+        self._ensure()
+        with self._lock:
+            return {
+                'total_users': self._user_count,
+                'total_videos': len(self._videos),
+                'total_enrollments': self._enrollment_count,
+                'unique_enrollments_users': len(self._enrollments_per_user),
+                'total_likes': self._like_count,
+            }
+
+    def new_users_since(self, since):
+        self._ensure()
+        with self._lock:
+            return len(self._users_created) - bisect.bisect_left(self._users_created, since)
+
+    def new_videos_since(self, since):
+        self._ensure()
+        with self._lock:
+            return len(self._videos_uploaded) - bisect.bisect_left(self._videos_uploaded, since)
+
+    def views_per_category(self, pending=None):
+        """Returns {category: views}, adding pending {video_id: views} not yet in the video records."""
+        self._ensure()
+        with self._lock:
+            views = dict(self._category_views)
+            for video_id, count in (pending or {}).items():
+                if video_id in self._videos:
+                    category = self._videos[video_id][1]
+                    views[category] = views.get(category, 0) + count
+            return views
+
+    def enrollments_per_day(self):
+        """Returns [(YYYY-MM-DD, enrollments)] sorted by day."""
+        self._ensure()
+        with self._lock:
+            return sorted(self._enrollments_per_day.items())
+
+    def users_per_month(self):
+        """Returns [(YYYY-MM, registrations)] sorted by month."""
+        self._ensure()
+        with self._lock:
+            return sorted(self._users_per_month.items())
+
+    def top_liked(self, n=5):
+        """Returns [(title, likes)] for the n most liked videos, ties in catalog order."""
+        self._ensure()
+        with self._lock:
+            if self._top_liked is None or len(self._top_liked) != min(n, len(self._videos)):
+                top = heapq.nlargest(n, self._videos, key=lambda video_id: self._likes_per_video.get(video_id, 0))
+                self._top_liked = [(self._videos[video_id][0], self._likes_per_video.get(video_id, 0))
+                                   for video_id in top]
+            return self._top_liked
+
+    def _add_user(self, user, bulk=False):
+        self._user_count += 1
+        created_at = parse_timestamp(user.get('created_at', EPOCH))
+        # rebuild() sorts once at the end instead of inserting in order
+        if bulk:
+            self._users_created.append(created_at)
+        else:
+            bisect.insort(self._users_created, created_at)
+        if 'created_at' in user:
+            month = created_at.strftime('%Y-%m')
+            self._users_per_month[month] = self._users_per_month.get(month, 0) + 1
+
+    def _add_video(self, video, bulk=False):
+        category = video.get('category', 'Uncategorized')
+        views = video.get('views', 0)
+        self._videos[video['id']] = (video['title'], category, views)
+        uploaded_at = parse_timestamp(video.get('uploaded_at', EPOCH))
+        if bulk:
+            self._videos_uploaded.append(uploaded_at)
+        else:
+            bisect.insort(self._videos_uploaded, uploaded_at)
+        self._category_views[category] = self._category_views.get(category, 0) + views
+
+    def _update_video(self, video_id, fields):
+        if video_id not in self._videos:
+            return True  # the update matched no video
+        title, category, views = self._videos[video_id]
+        if fields.get('category', category) != category:
+            return False
+        # A views flush sets the new total, so the category moves by the difference
+        new_views = fields.get('views', views)
+        self._category_views[category] = self._category_views.get(category, 0) + new_views - views
+        if fields.get('title', title) != title:
+            self._top_liked = None
+        self._videos[video_id] = (fields.get('title', title), category, new_views)
+        return True
+
+    def _add_enrollment(self, enrollment):
+        self._enrollment_count += 1
+        user_id = enrollment['user_id']
+        self._enrollments_per_user[user_id] = self._enrollments_per_user.get(user_id, 0) + 1
+        day = parse_timestamp(enrollment['timestamp']).strftime('%Y-%m-%d')
+        self._enrollments_per_day[day] = self._enrollments_per_day.get(day, 0) + 1
+
+    # like_video only inserts a like the user doesn't have and deletes one they do, so the
+    # events can be counted without keeping the (user, video) pairs a second time
+
+    def _add_like(self, user_id, video_id):
+        self._like_count += 1
+        self._likes_per_video[video_id] = self._likes_per_video.get(video_id, 0) + 1
+        self._top_liked = None
+
+    def _remove_like(self, user_id, video_id):
+        self._like_count -= 1
+        self._likes_per_video[video_id] = self._likes_per_video.get(video_id, 0) - 1
+        self._top_liked = None
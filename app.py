@@ -1,17 +1,79 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
-from flask_bcrypt import Bcrypt
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, abort, Response, stream_with_context
+from flask import before_render_template, g, send_file, send_from_directory, template_rendered
+from flask.cli import AppGroup
 from flask_moment import Moment
+import click
+import csv
+import io
 import json
+import logging
+import math
+import mimetypes
 import os
 import re
+import signal
+import time
 from datetime import datetime, timedelta # Import datetime directly, and timedelta
 from functools import wraps
 import uuid # ADDED: Import uuid for unique IDs
 
+from aggregates import DashboardAggregates
+import assets
+import dataio
+from datastore import JsonStore, expand_event
+from indexes import AdIndex, CatalogIndex, EngagementIndex, TrendingIndex, UserDirectory
+from jobs import JobQueue
+import metrics
+from pagecache import ResponseCache
+from related import RelatedVideos, build_related
+from search import SearchIndex
+from passwords import HasherBusy, PasswordHasher
+from sqlitestore import SqliteStore
+import thumbs
+from viewcounts import ViewCounter
+
 app = Flask(__name__)
 moment = Moment(app)
 app.config['SECRET_KEY'] = 'cf8b472947bbaba36d954f2e989a654bc6050dc87bac3d80'
-bcrypt = Bcrypt(app)
+
+# --- Password Hashing ---
+# bcrypt runs on a process pool of BCRYPT_WORKERS per web worker; once BCRYPT_MAX_QUEUE more jobs are
+# waiting, login/signup answer 429. Hashes made with another cost are upgraded on the next login.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 2))
+app.config['BCRYPT_MAX_QUEUE'] = int(os.environ.get('BCRYPT_MAX_QUEUE', 16))
+bcrypt = PasswordHasher(rounds=app.config['BCRYPT_LOG_ROUNDS'], workers=app.config['BCRYPT_WORKERS'],
+                        max_queue=app.config['BCRYPT_MAX_QUEUE'])
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    return 'Too many sign-in requests right now. Please try again in a moment.', 429, {'Retry-After': '1'}
+
+# --- Static Assets ---
+# `flask assets build` writes minified, content-hashed copies of static/css and static/js to static/dist,
+# with gzip (and brotli) variants. url_for('static', ...) then links the hashed copies, which are served
+# precompressed per Accept-Encoding and cached by browsers for good. Unbuilt files are served as they are.
+static_assets = assets.StaticAssets(app.static_folder)
+static_assets.load()
+
+@app.url_defaults
+def link_static_bundles(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_for_bundle(values['filename'])
+
+def serve_static(filename):
+    if not static_assets.is_bundle(filename):
+        return app.send_static_file(filename)
+    path, encoding = static_assets.variant(filename, lambda name: request.accept_encodings.quality(name) > 0)
+    response = send_from_directory(app.static_folder, path, mimetype=mimetypes.guess_type(filename)[0],
+                                   max_age=assets.IMMUTABLE_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = serve_static
 
 # --- JSON Database Paths ---
 DATA_DIR = 'data'
@@ -21,30 +83,270 @@ LIKES_FILE = os.path.join(DATA_DIR, 'likes.json')
 ENROLLMENTS_FILE = os.path.join(DATA_DIR, 'enrollments.json')
 SUGGESTIONS_FILE = os.path.join(DATA_DIR, 'suggestions.json')
 ADS_FILE = os.path.join(DATA_DIR, 'ads.json')
+AD_DISMISSALS_FILE = os.path.join(DATA_DIR, 'ad_dismissals.json')
 DONATION_COMMENTS_FILE = os.path.join(DATA_DIR, 'donation_comments.json')
+# Append-only buffer of page views, folded into videos.json in batches
+VIEWS_LOG_FILE = os.path.join(DATA_DIR, 'views.log')
+
+ALL_DATA_FILES = [USERS_FILE, VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE, ADS_FILE, AD_DISMISSALS_FILE,
+                  DONATION_COMMENTS_FILE]
 
 # Create data directory if it doesn't exist
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# --- Storage Backend ---
+# 'json' keeps each collection in its file above; 'sqlite' keeps them as tables in SQLITE_DATABASE
+# (import existing files with `flask migrate-sqlite`). Routes use the same helpers with either one.
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'json')
+app.config['SQLITE_DATABASE'] = os.environ.get('SQLITE_DATABASE', os.path.join(DATA_DIR, 'gis.sqlite3'))
+
+# Collections rewritten on hot paths are stored without indentation to keep writes small
+COMPACT_JSON_FILES = [VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE]
+# Engagement collections append their changes to '<name>.jsonl' instead of rewriting the whole file;
+# a log larger than EVENT_LOG_COMPACT_BYTES is folded back into the file (or run `flask compact-logs`).
+# Videos are logged too: likes_count recounts and view flushes then reach the indexes of other workers
+# as events, instead of a rewritten videos.json that each of them has to re-read.
+EVENT_LOG_FILES = [VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE, AD_DISMISSALS_FILE,
+                   DONATION_COMMENTS_FILE]
+EVENT_LOG_COMPACT_BYTES = 4 * 1024 * 1024
+
+# --- Background Jobs ---
+# Follow-up work (likes_count recounts, view flushes, log compaction) is queued in JOBS_DATABASE and run
+# by `flask jobs work` (the Procfile's worker process). JOBS_INLINE=1 runs jobs as they are queued
+# instead, for development without a worker.
+app.config['JOBS_DATABASE'] = os.environ.get('JOBS_DATABASE', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE', '0') == '1'
+jobs = JobQueue(app.config['JOBS_DATABASE'], inline=app.config['JOBS_INLINE'])
+
+# Seconds between compactions of every event log, on top of those queued when a log grows too big
+LOG_COMPACT_INTERVAL = 3600
+
+# Seconds a likes_count recount waits, so all the likes a video gets meanwhile share one write
+LIKE_RECOUNT_DELAY = 10
+
+if app.config['STORAGE_BACKEND'] == 'sqlite':
+    store = SqliteStore(app.config['SQLITE_DATABASE'])
+elif app.config['STORAGE_BACKEND'] == 'json':
+    store = JsonStore(compact_files=COMPACT_JSON_FILES, log_files=EVENT_LOG_FILES,
+                      compact_threshold=EVENT_LOG_COMPACT_BYTES,
+                      on_log_full=lambda filepath: jobs.enqueue('compact_log', key='compact_log:' + filepath,
+                                                                filepath=filepath))
+else:
+    raise ValueError('Unknown STORAGE_BACKEND: %r' % app.config['STORAGE_BACKEND'])
+
 # --- Helper Functions for JSON DB ---
 
 def load_json(filepath):
     """Loads data from a JSON file. Initializes with empty list if file is empty or non-existent."""
-    if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
-        # Ensure file exists and contains an empty JSON array if it was empty/missing
-        with open(filepath, 'w') as f:
-            json.dump([], f)
-        return [] # Return empty list immediately
-    with open(filepath, 'r') as f:
-        return json.load(f)
+    return store.load(filepath)
+
+def read_json(filepath):
+    """Returns cached data from a JSON file for read-only use; the result must not be mutated."""
+    return store.read(filepath)
 
 def save_json(filepath, data):
-    """Saves data to a JSON file."""
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=4)
+    """Saves data to a JSON file atomically."""
+    store.save(filepath, data)
+
+def json_transaction(*filepaths):
+    """Locks the given JSON files for a read-modify-write and saves them atomically when the block exits."""
+    return store.transaction(*filepaths)
+
+# Views are flushed into videos.json after this many buffered views or seconds, whichever comes first
+VIEW_FLUSH_THRESHOLD = 1000
+VIEW_FLUSH_INTERVAL = 60
+
+view_counter = ViewCounter(store, VIEWS_LOG_FILE, VIDEOS_FILE,
+                           flush_threshold=VIEW_FLUSH_THRESHOLD, flush_interval=VIEW_FLUSH_INTERVAL,
+                           on_flush_due=lambda: jobs.enqueue('flush_views', key='flush_views'))
+
+# (user, video) lookups for likes, enrollments and suggestions, kept up to date as they are written
+engagement = EngagementIndex(store, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE)
+
+# Users by id and email; admin flags are cached for ADMIN_FLAG_TTL seconds
+ADMIN_FLAG_TTL = 5
+user_directory = UserDirectory(store, USERS_FILE, admin_ttl=ADMIN_FLAG_TTL)
+
+# Active ads per user, with dismissals kept as interned user numbers
+ads_index = AdIndex(store, ADS_FILE, AD_DISMISSALS_FILE)
+
+# The catalog pre-sorted for each library sort order, overall and per category
+catalog = CatalogIndex(store, VIDEOS_FILE)
+
+# Videos by recent likes, enrollments and views for sort_by=trending; each counts half as much after
+# TRENDING_HALF_LIFE_HOURS. Views are added as this worker reads them from the view log.
+app.config['TRENDING_HALF_LIFE_HOURS'] = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 24))
+trending = TrendingIndex(store, VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE,
+                         half_life=app.config['TRENDING_HALF_LIFE_HOURS'] * 3600)
+view_counter.subscribe(trending.record_view)
+
+# BM25 full-text index over video text, and suggestion text for admins
+search_index = SearchIndex(store, VIDEOS_FILE, SUGGESTIONS_FILE)
+
+# Totals and histograms for the admin dashboard and chart APIs
+dashboard_stats = DashboardAggregates(store, USERS_FILE, VIDEOS_FILE, ENROLLMENTS_FILE, LIKES_FILE)
+
+# --- Job Tasks ---
+
+@jobs.task('recount_likes')
+def recount_likes(video_ids):
+    """Sets likes_count on each of video_ids from the likes collection."""
+    with json_transaction(VIDEOS_FILE) as tx:
+        counts = {video_id: {'likes_count': engagement.like_count(video_id)}
+                  for video_id in video_ids if catalog.get(video_id)}
+        if counts:
+            tx.update_many(VIDEOS_FILE, 'id', counts)
+
+@jobs.task('flush_views')
+def flush_views():
+    view_counter.flush()
+
+@jobs.task('compact_log')
+def compact_log(filepath):
+    if isinstance(store, JsonStore) and filepath in EVENT_LOG_FILES:
+        store.compact(filepath)
+
+@jobs.task('compact_logs')
+def compact_all_logs():
+    """Folds every non-empty event log into its JSON file."""
+    for filepath in EVENT_LOG_FILES:
+        if isinstance(store, JsonStore) and os.path.exists(store.log_path(filepath)):
+            store.compact(filepath)
+
+jobs.every(VIEW_FLUSH_INTERVAL, 'flush_views')
+jobs.every(LOG_COMPACT_INTERVAL, 'compact_logs')
+
+# --- Related Videos ---
+# Neighbours of each video by co-likes and co-enrollments (see related.py), rebuilt by the refresh_related
+# job every RELATED_REFRESH_INTERVAL seconds or with `flask build-related`, and shown on video pages.
+app.config['RELATED_FILE'] = os.environ.get('RELATED_FILE', os.path.join(DATA_DIR, 'related.json'))
+app.config['RELATED_REFRESH_INTERVAL'] = int(os.environ.get('RELATED_REFRESH_INTERVAL', 3600))
+related_videos = RelatedVideos(app.config['RELATED_FILE'])
+
+# Related videos shown under a video
+RELATED_PANEL_SIZE = 6
+
+@jobs.task('refresh_related', max_attempts=2)
+def refresh_related():
+    related_videos.save(build_related(store, [LIKES_FILE, ENROLLMENTS_FILE]))
+
+jobs.every(app.config['RELATED_REFRESH_INTERVAL'], 'refresh_related')
+
+# --- Thumbnails ---
+# /thumb/<video_id> and /thumb/ad/<ad_id> serve WebP or JPEG renditions of thumbnail_url and image_url at
+# a fixed set of widths, rendered by the render_thumbnail job into THUMB_DIR (see thumbs.py). The cache is
+# kept under THUMB_CACHE_MAX_BYTES. Without Pillow (requirements-thumbs.txt) pages link the sources as before.
+app.config['THUMB_DIR'] = os.environ.get('THUMB_DIR', os.path.join(DATA_DIR, 'thumbs'))
+app.config['THUMB_CACHE_MAX_BYTES'] = int(os.environ.get('THUMB_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['THUMB_MAX_AGE'] = int(os.environ.get('THUMB_MAX_AGE', 7 * 24 * 3600))
+thumbnails = thumbs.ThumbnailCache(app.config['THUMB_DIR'], max_bytes=app.config['THUMB_CACHE_MAX_BYTES'])
+
+# Width library cards ask for
+THUMB_CARD_WIDTH = 480
+
+@jobs.task('render_thumbnail', max_attempts=3)
+def render_thumbnail(url, width, crop):
+    thumbnails.render(url, width, crop)
+
+def queue_thumbnail(url, width, crop):
+    jobs.enqueue('render_thumbnail', key='thumb:%s:%d:%d' % (thumbs.url_key(url), width, crop),
+                 url=url, width=width, crop=crop)
+
+@app.template_global()
+def thumbnail_src(video, width=THUMB_CARD_WIDTH):
+    """The URL to show a video's thumbnail from; ?v= changes along with thumbnail_url."""
+    url = video.get('thumbnail_url')
+    if not url or not thumbs.available():
+        return url
+    return url_for('video_thumbnail', video_id=video['id'], w=width, v=thumbs.url_key(url)[:8])
+
+@app.template_global()
+def ad_image_src(ad, width=THUMB_CARD_WIDTH):
+    url = ad.get('image_url')
+    if not url or not thumbs.available():
+        return url
+    return url_for('ad_image', ad_id=ad['id'], w=width, v=thumbs.url_key(url)[:8])
+
+# --- Library Page Cache ---
+# Anonymous /library pages depend only on (category, sort_by) and the catalog, ads and view counts, so
+# they are cached as rendered HTML. Catalog and ad edits made by this worker clear the cache at once;
+# view and like updates (and edits made by other workers) show up within LIBRARY_CACHE_TOLERANCE seconds.
+app.config['LIBRARY_CACHE_TOLERANCE'] = float(os.environ.get('LIBRARY_CACHE_TOLERANCE', 5))
+app.config['LIBRARY_CACHE_MAX_ENTRIES'] = int(os.environ.get('LIBRARY_CACHE_MAX_ENTRIES', 128))
+app.config['LIBRARY_CACHE_MAX_BYTES'] = int(os.environ.get('LIBRARY_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+# max-age sent to browsers and proxies; with 0 they revalidate every time using the ETag
+app.config['LIBRARY_CACHE_MAX_AGE'] = int(os.environ.get('LIBRARY_CACHE_MAX_AGE', 0))
+
+library_cache = ResponseCache(max_entries=app.config['LIBRARY_CACHE_MAX_ENTRIES'],
+                              max_bytes=app.config['LIBRARY_CACHE_MAX_BYTES'],
+                              tolerance=app.config['LIBRARY_CACHE_TOLERANCE'])
+
+# Video fields that only move counters; updates to them are left to the tolerance window
+COUNTER_FIELDS = {'likes_count', 'views'}
+
+def _invalidate_library_cache(filepath, events, old_version, new_version):
+    if filepath not in (VIDEOS_FILE, ADS_FILE):
+        return
+    if filepath == VIDEOS_FILE and events and all(
+            e['op'] == 'update' and set(e['fields']) <= COUNTER_FIELDS for event in events for e in expand_event(event)):
+        return
+    library_cache.clear()
+
+store.subscribe(_invalidate_library_cache)
+
+def library_version(sort_by=None):
+    """Returns the version of everything an anonymous library page is rendered from."""
+    version = (store.version(VIDEOS_FILE), store.version(ADS_FILE), view_counter.version())
+    if sort_by == 'trending':
+        version += (store.version(LIKES_FILE), store.version(ENROLLMENTS_FILE))
+    return version
+
+# --- Metrics and Profiling ---
+# Every request records its latency and the time spent in storage (load_json/save_json/append_json_log,
+# or load_sqlite/save_sqlite), template rendering and bcrypt, served to admins at /admin/metrics and
+# to browsers as a Server-Timing header. Numbers are kept per worker process.
+# Setting PROFILE_SLOW_REQUESTS_MS samples request stacks every PROFILE_INTERVAL_MS and writes a
+# collapsed-stack flame graph to PROFILE_DIR for each request slower than that.
+app.config['PROFILE_SLOW_REQUESTS_MS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0))
+app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+
+profiler = None
+if app.config['PROFILE_SLOW_REQUESTS_MS'] > 0:
+    profiler = metrics.SamplingProfiler(app.config['PROFILE_DIR'],
+                                        threshold=app.config['PROFILE_SLOW_REQUESTS_MS'] / 1000,
+                                        interval=app.config['PROFILE_INTERVAL_MS'] / 1000)
+
+@app.before_request
+def start_request_metrics():
+    metrics.begin_request()
+    if profiler is not None:
+        profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are timed up to their first byte
+    endpoint = request.endpoint or 'unmatched'
+    elapsed, spans = metrics.end_request(endpoint, request.method, response.status_code,
+                                         response.content_length or 0)
+    if profiler is not None:
+        profiler.end(endpoint, elapsed)
+    if spans:
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.1f' % (name, seconds * 1000)
+                                                      for name, seconds in sorted(spans.items()))
+    return response
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+def _template_finished(sender, template, context, **extra):
+    metrics.record_span('render_template', time.perf_counter() - g.render_started.pop())
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
 
 # Ensure all JSON files exist and are initialized with an empty list if they are new or empty
-for f in [USERS_FILE, VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE, ADS_FILE, DONATION_COMMENTS_FILE]:
+for f in ALL_DATA_FILES:
     load_json(f) # Calling load_json will ensure the file is created with '[]' if not present or empty
 
 # --- User Authentication Decorators ---
@@ -64,10 +366,7 @@ def admin_required(f):
         if 'user_id' not in session:
             flash('Please log in to access this page.', 'danger')
             return redirect(url_for('login'))
-        users = load_json(USERS_FILE)
-        current_user = next(
-            (u for u in users if u['id'] == session['user_id']), None)
-        if not current_user or not current_user.get('is_admin'):
+        if not user_directory.is_admin(session['user_id']):
             flash('You do not have administrative access.', 'danger')
             return redirect(url_for('library'))
         return f(*args, **kwargs)
@@ -78,77 +377,193 @@ def admin_required(f):
 @app.route('/')
 @app.route('/library')
 def library():
-    videos = load_json(VIDEOS_FILE)
-    # Ensure all videos have a 'category' key to prevent errors if some are missing
-    categories = sorted(list(set(v.get('category', 'Uncategorized') for v in videos)))
-
-    # Filtering and Sorting
+    # Anonymous pages without pending flash messages are identical for everyone and are served from cache
+    if 'user_id' in session or '_flashes' in session:
+        return render_library()
+
+    key = tuple(request.args.get(arg) for arg in ('category', 'sort_by', 'after', 'limit'))
+    version = library_version(request.args.get('sort_by'))
+    page = library_cache.get(key, version)
+    if page is None:
+        page = library_cache.put(key, version, render_library().encode('utf-8'))
+
+    response = Response(page.body, mimetype='text/html')
+    response.set_etag(page.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['LIBRARY_CACHE_MAX_AGE']
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+# Videos per library page; ?limit= can ask for up to LIBRARY_MAX_PAGE_SIZE
+LIBRARY_PAGE_SIZE = 24
+LIBRARY_MAX_PAGE_SIZE = 100
+
+def render_library():
+    categories = catalog.categories()
+
+    # Filtering, sorting and keyset pagination (?after=<id of the last video on the previous page>)
     category_filter = request.args.get('category')
     sort_by = request.args.get('sort_by', 'recently_uploaded')
-
-    if category_filter and category_filter != 'all':
-        videos = [v for v in videos if v.get('category') == category_filter]
-
-    if sort_by == 'most_liked':
-        videos.sort(key=lambda x: x.get('likes_count', 0), reverse=True)
+    after = request.args.get('after')
+    limit = min(max(request.args.get('limit', LIBRARY_PAGE_SIZE, type=int), 1), LIBRARY_MAX_PAGE_SIZE)
+
+    scope = category_filter if category_filter and category_filter != 'all' else None
+    if sort_by == 'trending':
+        view_counter.catch_up()
+        video_ids, next_cursor = trending.page(scope, after=after, limit=limit)
+        videos = [video for video in map(catalog.get, video_ids) if video]
+        pending = view_counter.pending_for(video_ids)
     elif sort_by == 'most_viewed':
-        videos.sort(key=lambda x: x.get('views', 0), reverse=True)
-    else:  # recently_uploaded (default)
-        # Ensure 'uploaded_at' exists for sorting, default to a very old date if not
-        videos.sort(key=lambda x: x.get('uploaded_at', '1970-01-01T00:00:00'), reverse=True)
-
-    # Get dismissed ads for the current user
-    active_ads = []
-    if 'user_id' in session:
-        ads = load_json(ADS_FILE)
-        user_id = session['user_id']
-        active_ads = [ad for ad in ads if ad.get(
-            'is_active') and user_id not in ad.get('dismissed_by_users', [])]
+        # Views still buffered in the view log count towards the order, not only the flushed ones
+        pending = view_counter.pending()
+        videos, next_cursor = catalog.page(scope, sort_by, after=after, limit=limit, pending=pending)
     else:
-        # Show all active ads to non-logged-in users (they can't dismiss them)
-        ads = load_json(ADS_FILE)
-        active_ads = [ad for ad in ads if ad.get('is_active')]
+        videos, next_cursor = catalog.page(scope, sort_by, after=after, limit=limit)
+        pending = view_counter.pending_for(v['id'] for v in videos)
+
+    # Shows views still buffered in the view log
+    if pending:
+        videos = [dict(v, views=v.get('views', 0) + pending[v['id']]) if v['id'] in pending else v
+                  for v in videos]
+
+    # Active ads the current user hasn't dismissed; non-logged-in users see them all (they can't dismiss them)
+    active_ads = ads_index.active_ads(session.get('user_id'))
 
     return render_template('library.html', videos=videos, categories=categories,
                            current_category=category_filter, current_sort=sort_by,
-                           ads=active_ads)
+                           ads=active_ads, after=after, next_cursor=next_cursor,
+                           limit=limit if limit != LIBRARY_PAGE_SIZE else None)
+
+def thumbnail_response(url, crop):
+    if not url:
+        abort(404)
+    if not thumbs.available():
+        return redirect(url)
+    width = thumbs.pick_width(request.args.get('w', THUMB_CARD_WIDTH, type=int))
+    # Browsers that take WebP say so explicitly; */* alone gets JPEG
+    fmt = 'webp' if any(value == 'image/webp' and quality > 0 for value, quality in request.accept_mimetypes) else 'jpeg'
+    path = thumbnails.lookup(url, width, fmt, crop)
+    if path is None:
+        queue_thumbnail(url, width, crop)
+        # Rendered already when jobs run inline
+        path = thumbnails.lookup(url, width, fmt, crop)
+    if path is None:
+        response = redirect(url)
+        response.cache_control.no_store = True
+        return response
+    response = send_file(path, mimetype=thumbs.FORMATS[fmt][1], etag=os.path.basename(path),
+                         max_age=app.config['THUMB_MAX_AGE'])
+    response.vary.add('Accept')
+    return response
+
+@app.route('/thumb/<video_id>')
+def video_thumbnail(video_id):
+    video = catalog.get(video_id)
+    return thumbnail_response(video.get('thumbnail_url') if video else None, crop=True)
+
+@app.route('/thumb/ad/<ad_id>')
+def ad_image(ad_id):
+    ad = next((a for a in ads_index.active_ads() if a['id'] == ad_id), None)
+    return thumbnail_response(ad.get('image_url') if ad else None, crop=False)
+
+@app.route('/thumb/uploads/<name>')
+def thumbnail_upload(name):
+    path = thumbnails.upload_path(name)
+    if path is None:
+        abort(404)
+    with open(path, 'rb') as f:
+        mimetype = thumbs.image_mimetype(f.read(16))
+    # Named after its content, so it never changes
+    response = send_file(path, mimetype=mimetype, etag=name, max_age=assets.IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/video/<video_id>')
 @login_required
 def video_detail(video_id):
-    videos = load_json(VIDEOS_FILE)
-    video = next((v for v in videos if v['id'] == video_id), None)
+    video = catalog.get(video_id)
 
     if not video:
         flash('Video not found.', 'danger')
         return redirect(url_for('library'))
 
-    # Increment view count
-    video['views'] = video.get('views', 0) + 1
-    save_json(VIDEOS_FILE, videos)
+    # Increment view count (buffered; folded into videos.json in batches)
+    view_counter.record(video_id)
+    # The catalog row is shared, so the buffered views go on a copy
+    video = dict(video, views=video.get('views', 0) + view_counter.pending_for([video_id]).get(video_id, 0))
 
     # Check if user has liked this video
     user_id = session['user_id']
-    likes = load_json(LIKES_FILE)
-    is_liked = any(l['user_id'] == user_id and l['video_id']
-                   == video_id for l in likes)
+    is_liked = engagement.has_liked(user_id, video_id)
 
     # Check if user is enrolled
-    enrollments = load_json(ENROLLMENTS_FILE)
-    is_enrolled = any(e['user_id'] == user_id and e['video_id']
-                      == video_id for e in enrollments)
+    is_enrolled = engagement.is_enrolled(user_id, video_id)
 
     # Get user's suggestion for this video if they are enrolled and have submitted one
     user_suggestion = None
     if is_enrolled:
-        suggestions = load_json(SUGGESTIONS_FILE)
-        user_suggestion_entry = next(
-            (s for s in suggestions if s['user_id'] == user_id and s['video_id'] == video_id), None)
+        user_suggestion_entry = engagement.suggestion(user_id, video_id)
         if user_suggestion_entry:
             user_suggestion = user_suggestion_entry['suggestion_text']
 
+    related = []
+    for related_id in related_videos.get(video_id):
+        related_video = catalog.get(related_id)
+        if related_video:
+            related.append(related_video)
+            if len(related) == RELATED_PANEL_SIZE:
+                break
+
     return render_template('video_detail.html', video=video, is_liked=is_liked,
-                           is_enrolled=is_enrolled, user_suggestion=user_suggestion)
+                           is_enrolled=is_enrolled, user_suggestion=user_suggestion, related=related)
+
+# --- Search ---
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+def search_results():
+    """Runs the search in the query string. Returns (query, videos, suggestions).
+
+    suggestions is None unless an admin asked for them with ?include=suggestions.
+    """
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_MAX_PAGE_SIZE)
+    videos = search_index.videos(query, limit) if query else []
+
+    suggestions = None
+    if request.args.get('include') == 'suggestions' and 'user_id' in session \
+            and user_directory.is_admin(session['user_id']):
+        suggestions = search_index.suggestions(query, limit) if query else []
+    return query, videos, suggestions
+
+@app.route('/search')
+def search():
+    query, results, suggestions = search_results()
+    # Includes views still buffered in the view log
+    pending = view_counter.pending_for(v['id'] for v, _ in results)
+    videos = [dict(v, views=v.get('views', 0) + pending[v['id']]) if v['id'] in pending else v
+              for v, _ in results]
+    return render_template('search.html', query=query, videos=videos,
+                           suggestions=[s for s, _ in suggestions] if suggestions is not None else None)
+
+@app.route('/api/search')
+def api_search():
+    query, videos, suggestions = search_results()
+    response = {
+        'query': query,
+        'results': [{'id': v['id'], 'title': v['title'], 'category': v.get('category'),
+                     'thumbnail_url': v.get('thumbnail_url'), 'score': round(score, 4)}
+                    for v, score in videos]
+    }
+    if suggestions is not None:
+        response['suggestions'] = [{'id': s['id'], 'video_id': s['video_id'], 'user_id': s['user_id'],
+                                    'suggestion_text': s['suggestion_text'], 'score': round(score, 4)}
+                                   for s, score in suggestions]
+    return jsonify(response)
+
+@app.route('/api/search/complete')
+def api_search_complete():
+    return jsonify({'completions': search_index.complete(request.args.get('q', ''))})
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -163,11 +578,12 @@ def login():
             flash('Please enter both email and password.', 'danger')
             return render_template('login.html')
 
-        users = load_json(USERS_FILE)
-        user = next((u for u in users if u['email'] == email), None)
+        user = user_directory.by_email(email)
 
         if user:
-            if bcrypt.check_password_hash(user['password'], password):
+            if bcrypt.check(user['password'], password):
+                if bcrypt.needs_rehash(user['password']):
+                    rehash_password(user['id'], user['password'], password)
                 session['user_id'] = user['id']
                 session['is_admin'] = user.get('is_admin', False)
                 flash('Login successful!', 'success')
@@ -179,6 +595,18 @@ def login():
             flash('Invalid email or password.', 'danger') # User not found
     return render_template('login.html')
 
+def rehash_password(user_id, old_hash, password):
+    """Re-hashes a user's password at the configured cost; skipped if the hashing pool is busy.
+
+    Only replaces old_hash, the hash password was checked against, so a password changed meanwhile stays.
+    """
+    try:
+        hashed_password = bcrypt.hash(password)
+    except HasherBusy:
+        return
+    with json_transaction(USERS_FILE) as tx:
+        tx.update(USERS_FILE, {'id': user_id, 'password': old_hash}, {'password': hashed_password})
+
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
     if 'user_id' in session: # Check if already logged in using 'user_id'
@@ -190,8 +618,6 @@ def signup():
         password = request.form.get('password') # Use .get()
         confirm_password = request.form.get('confirm_password') # Use .get()
 
-        users = load_json(USERS_FILE)
-
         # Basic validations
         if not username or not email or not password or not confirm_password:
             flash('All fields are required.', 'danger')
@@ -201,7 +627,7 @@ def signup():
             flash('Username must be 3-20 characters long and contain only letters, numbers, or underscores.', 'danger')
             return render_template('signup.html', username=username, email=email)
 
-        if any(u['email'] == email for u in users):
+        if user_directory.by_email(email):
             flash('Account with that email already exists.', 'warning')
             return render_template('signup.html', username=username, email=email)
 
@@ -213,7 +639,7 @@ def signup():
             flash('Password must be at least 6 characters long.', 'danger')
             return render_template('signup.html', username=username, email=email)
 
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed_password = bcrypt.hash(password)
 
         new_user = {
             'id': str(uuid.uuid4()),
@@ -223,8 +649,15 @@ def signup():
             'is_admin': False,
             'created_at': datetime.now().isoformat()
         }
-        users.append(new_user)
-        save_json(USERS_FILE, users)
+        with json_transaction(USERS_FILE) as tx:
+            # Re-check under the lock in case the same email signed up concurrently
+            if user_directory.by_email(email):
+                tx.discard()
+            else:
+                tx.insert(USERS_FILE, new_user)
+        if tx.discarded:
+            flash('Account with that email already exists.', 'warning')
+            return render_template('signup.html', username=username, email=email)
         flash('Your account has been created! You can now log in.', 'success')
         return redirect(url_for('login'))
     return render_template('signup.html')
@@ -242,97 +675,82 @@ def logout():
 @login_required
 def profile():
     user_id = session['user_id']
-    users = load_json(USERS_FILE)
-    current_user = next((u for u in users if u['id'] == user_id), None)
+    current_user = user_directory.by_id(user_id)
 
     if not current_user:
         flash('User not found. Please log in again.', 'danger')
         return redirect(url_for('logout'))
 
-    likes = load_json(LIKES_FILE)
-    videos = load_json(VIDEOS_FILE)
-
-    liked_video_ids = [l['video_id'] for l in likes if l['user_id'] == user_id]
-    liked_videos = [v for v in videos if v['id'] in liked_video_ids]
-
-    enrollments = load_json(ENROLLMENTS_FILE)
-    enrolled_video_ids = [e['video_id']
-                          for e in enrollments if e['user_id'] == user_id]
-    enrolled_videos = [v for v in videos if v['id'] in enrolled_video_ids]
+    # The user's library, a page of each list at a time, most recent first
+    liked = library_section(engagement.liked_page, user_id, request.args.get('liked_page', 1, type=int))
+    enrolled = library_section(engagement.enrolled_page, user_id, request.args.get('enrolled_page', 1, type=int))
 
-    # Get dismissed ads for the current user
-    ads = load_json(ADS_FILE)
-    active_ads = [ad for ad in ads if ad.get(
-        'is_active') and user_id not in ad.get('dismissed_by_users', [])]
+    # Active ads the current user hasn't dismissed
+    active_ads = ads_index.active_ads(user_id)
 
     # Don't pass the hashed password to the template directly
     display_user = {k: v for k, v in current_user.items() if k != 'password'}
 
-    return render_template('profile.html', user=display_user, liked_videos=liked_videos,
-                           enrolled_videos=enrolled_videos, ads=active_ads)
+    return render_template('profile.html', user=display_user, liked=liked, enrolled=enrolled, ads=active_ads)
+
+# Videos per page of each profile library list
+PROFILE_PAGE_SIZE = 12
+
+def library_section(page_of, user_id, page):
+    """Returns the videos on one page of a profile list, with page, total_pages and total."""
+    page = max(page, 1)
+    video_ids, total = page_of(user_id, (page - 1) * PROFILE_PAGE_SIZE, PROFILE_PAGE_SIZE)
+    total_pages = max(1, math.ceil(total / PROFILE_PAGE_SIZE))
+    if page > total_pages:
+        page = total_pages
+        video_ids, total = page_of(user_id, (page - 1) * PROFILE_PAGE_SIZE, PROFILE_PAGE_SIZE)
+    videos = [video for video in map(catalog.get, video_ids) if video]
+    return {'videos': videos, 'page': page, 'total_pages': total_pages, 'total': total}
 
 @app.route('/like_video/<video_id>', methods=['POST'])
 @login_required
 def like_video(video_id):
     user_id = session['user_id']
-    likes = load_json(LIKES_FILE)
-    videos = load_json(VIDEOS_FILE)
 
-    video_exists = any(v['id'] == video_id for v in videos)
-    if not video_exists:
+    if not catalog.get(video_id):
         return jsonify({'success': False, 'message': 'Video not found.'})
 
-    existing_like = next(
-        (l for l in likes if l['user_id'] == user_id and l['video_id'] == video_id), None)
-
-    if existing_like:
-        # Unlike
-        likes.remove(existing_like)
-        liked = False
-    else:
-        # Like
-        likes.append({'user_id': user_id, 'video_id': video_id,
-                      'timestamp': datetime.now().isoformat()})
-        liked = True
-
-    save_json(LIKES_FILE, likes)
+    with json_transaction(LIKES_FILE) as tx:
+        if engagement.has_liked(user_id, video_id):
+            # Unlike
+            tx.delete(LIKES_FILE, {'user_id': user_id, 'video_id': video_id})
+            liked = False
+        else:
+            # Like
+            tx.insert(LIKES_FILE, {'user_id': user_id, 'video_id': video_id,
+                                   'timestamp': datetime.now().isoformat()})
+            liked = True
 
-    # Update likes_count in videos.json (denormalization)
-    for video in videos:
-        if video['id'] == video_id:
-            video['likes_count'] = len(
-                [l for l in likes if l['video_id'] == video_id])
-            break
-    save_json(VIDEOS_FILE, videos)
+    # The likes_count copy in videos.json is brought up to date by a background job
+    likes_count = engagement.like_count(video_id)
+    jobs.enqueue('recount_likes', key='recount_likes:' + video_id, delay=LIKE_RECOUNT_DELAY, video_ids=[video_id])
 
-    # Find the updated video to send its likes_count
-    updated_video = next((v for v in videos if v['id'] == video_id), {})
-    return jsonify({'success': True, 'liked': liked, 'likes_count': updated_video.get('likes_count', 0)})
+    return jsonify({'success': True, 'liked': liked, 'likes_count': likes_count})
 
 @app.route('/enroll_video/<video_id>', methods=['POST'])
 @login_required
 def enroll_video(video_id):
     user_id = session['user_id']
-    enrollments = load_json(ENROLLMENTS_FILE)
-    videos = load_json(VIDEOS_FILE)
 
-    video_exists = any(v['id'] == video_id for v in videos)
-    if not video_exists:
+    if not catalog.get(video_id):
         return jsonify({'success': False, 'message': 'Video not found.'})
 
-    existing_enrollment = next(
-        (e for e in enrollments if e['user_id'] == user_id and e['video_id'] == video_id), None)
-
-    if existing_enrollment:
-        return jsonify({'success': False, 'message': 'Already enrolled.'})
+    with json_transaction(ENROLLMENTS_FILE) as tx:
+        if engagement.is_enrolled(user_id, video_id):
+            tx.discard()
+            return jsonify({'success': False, 'message': 'Already enrolled.'})
 
-    enrollments.append({
-        'id': str(uuid.uuid4()),
-        'user_id': user_id,
-        'video_id': video_id,
-        'timestamp': datetime.now().isoformat()
-    })
-    save_json(ENROLLMENTS_FILE, enrollments)
+        tx.insert(ENROLLMENTS_FILE, {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'video_id': video_id,
+            'timestamp': datetime.now().isoformat()
+        })
     return jsonify({'success': True, 'message': 'Enrolled successfully!'})
 
 @app.route('/submit_suggestion/<video_id>', methods=['POST'])
@@ -345,31 +763,26 @@ def submit_suggestion(video_id):
         flash('Suggestion cannot be empty.', 'danger')
         return redirect(url_for('video_detail', video_id=video_id))
 
-    enrollments = load_json(ENROLLMENTS_FILE)
-    suggestions = load_json(SUGGESTIONS_FILE)
-
     # Check if user is actually enrolled in this video
-    enrolled = any(e['user_id'] == user_id and e['video_id']
-                   == video_id for e in enrollments)
+    enrolled = engagement.is_enrolled(user_id, video_id)
     if not enrolled:
         flash('You must be enrolled in this video to submit a suggestion.', 'danger')
         return redirect(url_for('video_detail', video_id=video_id))
 
     # Update existing suggestion or add new one
-    existing_suggestion = next(
-        (s for s in suggestions if s['user_id'] == user_id and s['video_id'] == video_id), None)
-    if existing_suggestion:
-        existing_suggestion['suggestion_text'] = suggestion_text
-        existing_suggestion['timestamp'] = datetime.now().isoformat()
-    else:
-        suggestions.append({
-            'id': str(uuid.uuid4()),
-            'user_id': user_id,
-            'video_id': video_id,
-            'suggestion_text': suggestion_text,
-            'timestamp': datetime.now().isoformat()
-        })
-    save_json(SUGGESTIONS_FILE, suggestions)
+    with json_transaction(SUGGESTIONS_FILE) as tx:
+        existing_suggestion = engagement.suggestion(user_id, video_id)
+        if existing_suggestion:
+            tx.update(SUGGESTIONS_FILE, {'id': existing_suggestion['id']},
+                      {'suggestion_text': suggestion_text, 'timestamp': datetime.now().isoformat()})
+        else:
+            tx.insert(SUGGESTIONS_FILE, {
+                'id': str(uuid.uuid4()),
+                'user_id': user_id,
+                'video_id': video_id,
+                'suggestion_text': suggestion_text,
+                'timestamp': datetime.now().isoformat()
+            })
     flash('Suggestion submitted successfully!', 'success')
     return redirect(url_for('video_detail', video_id=video_id))
 
@@ -378,23 +791,19 @@ def donate():
     if request.method == 'POST':
         comment = request.form.get('comment')
 
-        donation_comments = load_json(DONATION_COMMENTS_FILE)
-
         user_email = "Anonymous"
         if 'user_id' in session:
-            users = load_json(USERS_FILE)
-            current_user = next(
-                (u for u in users if u['id'] == session['user_id']), None)
+            current_user = user_directory.by_id(session['user_id'])
             if current_user:
                 user_email = current_user.get('email', 'Anonymous')
 
-        donation_comments.append({
-            'id': str(uuid.uuid4()),
-            'user_email': user_email,
-            'comment': comment,
-            'timestamp': datetime.now().isoformat()
-        })
-        save_json(DONATION_COMMENTS_FILE, donation_comments)
+        with json_transaction(DONATION_COMMENTS_FILE) as tx:
+            tx.insert(DONATION_COMMENTS_FILE, {
+                'id': str(uuid.uuid4()),
+                'user_email': user_email,
+                'comment': comment,
+                'timestamp': datetime.now().isoformat()
+            })
         # Actual payment is handled client-side/externally
         flash('Thank you for your donation!', 'success')
         return redirect(url_for('donate'))
@@ -404,119 +813,195 @@ def donate():
 @login_required
 def dismiss_ad(ad_id):
     user_id = session['user_id']
-    ads = load_json(ADS_FILE)
-
-    ad_found = False
-    for ad in ads:
-        if ad['id'] == ad_id:
-            if 'dismissed_by_users' not in ad:
-                ad['dismissed_by_users'] = []
-            if user_id not in ad['dismissed_by_users']:
-                ad['dismissed_by_users'].append(user_id)
-            ad_found = True
-            break
+
+    ad_found = ads_index.exists(ad_id)
+    if ad_found:
+        # Dismissals are appended to their own collection instead of rewriting ads.json
+        with json_transaction(AD_DISMISSALS_FILE) as tx:
+            if not ads_index.has_dismissed(user_id, ad_id):
+                tx.insert(AD_DISMISSALS_FILE, {'user_id': user_id, 'ad_id': ad_id,
+                                               'timestamp': datetime.now().isoformat()})
 
     if ad_found:
-        save_json(ADS_FILE, ads)
         return jsonify({'success': True})
     return jsonify({'success': False, 'message': 'Ad not found or already dismissed.'})
 
 # --- Admin Routes ---
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
-    users = load_json(USERS_FILE)
-    videos = load_json(VIDEOS_FILE)
-    enrollments = load_json(ENROLLMENTS_FILE)
-    likes = load_json(LIKES_FILE)
-    donation_comments = load_json(DONATION_COMMENTS_FILE)
-
-    total_users = len(users)
-    total_videos = len(videos)
-    total_enrollments = len(enrollments)
-    unique_enrollments_users = len(set(e['user_id'] for e in enrollments))
-    total_likes = len(likes)
+    donation_comments = read_json(DONATION_COMMENTS_FILE)
 
     # New users/videos in last 7 days
     seven_days_ago_dt = datetime.now() - timedelta(days=7)
-    # Use .get() with a default for robustness in case 'created_at' or 'uploaded_at' is missing
-    new_users_7days = [u for u in users if datetime.fromisoformat(u.get('created_at', '1970-01-01T00:00:00')) >= seven_days_ago_dt]
-    new_videos_7days = [v for v in videos if datetime.fromisoformat(v.get('uploaded_at', '1970-01-01T00:00:00')) >= seven_days_ago_dt]
 
     return render_template('admin_dashboard.html',
-                           total_users=total_users,
-                           total_videos=total_videos,
-                           total_enrollments=total_enrollments,
-                           unique_enrollments_users=unique_enrollments_users,
-                           total_likes=total_likes,
-                           new_users_7days_count=len(new_users_7days),
-                           new_videos_7days_count=len(new_videos_7days),
-                           donation_comments=donation_comments)
+                           new_users_7days_count=dashboard_stats.new_users_since(seven_days_ago_dt),
+                           new_videos_7days_count=dashboard_stats.new_videos_since(seven_days_ago_dt),
+                           donation_comments=donation_comments,
+                           **dashboard_stats.totals())
 
 @app.route('/admin/users')
 @admin_required
 def admin_manage_users():
-    users = load_json(USERS_FILE)
-    return render_template('admin_manage_users.html', users=users)
+    return render_template('admin_manage_users.html', users=read_json(USERS_FILE))
 
 @app.route('/admin/users/edit/<user_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_user(user_id):
-    users = load_json(USERS_FILE)
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = user_directory.by_id(user_id)
 
     if not user:
         flash('User not found.', 'danger')
         return redirect(url_for('admin_manage_users'))
 
     if request.method == 'POST':
-        user['username'] = request.form['username']
-        user['email'] = request.form['email']
         new_password = request.form['password']
-        if new_password:
-            user['password'] = bcrypt.generate_password_hash(
-                new_password).decode('utf-8')
-        user['is_admin'] = 'is_admin' in request.form
-        save_json(USERS_FILE, users)
+        # Hash before taking the lock so other writers aren't held up by bcrypt
+        try:
+            hashed_password = bcrypt.hash(new_password) if new_password else None
+        except HasherBusy:
+            flash('The server is busy right now; the user was not changed. Please try again.', 'warning')
+            return render_template('admin_edit_user.html', user=user), 429
+        fields = {
+            'username': request.form['username'],
+            'email': request.form['email'],
+            'is_admin': 'is_admin' in request.form
+        }
+        if hashed_password:
+            fields['password'] = hashed_password
+        with json_transaction(USERS_FILE) as tx:
+            if not user_directory.by_id(user_id):
+                tx.discard()
+                flash('User not found.', 'danger')
+                return redirect(url_for('admin_manage_users'))
+            tx.update(USERS_FILE, {'id': user_id}, fields)
         flash('User updated successfully!', 'success')
         return redirect(url_for('admin_manage_users'))
     return render_template('admin_edit_user.html', user=user)
 
+# --- Cascading Deletes ---
+# Deleting users or videos removes everything that refers to them in one transaction. The engagement
+# and ad indexes say which collections hold related records, so only those get a (batched) delete.
+# Recounting likes and compacting the touched event logs are left to background jobs.
+
+def _compact_later(filepaths):
+    if not isinstance(store, JsonStore):
+        return
+    for filepath in sorted(filepaths):
+        jobs.enqueue('compact_log', key='compact_log:' + filepath, filepath=filepath)
+
+def delete_users(user_ids):
+    """Deletes users with their likes, enrollments, suggestions and ad dismissals. Returns how many existed."""
+    user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_directory.by_id(user_id)]
+    if not user_ids:
+        return 0
+    with json_transaction(USERS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE, AD_DISMISSALS_FILE) as tx:
+        # Videos that lose the likes of deleted users
+        liked = list(dict.fromkeys(video_id for user_id in user_ids for video_id in engagement.liked_videos(user_id)))
+        for filepath, has_records in ((LIKES_FILE, engagement.liked_videos),
+                                      (ENROLLMENTS_FILE, engagement.enrolled_videos),
+                                      (SUGGESTIONS_FILE, engagement.suggested_videos),
+                                      (AD_DISMISSALS_FILE, ads_index.has_dismissals)):
+            affected = [user_id for user_id in user_ids if has_records(user_id)]
+            if affected:
+                tx.delete_many(filepath, 'user_id', affected)
+        tx.delete_many(USERS_FILE, 'id', user_ids)
+    if liked:
+        jobs.enqueue('recount_likes', video_ids=liked)
+    _compact_later(tx.events.keys() & set(EVENT_LOG_FILES))
+    return len(user_ids)
+
+def delete_videos(video_ids):
+    """Deletes videos with their likes, enrollments and suggestions. Returns how many existed."""
+    video_ids = [video_id for video_id in dict.fromkeys(video_ids) if catalog.get(video_id)]
+    if not video_ids:
+        return 0
+    with json_transaction(VIDEOS_FILE, LIKES_FILE, ENROLLMENTS_FILE, SUGGESTIONS_FILE) as tx:
+        for filepath, count in ((LIKES_FILE, engagement.like_count),
+                                (ENROLLMENTS_FILE, engagement.enrollment_count),
+                                (SUGGESTIONS_FILE, engagement.suggestion_count)):
+            affected = [video_id for video_id in video_ids if count(video_id)]
+            if affected:
+                tx.delete_many(filepath, 'video_id', affected)
+        tx.delete_many(VIDEOS_FILE, 'id', video_ids)
+    _compact_later(tx.events.keys() & set(EVENT_LOG_FILES))
+    return len(video_ids)
+
 @app.route('/admin/users/delete/<user_id>', methods=['POST'])
 @admin_required
 def admin_delete_user(user_id):
-    users = load_json(USERS_FILE)
-    users = [u for u in users if u['id'] != user_id]
-    save_json(USERS_FILE, users)
-    flash('User deleted successfully!', 'success')
+    if user_id == session['user_id']:
+        flash('You cannot delete your own account.', 'danger')
+    else:
+        delete_users([user_id])
+        flash('User deleted successfully!', 'success')
+    return redirect(url_for('admin_manage_users'))
+
+@app.route('/admin/users/delete', methods=['POST'])
+@admin_required
+def admin_bulk_delete_users():
+    user_ids = [user_id for user_id in request.form.getlist('user_ids') if user_id != session['user_id']]
+    if len(user_ids) < len(request.form.getlist('user_ids')):
+        flash('You cannot delete your own account; it was left out.', 'warning')
+    deleted = delete_users(user_ids)
+    flash('Deleted %d user%s.' % (deleted, '' if deleted == 1 else 's'), 'success')
     return redirect(url_for('admin_manage_users'))
 
 @app.route('/admin/videos')
 @admin_required
 def admin_manage_videos():
-    videos = load_json(VIDEOS_FILE)
+    videos = view_counter.merged_videos()
     return render_template('admin_manage_videos.html', videos=videos)
 
+def thumbnail_from_form():
+    """Returns the thumbnail URL from a video form, storing the uploaded image if there is one.
+
+    Flashes the problem and returns None when the form has neither, or the upload isn't an image.
+    """
+    upload = request.files.get('thumbnail_file')
+    if upload and upload.filename:
+        try:
+            name = thumbnails.save_upload(upload.read())
+        except thumbs.InvalidImage as e:
+            flash(str(e), 'danger')
+            return None
+        return url_for('thumbnail_upload', name=name)
+    url = request.form.get('thumbnail_url', '').strip()
+    if not url:
+        flash('Give a thumbnail URL or upload an image.', 'danger')
+        return None
+    return url
+
 @app.route('/admin/videos/add', methods=['GET', 'POST'])
 @admin_required
 def admin_add_video():
     categories = ["Cartography", "GIS", "Remote Sensing", "Survey",
                   "Photogrammetry", "Web Development", "Community Contributions"]
     if request.method == 'POST':
+        thumbnail_url = thumbnail_from_form()
+        if thumbnail_url is None:
+            return render_template('admin_add_video.html', categories=categories)
         new_video = {
             'id': str(uuid.uuid4()),
             'title': request.form['title'],
             'description': request.form['description'],
             'category': request.form['category'],
             'video_url': request.form['video_url'],
-            'thumbnail_url': request.form['thumbnail_url'],
+            'thumbnail_url': thumbnail_url,
             'uploaded_at': datetime.now().isoformat(),
             'views': 0,
             'likes_count': 0
         }
-        videos = load_json(VIDEOS_FILE)
-        videos.append(new_video)
-        save_json(VIDEOS_FILE, videos)
+        with json_transaction(VIDEOS_FILE) as tx:
+            tx.insert(VIDEOS_FILE, new_video)
+        if thumbs.available():
+            queue_thumbnail(thumbnail_url, THUMB_CARD_WIDTH, crop=True)
         flash('Video added successfully!', 'success')
         return redirect(url_for('admin_manage_videos'))
     return render_template('admin_add_video.html', categories=categories)
@@ -524,7 +1009,7 @@ def admin_add_video():
 @app.route('/admin/videos/edit/<video_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_video(video_id):
-    videos = load_json(VIDEOS_FILE)
+    videos = read_json(VIDEOS_FILE)
     video = next((v for v in videos if v['id'] == video_id), None)
     categories = ["Cartography", "GIS", "Remote Sensing", "Survey",
                   "Photogrammetry", "Web Development", "Community Contributions"]
@@ -534,12 +1019,24 @@ def admin_edit_video(video_id):
         return redirect(url_for('admin_manage_videos'))
 
     if request.method == 'POST':
-        video['title'] = request.form['title']
-        video['description'] = request.form['description']
-        video['category'] = request.form['category']
-        video['video_url'] = request.form['video_url']
-        video['thumbnail_url'] = request.form['thumbnail_url']
-        save_json(VIDEOS_FILE, videos)
+        thumbnail_url = thumbnail_from_form()
+        if thumbnail_url is None:
+            return render_template('admin_edit_video.html', video=video, categories=categories)
+        with json_transaction(VIDEOS_FILE) as tx:
+            if not catalog.get(video_id):
+                tx.discard()
+                flash('Video not found.', 'danger')
+                return redirect(url_for('admin_manage_videos'))
+            # Recorded as an update so the catalog and search indexes only refresh this video
+            tx.update(VIDEOS_FILE, {'id': video_id}, {
+                'title': request.form['title'],
+                'description': request.form['description'],
+                'category': request.form['category'],
+                'video_url': request.form['video_url'],
+                'thumbnail_url': thumbnail_url
+            })
+        if thumbs.available():
+            queue_thumbnail(thumbnail_url, THUMB_CARD_WIDTH, crop=True)
         flash('Video updated successfully!', 'success')
         return redirect(url_for('admin_manage_videos'))
     return render_template('admin_edit_video.html', video=video, categories=categories)
@@ -547,30 +1044,21 @@ def admin_edit_video(video_id):
 @app.route('/admin/videos/delete/<video_id>', methods=['POST'])
 @admin_required
 def admin_delete_video(video_id):
-    videos = load_json(VIDEOS_FILE)
-    videos = [v for v in videos if v['id'] != video_id]
-    save_json(VIDEOS_FILE, videos)
-
-    # Also remove any likes/enrollments/suggestions related to this video
-    likes = load_json(LIKES_FILE)
-    likes = [l for l in likes if l['video_id'] != video_id]
-    save_json(LIKES_FILE, likes)
-
-    enrollments = load_json(ENROLLMENTS_FILE)
-    enrollments = [e for e in enrollments if e['video_id'] != video_id]
-    save_json(ENROLLMENTS_FILE, enrollments)
-
-    suggestions = load_json(SUGGESTIONS_FILE)
-    suggestions = [s for s in suggestions if s['video_id'] != video_id]
-    save_json(SUGGESTIONS_FILE, suggestions)
-
+    delete_videos([video_id])
     flash('Video deleted successfully!', 'success')
     return redirect(url_for('admin_manage_videos'))
 
+@app.route('/admin/videos/delete', methods=['POST'])
+@admin_required
+def admin_bulk_delete_videos():
+    deleted = delete_videos(request.form.getlist('video_ids'))
+    flash('Deleted %d video%s.' % (deleted, '' if deleted == 1 else 's'), 'success')
+    return redirect(url_for('admin_manage_videos'))
+
 @app.route('/admin/ads')
 @admin_required
 def admin_manage_ads():
-    ads = load_json(ADS_FILE)
+    ads = read_json(ADS_FILE)
     return render_template('admin_manage_ads.html', ads=ads)
 
 @app.route('/admin/ads/add', methods=['GET', 'POST'])
@@ -584,12 +1072,10 @@ def admin_add_ad():
             'image_url': request.form['image_url'],
             'link_url': request.form['link_url'],
             'is_active': 'is_active' in request.form,
-            'created_at': datetime.now().isoformat(),
-            'dismissed_by_users': []
+            'created_at': datetime.now().isoformat()
         }
-        ads = load_json(ADS_FILE)
-        ads.append(new_ad)
-        save_json(ADS_FILE, ads)
+        with json_transaction(ADS_FILE) as tx:
+            tx[ADS_FILE].append(new_ad)
         flash('Announcement/Ad added successfully!', 'success')
         return redirect(url_for('admin_manage_ads'))
     return render_template('admin_add_ad.html')
@@ -597,7 +1083,7 @@ def admin_add_ad():
 @app.route('/admin/ads/edit/<ad_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_ad(ad_id):
-    ads = load_json(ADS_FILE)
+    ads = read_json(ADS_FILE)
     ad = next((a for a in ads if a['id'] == ad_id), None)
 
     if not ad:
@@ -605,12 +1091,17 @@ def admin_edit_ad(ad_id):
         return redirect(url_for('admin_manage_ads'))
 
     if request.method == 'POST':
-        ad['title'] = request.form['title']
-        ad['content'] = request.form['content']
-        ad['image_url'] = request.form['image_url']
-        ad['link_url'] = request.form['link_url']
-        ad['is_active'] = 'is_active' in request.form
-        save_json(ADS_FILE, ads)
+        with json_transaction(ADS_FILE) as tx:
+            ad = next((a for a in tx[ADS_FILE] if a['id'] == ad_id), None)
+            if not ad:
+                tx.discard()
+                flash('Announcement/Ad not found.', 'danger')
+                return redirect(url_for('admin_manage_ads'))
+            ad['title'] = request.form['title']
+            ad['content'] = request.form['content']
+            ad['image_url'] = request.form['image_url']
+            ad['link_url'] = request.form['link_url']
+            ad['is_active'] = 'is_active' in request.form
         flash('Announcement/Ad updated successfully!', 'success')
         return redirect(url_for('admin_manage_ads'))
     return render_template('admin_edit_ad.html', ad=ad)
@@ -618,50 +1109,111 @@ def admin_edit_ad(ad_id):
 @app.route('/admin/ads/delete/<ad_id>', methods=['POST'])
 @admin_required
 def admin_delete_ad(ad_id):
-    ads = load_json(ADS_FILE)
-    ads = [a for a in ads if a['id'] != ad_id]
-    save_json(ADS_FILE, ads)
+    with json_transaction(ADS_FILE, AD_DISMISSALS_FILE) as tx:
+        tx[ADS_FILE] = [a for a in tx[ADS_FILE] if a['id'] != ad_id]
+        tx.delete(AD_DISMISSALS_FILE, {'ad_id': ad_id})
     flash('Announcement/Ad deleted successfully!', 'success')
     return redirect(url_for('admin_manage_ads'))
 
-@app.route('/admin/enrollments')
-@admin_required
-def admin_enrollment_report():
-    enrollments = load_json(ENROLLMENTS_FILE)
-    users = load_json(USERS_FILE)
-    videos = load_json(VIDEOS_FILE)
-    suggestions = load_json(SUGGESTIONS_FILE)
+ENROLLMENT_REPORT_PAGE_SIZE = 50
+ENROLLMENT_REPORT_FIELDS = ['user_email', 'user_username', 'video_title', 'enrollment_timestamp', 'suggestion_text']
+# Rows per chunk written by the streaming exports
+ENROLLMENT_EXPORT_BATCH = 500
+
+def filtered_enrollments():
+    """Returns the enrollments matching the report's video_id and user (email) query filters."""
+    enrollments = read_json(ENROLLMENTS_FILE)
+    video_id = request.args.get('video_id') or None
+    user_email = (request.args.get('user') or '').strip().lower()
+
+    user_id = None
+    if user_email:
+        user = user_directory.by_email(user_email)
+        if not user:
+            return []
+        user_id = user['id']
+
+    if video_id or user_id:
+        enrollments = [e for e in enrollments
+                       if (not video_id or e['video_id'] == video_id) and (not user_id or e['user_id'] == user_id)]
+    return enrollments
+
+def enrollment_report_rows(enrollments):
+    """Yields report rows for enrollments, joining users, videos and suggestions through dictionaries."""
+    users = {u['id']: u for u in read_json(USERS_FILE)}
+    videos = {v['id']: v for v in read_json(VIDEOS_FILE)}
+    suggestions = {(s['user_id'], s['video_id']): s['suggestion_text'] for s in read_json(SUGGESTIONS_FILE)}
+    unknown_user = {'email': 'Unknown User', 'username': 'Unknown User'}
+    unknown_video = {'title': 'Unknown Video'}
 
-    report_data = []
     for e in enrollments:
-        user = next((u for u in users if u['id'] == e['user_id']), {
-                            'email': 'Unknown User', 'username': 'Unknown User'})
-        video = next((v for v in videos if v['id'] == e['video_id']), {
-                             'title': 'Unknown Video'})
-        suggestion = next(
-            (s for s in suggestions if s['user_id'] == e['user_id'] and s['video_id'] == e['video_id']), None)
-
-        report_data.append({
+        user = users.get(e['user_id'], unknown_user)
+        video = videos.get(e['video_id'], unknown_video)
+        yield {
             'user_email': user['email'],
             'user_username': user['username'],
             'video_title': video['title'],
             'enrollment_timestamp': e['timestamp'],
-            'suggestion_text': suggestion['suggestion_text'] if suggestion else 'No suggestion yet'
-        })
+            'suggestion_text': suggestions.get((e['user_id'], e['video_id']), 'No suggestion yet')
+        }
 
-    return render_template('admin_enrollment_report.html', report_data=report_data)
+@app.route('/admin/enrollments')
+@admin_required
+def admin_enrollment_report():
+    enrollments = filtered_enrollments()
+
+    # Only the rows on the requested page are joined and rendered
+    total_pages = max(1, math.ceil(len(enrollments) / ENROLLMENT_REPORT_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), total_pages)
+    start = (page - 1) * ENROLLMENT_REPORT_PAGE_SIZE
+    report_data = list(enrollment_report_rows(enrollments[start:start + ENROLLMENT_REPORT_PAGE_SIZE]))
+
+    filters = {k: request.args[k] for k in ('video_id', 'user') if request.args.get(k)}
+    videos = sorted(read_json(VIDEOS_FILE), key=lambda v: v['title'].lower())
+    return render_template('admin_enrollment_report.html', report_data=report_data, page=page,
+                           total_pages=total_pages, total_enrollments=len(enrollments),
+                           filters=filters, videos=videos)
+
+@app.route('/admin/enrollments/export.<fmt>')
+@admin_required
+def admin_enrollment_export(fmt):
+    if fmt not in ('csv', 'json'):
+        abort(404)
+    rows = enrollment_report_rows(filtered_enrollments())
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=ENROLLMENT_REPORT_FIELDS)
+        writer.writeheader()
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % ENROLLMENT_EXPORT_BATCH == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate_json():
+        chunk = ['[']
+        for i, row in enumerate(rows):
+            chunk.append((',' if i else '') + json.dumps(row))
+            if len(chunk) >= ENROLLMENT_EXPORT_BATCH:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']')
+        yield ''.join(chunk)
+
+    generate, mimetype = (generate_csv, 'text/csv') if fmt == 'csv' else (generate_json, 'application/json')
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=enrollments.%s' % fmt})
 
 # --- API Endpoints for Charting (Admin Dashboard) ---
 
 @app.route('/admin/api/video_views')
 @admin_required
 def api_video_views():
-    videos = load_json(VIDEOS_FILE)
-    view_data = {}
-    for video in videos:
-        category = video.get('category', 'Uncategorized')
-        view_data[category] = view_data.get(
-            category, 0) + video.get('views', 0)
+    # Includes views still buffered in the view log
+    view_data = dashboard_stats.views_per_category(view_counter.pending())
 
     labels = list(view_data.keys())
     data = list(view_data.values())
@@ -671,30 +1223,21 @@ def api_video_views():
 @app.route('/admin/api/enrollment_trends')
 @admin_required
 def api_enrollment_trends():
-    enrollments = load_json(ENROLLMENTS_FILE)
-    # Group enrollments by day
-    enrollment_counts = {}
-    for e in enrollments:
-        date = datetime.fromisoformat(
-            e['timestamp']).strftime('%Y-%m-%d')
-        enrollment_counts[date] = enrollment_counts.get(date, 0) + 1
-
-    # Sort by date
-    sorted_dates = sorted(enrollment_counts.keys())
-    data = [enrollment_counts[date] for date in sorted_dates]
+    # Enrollments grouped by day, sorted by date
+    enrollment_counts = dashboard_stats.enrollments_per_day()
+    sorted_dates = [date for date, _ in enrollment_counts]
+    data = [count for _, count in enrollment_counts]
 
     return jsonify({'labels': sorted_dates, 'data': data, 'chart_type': 'line', 'title': 'Enrollment Trends Over Time'})
 
 @app.route('/admin/api/likes_distribution')
 @admin_required
 def api_likes_distribution():
-    videos = load_json(VIDEOS_FILE)
     # Get top 5 most liked videos for a pie chart or bar chart
-    sorted_videos = sorted(videos, key=lambda x: x.get(
-        'likes_count', 0), reverse=True)[:5]
+    top_videos = dashboard_stats.top_liked(5)
 
-    labels = [v['title'] for v in sorted_videos]
-    data = [v.get('likes_count', 0) for v in sorted_videos]
+    labels = [title for title, _ in top_videos]
+    data = [likes_count for _, likes_count in top_videos]
 
     return jsonify({'labels': labels, 'data': data, 'chart_type': 'pie', 'title': 'Top 5 Most Liked Videos'})
 @app.route('/terms')
@@ -708,20 +1251,130 @@ def privacy():
 @app.route('/admin/api/user_activity')
 @admin_required
 def api_user_activity():
-    users = load_json(USERS_FILE)
     # Simple example: users created per month
-    user_creation_counts = {}
-    for u in users:
-        if 'created_at' in u:
-            month = datetime.fromisoformat(
-                u['created_at']).strftime('%Y-%m')
-            user_creation_counts[month] = user_creation_counts.get(
-                month, 0) + 1
-
-    sorted_months = sorted(user_creation_counts.keys())
-    data = [user_creation_counts[month] for month in sorted_months]
+    user_creation_counts = dashboard_stats.users_per_month()
+    sorted_months = [month for month, _ in user_creation_counts]
+    data = [count for _, count in user_creation_counts]
 
     return jsonify({'labels': sorted_months, 'data': data, 'chart_type': 'bar', 'title': 'User Registrations Over Time'})
 
+# --- CLI Commands ---
+
+@app.cli.command('migrate-sqlite')
+@click.option('--database', default=None, help='SQLite file to import into (defaults to SQLITE_DATABASE).')
+def migrate_sqlite(database):
+    """Imports the JSON files in the data directory into the SQLite backend, replacing its contents."""
+    source = JsonStore(log_files=EVENT_LOG_FILES)
+    target = SqliteStore(database or app.config['SQLITE_DATABASE'])
+    # A single transaction, so a failed import leaves the database as it was
+    with target.lock(*ALL_DATA_FILES):
+        for filepath in ALL_DATA_FILES:
+            rows = source.load(filepath)
+            target.save(filepath, rows)
+            click.echo('%s: %d rows' % (os.path.basename(filepath), len(rows)))
+    click.echo('Imported into %s. Set STORAGE_BACKEND=sqlite to use it.' % target.database)
+
+@app.cli.command('compact-logs')
+def compact_logs():
+    """Folds the engagement event logs into their JSON files."""
+    if not isinstance(store, JsonStore):
+        click.echo('The %s backend keeps no event logs.' % app.config['STORAGE_BACKEND'])
+        return
+    for filepath in EVENT_LOG_FILES:
+        store.compact(filepath)
+        click.echo('Compacted %s' % os.path.basename(filepath))
+
+@app.cli.command('build-related')
+def build_related_command():
+    """Rebuilds the related-videos table from likes and enrollments."""
+    started = time.perf_counter()
+    table = build_related(store, [LIKES_FILE, ENROLLMENTS_FILE])
+    related_videos.save(table)
+    click.echo('Related videos for %d videos in %.1fs -> %s' % (len(table), time.perf_counter() - started,
+                                                               related_videos.path))
+
+# Collections handled by `flask data export/import`, by name
+DATA_COLLECTIONS = {'users': USERS_FILE, 'videos': VIDEOS_FILE, 'enrollments': ENROLLMENTS_FILE, 'likes': LIKES_FILE}
+
+data_cli = AppGroup('data', help='Export and import collections as JSON Lines.')
+app.cli.add_command(data_cli)
+
+@data_cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--collection', '-c', 'names', multiple=True, type=click.Choice(dataio.COLLECTIONS),
+              help='Collection to export (repeatable; defaults to all of them).')
+def data_export(directory, names):
+    """Writes collections to DIRECTORY as <collection>.jsonl files."""
+    os.makedirs(directory, exist_ok=True)
+    for name in names or dataio.COLLECTIONS:
+        out_path = os.path.join(directory, name + '.jsonl')
+        count = dataio.export_collection(store, DATA_COLLECTIONS[name], out_path)
+        click.echo('%s: %d records -> %s' % (name, count, out_path))
+
+@data_cli.command('import')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--replace', is_flag=True, help='Empty each imported collection first instead of adding to it.')
+@click.option('--skip-invalid', is_flag=True, help='Skip invalid records instead of aborting the import.')
+@click.option('--batch-size', default=dataio.IMPORT_BATCH_SIZE, show_default=True, help='Records written per batch.')
+def data_import(paths, replace, skip_invalid, batch_size):
+    """Imports <collection>.jsonl files, or directories holding them, all or nothing.
+
+    Records whose id (or email, or user/video pair) is already present are skipped. Likes and
+    enrollments must name users and videos that exist or are part of the same import.
+    """
+    try:
+        stats = dataio.import_collections(store, DATA_COLLECTIONS, dataio.find_sources(paths), replace=replace,
+                                          skip_invalid=skip_invalid, batch_size=batch_size,
+                                          warn=lambda message: click.echo('Skipped %s' % message, err=True))
+    except dataio.InvalidRecord as e:
+        raise click.ClickException('%s. Nothing was imported.' % e)
+    for name, counts in stats.items():
+        click.echo('%s: %d imported, %d duplicates, %d invalid' % (
+            name, counts['imported'], counts['duplicates'], counts['invalid']))
+
+assets_cli = AppGroup('assets', help='Build static asset bundles.')
+app.cli.add_command(assets_cli)
+
+@assets_cli.command('build')
+def assets_build():
+    """Writes minified, content-hashed bundles of the stylesheets and scripts to static/dist."""
+    for filename, hashed in sorted(static_assets.build().items()):
+        click.echo('%s -> %s/%s' % (filename, static_assets.dist, hashed))
+    if assets.brotli is None:
+        click.echo('brotli is not installed, so only gzip variants were written.')
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+app.cli.add_command(jobs_cli)
+
+@jobs_cli.command('work')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds to wait when no job is due.')
+@click.option('--once', is_flag=True, help='Run the jobs that are due now, then exit.')
+def jobs_work(poll_interval, once):
+    """Runs queued and periodic jobs until stopped. SIGTERM lets the current job finish first."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if once:
+        click.echo('Ran %d jobs.' % jobs.run_due())
+        return
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    click.echo('Working on %s (tasks: %s)' % (jobs.database, ', '.join(sorted(jobs.tasks))))
+    try:
+        jobs.work(poll_interval=poll_interval, should_stop=lambda: bool(stopping))
+    except KeyboardInterrupt:
+        pass
+
+@jobs_cli.command('status')
+def jobs_status():
+    """Shows how many jobs are queued, running and failed, and the latest failures."""
+    counts = jobs.counts()
+    click.echo(', '.join('%s: %d' % (status, counts.get(status, 0)) for status in ('queued', 'running', 'failed')))
+    for job_id, name, args, attempts, last_error in jobs.failed():
+        click.echo('\n#%d %s %s after %d attempts:\n%s' % (job_id, name, args, attempts, last_error.rstrip()))
+
+@jobs_cli.command('retry-failed')
+def jobs_retry_failed():
+    """Queues every failed job again."""
+    click.echo('Queued %d jobs.' % jobs.retry_failed())
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,33 @@
+import os
+
+from a2wsgi import WSGIMiddleware
+
+from app import app
+
+# --- ASGI Entry Point ---
+# Serves the app from an event loop instead of gunicorn's sync workers (see
+# "Deployment" in the README):
+#
+#     gunicorn asgi:application -k uvicorn_worker.UvicornWorker -w $WEB_CONCURRENCY
+#
+# The loop only accepts connections and moves bytes; each request runs on a
+# thread pool, so one waiting on a file lock, an fsync or the bcrypt pool ties
+# up a thread rather than the worker. The AJAX engagement endpoints used by
+# static/js/script.js get a pool of their own, so a burst of likes never
+# queues behind slow page renders or exports, and vice versa.
+
+# Threads per worker for page requests and for the engagement endpoints
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+ASGI_ENGAGEMENT_THREADS = int(os.environ.get('ASGI_ENGAGEMENT_THREADS', 16))
+
+ENGAGEMENT_PREFIXES = ('/like_video/', '/enroll_video/', '/dismiss_ad/')
+
+pages = WSGIMiddleware(app, workers=ASGI_THREADS)
+engagement = WSGIMiddleware(app, workers=ASGI_ENGAGEMENT_THREADS)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'].startswith(ENGAGEMENT_PREFIXES):
+        await engagement(scope, receive, send)
+    else:
+        await pages(scope, receive, send)
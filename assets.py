@@ -0,0 +1,297 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are built without it
+    brotli = None
+
+# --- Static Asset Bundles ---
+# `flask assets build` minifies the stylesheets and scripts under static/,
+# writes each to static/dist/ under a name carrying a hash of its content,
+# next to .gz (and, when the brotli package is installed, .br) copies, and
+# records the names in static/dist/manifest.json. Templates keep calling
+# url_for('static', filename='css/style.css'); while a manifest is loaded
+# that URL points at the hashed file instead. A hashed name never changes
+# content, so it is served with an immutable Cache-Control header and
+# browsers don't ask for it again until a build produces a new name.
+#
+# Without a build, or for a source edited since the last one, the original
+# file is served as before.
+
+BUNDLE_EXTENSIONS = ('.css', '.js')
+
+# One year, the longest max-age caches are asked to honour
+IMMUTABLE_MAX_AGE = 31536000
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticAssets:
+    def __init__(self, static_folder, dist='dist'):
+        self.static_folder = static_folder
+        self.dist = dist  # directory under static_folder the bundles go to
+        self.bundles = {}  # source filename -> hashed filename, both relative to static_folder
+
+    @property
+    def dist_folder(self):
+        return os.path.join(self.static_folder, self.dist)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.dist_folder, 'manifest.json')
+
+    def sources(self):
+        """Returns the filenames under static_folder that get bundled, outside dist."""
+        found = []
+        for root, dirs, files in os.walk(self.static_folder):
+            if os.path.abspath(root) == os.path.abspath(self.static_folder):
+                dirs[:] = [name for name in dirs if name != self.dist]
+            for name in files:
+                if name.endswith(BUNDLE_EXTENSIONS):
+                    path = os.path.relpath(os.path.join(root, name), self.static_folder)
+                    found.append(path.replace(os.sep, '/'))
+        return sorted(found)
+
+    def build(self):
+        """Writes minified, hashed and compressed bundles plus the manifest. Returns the manifest."""
+        previous = self._read_manifest()
+        manifest = {}
+        for filename in self.sources():
+            with open(os.path.join(self.static_folder, filename), encoding='utf-8') as f:
+                source = f.read()
+            body = minify(filename, source).encode('utf-8')
+            stem, ext = os.path.splitext(filename)
+            hashed = '%s.%s%s' % (stem, hashlib.sha256(body).hexdigest()[:12], ext)
+            path = os.path.join(self.dist_folder, hashed)
+            if not os.path.exists(path):
+                _write(path, body)
+                _write(path + '.gz', gzip.compress(body, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write(path + '.br', brotli.compress(body, mode=brotli.MODE_TEXT))
+            manifest[filename] = hashed
+        _write(self.manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+        # Pages rendered before this build may still name the previous bundles, so they're kept one build longer
+        self._prune(set(manifest.values()) | set(previous.values()))
+        self.bundles = {filename: self.dist + '/' + hashed for filename, hashed in manifest.items()}
+        return manifest
+
+    def load(self):
+        """Reads the manifest, skipping bundles whose source changed since they were built."""
+        bundles = {}
+        for filename, hashed in self._read_manifest().items():
+            source = os.path.join(self.static_folder, filename)
+            built = os.path.join(self.dist_folder, hashed)
+            try:
+                if os.path.getmtime(source) <= os.path.getmtime(built):
+                    bundles[filename] = self.dist + '/' + hashed
+            except OSError:
+                continue
+        self.bundles = bundles
+        return bundles
+
+    def url_for_bundle(self, filename):
+        """Returns the hashed filename to link for filename, or filename when it has no bundle."""
+        return self.bundles.get(filename, filename)
+
+    def is_bundle(self, filename):
+        return filename.startswith(self.dist + '/') and filename.endswith(BUNDLE_EXTENSIONS)
+
+    def variant(self, filename, accepts):
+        """Returns (filename, encoding) of the smallest copy of a bundle the client takes.
+
+        accepts(encoding) tells whether the client accepts encoding; encoding is None for the plain file.
+        """
+        for encoding, suffix in ENCODINGS:
+            if accepts(encoding) and os.path.isfile(os.path.join(self.static_folder, filename + suffix)):
+                return filename + suffix, encoding
+        return filename, None
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _prune(self, keep):
+        keep = {os.path.normpath(name) for name in keep}
+        for root, dirs, files in os.walk(self.dist_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.dist_folder)
+                base = relative
+                for _, suffix in ENCODINGS:
+                    if base.endswith(suffix):
+                        base = base[:-len(suffix)]
+                if base.endswith(BUNDLE_EXTENSIONS) and base not in keep:
+                    os.remove(path)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# --- Minification ---
+# Deliberately conservative: comments and indentation go, everything the
+# browser could read differently stays. Scripts keep their line breaks, so
+# automatic semicolon insertion sees the same statements as before.
+
+def minify(filename, source):
+    if filename.endswith('.css'):
+        return minify_css(source)
+    if filename.endswith('.js'):
+        return minify_js(source)
+    return source
+
+
+_CSS_TOKENS = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/|(\s+)''', re.S)
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(source):
+    strings = []
+
+    def token(match):
+        if match.group(1):
+            strings.append(match.group(1))
+            return '\0%d\0' % (len(strings) - 1)
+        # A comment can separate two words, so it becomes a space like whitespace does
+        return ' '
+
+    text = _CSS_TOKENS.sub(token, source)
+    text = _CSS_PUNCTUATION.sub(r'\1', text)
+    text = re.sub(r' +', ' ', text).replace(';}', '}').strip()
+    return re.sub(r'\0(\d+)\0', lambda match: strings[int(match.group(1))], text) + '\n'
+
+
+# A slash after one of these, or after a keyword, starts a regular expression rather than a division
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_KEYWORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw')
+
+
+def minify_js(source):
+    out = []  # (kept verbatim, text)
+    code = []
+    braces = []  # brace depth at each open ${ ... } inside a template literal
+    depth = 0
+    i = 0
+    n = len(source)
+
+    def flush():
+        if code:
+            out.append((False, ''.join(code)))
+            del code[:]
+
+    def preceding_code():
+        text = ''.join(code).rstrip()
+        if text:
+            return text
+        for verbatim, chunk in reversed(out):
+            if not verbatim:
+                chunk = chunk.rstrip()
+                if chunk:
+                    return chunk
+            elif chunk:
+                return chunk
+        return ''
+
+    def scan_string(start, quote):
+        j = start + 1
+        while j < n and source[j] != quote:
+            j += 2 if source[j] == '\\' else 1
+        return j + 1
+
+    def scan_template(start):
+        j = start
+        while j < n:
+            if source[j] == '\\':
+                j += 2
+            elif source[j] == '`':
+                return j + 1, False
+            elif source.startswith('${', j):
+                return j + 2, True
+            else:
+                j += 1
+        return n, False
+
+    def template(start):
+        """Keeps template text verbatim from just after ` or }, up to the closing ` or the next ${."""
+        end, opens = scan_template(start)
+        flush()
+        out.append((True, source[start - 1:end]))  # from the opening ` or the } closing an expression
+        if opens:
+            braces.append(depth)
+        return end
+
+    while i < n:
+        ch = source[i]
+        if ch in '"\'':
+            end = scan_string(i, ch)
+            flush()
+            out.append((True, source[i:end]))
+            i = end
+        elif ch == '`':
+            i = template(i + 1)
+        elif ch == '/' and source.startswith('//', i):
+            end = source.find('\n', i)
+            i = n if end == -1 else end
+        elif ch == '/' and source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            code.append(' ')
+        elif ch == '/' and _starts_regex(preceding_code()):
+            j = i + 1
+            in_class = False
+            while j < n and source[j] != '\n' and (in_class or source[j] != '/'):
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and (source[j].isalnum() or source[j] == '_'):
+                j += 1
+            flush()
+            out.append((True, source[i:j]))
+            i = j
+        elif ch == '{':
+            depth += 1
+            code.append(ch)
+            i += 1
+        elif ch == '}' and braces and braces[-1] == depth:
+            braces.pop()
+            i = template(i + 1)
+        else:
+            if ch == '}':
+                depth -= 1
+            code.append(ch)
+            i += 1
+    flush()
+
+    text = ''.join(chunk if verbatim else _collapse_js(chunk) for verbatim, chunk in out)
+    return text.strip() + '\n'
+
+
+def _starts_regex(before):
+    if not before:
+        return True
+    if before[-1] in _REGEX_PRECEDERS:
+        return True
+    word = re.search(r'[A-Za-z_$][\w$]*$', before)
+    return word is not None and word.group(0) in _REGEX_KEYWORDS
+
+
+def _collapse_js(chunk):
+    chunk = re.sub(r'[ \t]*\n\s*', '\n', chunk)
+    return re.sub(r'[ \t]+', ' ', chunk)
@@ -0,0 +1,415 @@
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+import bcrypt
+import click
+
+# --- Benchmark Harness ---
+# Generates synthetic data sets, drives the hot routes through the Flask test
+# client and through a local gunicorn, and prints latency percentiles,
+# throughput and peak RSS per route as JSON so runs can be diffed:
+#
+#     python benchmark.py run --tier 100k --output bench-100k.json
+#
+# Every run works on a fresh copy of the app in a temporary directory, so the
+# real data/ directory is never touched.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILES = ['app.py', 'aggregates.py', 'assets.py', 'dataio.py', 'datastore.py', 'indexes.py', 'jobs.py', 'metrics.py',
+             'pagecache.py', 'passwords.py', 'related.py', 'search.py', 'sqlitestore.py', 'thumbs.py', 'viewcounts.py']
+APP_DIRS = ['templates', 'static']
+
+# users, likes and enrollments per tier
+TIERS = {'1k': 1000, '100k': 100000, '1m': 1000000}
+CATEGORIES = ["Cartography", "GIS", "Remote Sensing", "Survey",
+              "Photogrammetry", "Web Development", "Community Contributions"]
+PASSWORD = 'benchmark'
+ADMIN_EMAIL = 'user0@example.com'
+
+# Routes in the order they are driven; reads go first so writes don't skew them
+ROUTES = ['library', 'video_detail', 'admin_enrollments', 'login', 'like_video', 'enroll_video']
+
+
+# --- Data Generation ---
+
+def video_count(users):
+    return min(max(50, users // 100), 10000)
+
+
+def write_rows(path, rows):
+    """Streams rows into a JSON array one at a time so large tiers don't have to fit in memory."""
+    with open(path, 'w') as f:
+        f.write('[')
+        for i, row in enumerate(rows):
+            f.write(',\n' if i else '\n')
+            f.write(json.dumps(row))
+        f.write('\n]')
+
+
+def generate(data_dir, users, rounds=12, seed=0):
+    """Writes users, videos, likes, enrollments and suggestions for a tier into data_dir."""
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(seed)
+    videos = video_count(users)
+    now = datetime.now()
+    # One hash shared by every account; hashing a million passwords would take days
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+    def timestamp(max_days):
+        return (now - timedelta(seconds=rng.randrange(max_days * 86400))).isoformat()
+
+    write_rows(os.path.join(data_dir, 'users.json'), ({
+        'id': 'user-%d' % i,
+        'username': 'user%d' % i,
+        'email': 'user%d@example.com' % i,
+        'password': password,
+        'is_admin': i == 0,
+        'created_at': timestamp(365)
+    } for i in range(users)))
+
+    # Each user likes and enrolls in one video, spread evenly so (user, video) pairs are unique
+    likes_per_video = [0] * videos
+    def likes():
+        for i in range(users):
+            video = (i * 7 + i // videos) % videos
+            likes_per_video[video] += 1
+            yield {'user_id': 'user-%d' % i, 'video_id': 'video-%d' % video, 'timestamp': timestamp(180)}
+    write_rows(os.path.join(data_dir, 'likes.json'), likes())
+
+    write_rows(os.path.join(data_dir, 'enrollments.json'), ({
+        'id': 'enrollment-%d' % i,
+        'user_id': 'user-%d' % i,
+        'video_id': 'video-%d' % ((i * 3 + 1) % videos),
+        'timestamp': timestamp(180)
+    } for i in range(users)))
+
+    write_rows(os.path.join(data_dir, 'suggestions.json'), ({
+        'id': 'suggestion-%d' % i,
+        'user_id': 'user-%d' % i,
+        'video_id': 'video-%d' % ((i * 3 + 1) % videos),
+        'suggestion_text': 'More examples on %s please' % rng.choice(CATEGORIES).lower(),
+        'timestamp': timestamp(90)
+    } for i in range(0, users, 10)))
+
+    write_rows(os.path.join(data_dir, 'videos.json'), ({
+        'id': 'video-%d' % i,
+        'title': '%s lesson %d' % (rng.choice(CATEGORIES), i),
+        'description': 'Synthetic benchmark video %d' % i,
+        'category': rng.choice(CATEGORIES),
+        'video_url': 'https://example.com/videos/%d' % i,
+        'thumbnail_url': 'https://example.com/thumbs/%d.jpg' % i,
+        'uploaded_at': timestamp(730),
+        'views': rng.randrange(10000),
+        'likes_count': likes_per_video[i]
+    } for i in range(videos)))
+
+    for name in ('ads.json', 'ad_dismissals.json', 'donation_comments.json'):
+        write_rows(os.path.join(data_dir, name), [])
+
+
+def prepare_workdir(tier, rounds):
+    workdir = tempfile.mkdtemp(prefix='gis-bench-')
+    for name in APP_FILES:
+        shutil.copy(os.path.join(APP_DIR, name), workdir)
+    for name in APP_DIRS:
+        shutil.copytree(os.path.join(APP_DIR, name), os.path.join(workdir, name))
+    generate(os.path.join(workdir, 'data'), TIERS[tier], rounds=rounds)
+    return workdir
+
+
+# --- Request Plans ---
+
+def plan(route, users, rng):
+    """Returns (method, path, form, session) for one request.
+
+    session is None (anonymous), 'user', 'admin', or 'fresh' for a new anonymous session per request.
+    """
+    video = 'video-%d' % rng.randrange(video_count(users))
+    if route == 'library':
+        query = {'sort_by': rng.choice(['recently_uploaded', 'most_liked', 'most_viewed'])}
+        if rng.random() < 0.5:
+            query['category'] = rng.choice(CATEGORIES)
+        return 'GET', '/library?' + urllib.parse.urlencode(query), None, None
+    if route == 'video_detail':
+        return 'GET', '/video/' + video, None, 'user'
+    if route == 'admin_enrollments':
+        return 'GET', '/admin/enrollments?page=%d' % (rng.randrange(max(1, users // 50)) + 1), None, 'admin'
+    if route == 'login':
+        form = {'email': 'user%d@example.com' % rng.randrange(1, users), 'password': PASSWORD}
+        return 'POST', '/login', form, 'fresh'
+    if route == 'like_video':
+        return 'POST', '/like_video/' + video, None, 'user'
+    if route == 'enroll_video':
+        return 'POST', '/enroll_video/' + video, None, 'user'
+    raise ValueError('Unknown route: %r' % route)
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None
+    }
+
+
+def credentials(session):
+    # user1 is a regular account; user0 is the admin
+    return {'email': ADMIN_EMAIL if session == 'admin' else 'user1@example.com', 'password': PASSWORD}
+
+
+# --- Drivers ---
+
+def drive_client(workdir, tier, routes, requests, seed):
+    """Runs the routes through the Flask test client inside this process."""
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    started = time.perf_counter()
+    import app as app_module
+    startup = time.perf_counter() - started
+
+    app_module.app.config['TESTING'] = True
+    clients = {}
+    for session in (None, 'user', 'admin'):
+        clients[session] = app_module.app.test_client()
+        if session:
+            clients[session].post('/login', data=credentials(session))
+
+    users = TIERS[tier]
+    results = {}
+    for route in routes:
+        rng = random.Random(seed)
+        latencies, errors = [], 0
+        route_started = time.perf_counter()
+        for _ in range(requests):
+            method, path, form, session = plan(route, users, rng)
+            client = app_module.app.test_client() if session == 'fresh' else clients[session]
+            t = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            response.get_data()
+            latencies.append(time.perf_counter() - t)
+            errors += response.status_code >= 400
+        results[route] = summarize(latencies, errors, time.perf_counter() - route_started)
+
+    return {
+        'startup_s': round(startup, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'routes': results
+    }
+
+
+def drive_gunicorn(workdir, tier, routes, requests, concurrency, workers, seed, env):
+    """Runs the routes against a local gunicorn serving the work directory over HTTP."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    base = 'http://127.0.0.1:%d' % port
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '-w', str(workers),
+                               '-b', '127.0.0.1:%d' % port, '--timeout', '600'],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(base, server)
+        # Every worker imports the app; make sure they've all loaded the data before timing anything
+        time.sleep(1)
+        startup = time.perf_counter() - started
+
+        users = TIERS[tier]
+        results = {}
+        for route in routes:
+            results[route] = run_http_route(base, route, users, requests, concurrency, seed)
+        return {
+            'startup_s': round(startup, 3),
+            'peak_rss_kb': max([peak_rss(pid) for pid in worker_pids(server.pid)] or [0]),
+            'routes': results
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_http_route(base, route, users, requests, concurrency, seed):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(seed + index)
+        openers = {}
+        for _ in range(count):
+            method, path, form, session = plan(route, users, rng)
+            if session == 'fresh':
+                opener = http_session(base, None)
+            else:
+                if session not in openers:
+                    openers[session] = http_session(base, session)
+                opener = openers[session]
+            data = urllib.parse.urlencode(form).encode() if form else (b'' if method == 'POST' else None)
+            t = time.perf_counter()
+            try:
+                with opener.open(urllib.request.Request(base + path, data=data, method=method)) as r:
+                    r.read()
+                failed = False
+            except urllib.error.HTTPError as e:
+                failed = e.code >= 400
+            elapsed = time.perf_counter() - t
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i, requests // concurrency + (i < requests % concurrency)))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def http_session(base, session):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    if session:
+        opener.open(base + '/login', urllib.parse.urlencode(credentials(session)).encode()).read()
+    return opener
+
+
+def wait_until_up(base, server, timeout=900):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException('gunicorn exited with status %d' % server.returncode)
+        try:
+            urllib.request.urlopen(base + '/terms', timeout=5).read()
+            return
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.5)
+    raise click.ClickException('gunicorn did not start within %ds' % timeout)
+
+
+def worker_pids(master_pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    # the command name may contain spaces, so split after its closing parenthesis
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == master_pid:
+                        pids.append(int(name))
+            except (OSError, IndexError, ValueError):
+                continue
+    return pids
+
+
+def peak_rss(pid):
+    """Returns the high-water resident set size of pid in KB (Linux only)."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+# --- Commands ---
+
+@click.group()
+def cli():
+    """Benchmarks for the GIS content platform."""
+
+
+@cli.command()
+@click.option('--tier', type=click.Choice(sorted(TIERS)), default='1k', show_default=True)
+@click.option('--out', 'data_dir', default='bench-data', show_default=True, help='Directory to write the JSON files to.')
+@click.option('--bcrypt-rounds', default=12, show_default=True)
+def generate_data(tier, data_dir, bcrypt_rounds):
+    """Writes a synthetic data set for a tier."""
+    generate(data_dir, TIERS[tier], rounds=bcrypt_rounds)
+    click.echo('Wrote %s tier to %s' % (tier, data_dir))
+
+
+@cli.command()
+@click.option('--tier', type=click.Choice(sorted(TIERS)), default='1k', show_default=True)
+@click.option('--mode', type=click.Choice(['client', 'gunicorn', 'both']), default='both', show_default=True)
+@click.option('--route', 'routes', multiple=True, type=click.Choice(ROUTES), help='Routes to drive (default: all).')
+@click.option('--requests', default=200, show_default=True, help='Requests per route.')
+@click.option('--concurrency', default=8, show_default=True, help='Concurrent HTTP clients (gunicorn mode).')
+@click.option('--workers', default=2, show_default=True, help='gunicorn workers.')
+@click.option('--bcrypt-rounds', default=12, show_default=True, help='Cost of the generated password hashes.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+def run(tier, mode, routes, requests, concurrency, workers, bcrypt_rounds, seed, output):
+    """Generates a tier and benchmarks the hot routes against it."""
+    routes = [r for r in ROUTES if not routes or r in routes]
+    env = dict(os.environ, BCRYPT_LOG_ROUNDS=str(bcrypt_rounds), STORAGE_BACKEND='json')
+    report = {
+        'tier': tier,
+        'requests_per_route': requests,
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': {}
+    }
+
+    for current in (['client', 'gunicorn'] if mode == 'both' else [mode]):
+        workdir = prepare_workdir(tier, bcrypt_rounds)
+        try:
+            if current == 'client':
+                # A separate process so its peak RSS covers only the app under test
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), 'drive-client', workdir,
+                                      '--tier', tier, '--requests', str(requests), '--seed', str(seed)]
+                                     + ['--route=%s' % r for r in routes],
+                                     env=env, check=True, stdout=subprocess.PIPE).stdout
+                report['results']['client'] = json.loads(out)
+            else:
+                report['results']['gunicorn'] = dict(
+                    drive_gunicorn(workdir, tier, routes, requests, concurrency, workers, seed, env),
+                    workers=workers, concurrency=concurrency)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        click.echo(text)
+
+
+@cli.command('drive-client', hidden=True)
+@click.argument('workdir')
+@click.option('--tier', type=click.Choice(sorted(TIERS)))
+@click.option('--route', 'routes', multiple=True)
+@click.option('--requests', type=int)
+@click.option('--seed', type=int)
+def drive_client_command(workdir, tier, routes, requests, seed):
+    click.echo(json.dumps(drive_client(workdir, tier, list(routes), requests, seed)))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,210 @@
+import json
+import os
+from datetime import datetime
+
+from indexes import normalize_email, parse_timestamp
+
+# --- Bulk Import/Export ---
+# Collections move in and out as JSON Lines, one record per line, so a backup
+# or a migration from another system is never parsed as one document. Import
+# reads its input a line at a time and hands rows to the store in batches;
+# only the keys used for deduplication and reference checks stay in memory.
+
+# Import order, so enrollments and likes can be checked against the users and videos they name
+COLLECTIONS = ('users', 'videos', 'enrollments', 'likes')
+
+IMPORT_BATCH_SIZE = 1000
+
+
+class InvalidRecord(ValueError):
+    """Raised for a record that can't be imported, or an input that can't be read."""
+
+
+def _text(row, field, required=True):
+    value = row.get(field)
+    if value is None and not required:
+        return
+    if not isinstance(value, str) or not value.strip():
+        raise InvalidRecord('%r must be a non-empty string' % field)
+
+
+def _count(row, field):
+    value = row.setdefault(field, 0)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise InvalidRecord('%r must be a non-negative integer' % field)
+
+
+def _timestamp(row, field, required=False):
+    value = row.get(field)
+    if value is None and not required:
+        return
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise InvalidRecord('%r must be an ISO 8601 timestamp' % field)
+    # The app stores naive local times, which can't be compared with ones carrying a UTC offset
+    if timestamp.tzinfo is not None:
+        row[field] = parse_timestamp(value).isoformat()
+
+
+def validate_user(row):
+    for field in ('id', 'username', 'email', 'password'):
+        _text(row, field)
+    if '@' not in row['email']:
+        raise InvalidRecord('%r is not an email address' % row['email'])
+    # Anything else would lock the account out, since only bcrypt hashes are checked at login
+    if not row['password'].startswith('$2'):
+        raise InvalidRecord("'password' must be a bcrypt hash")
+    if not isinstance(row.setdefault('is_admin', False), bool):
+        raise InvalidRecord("'is_admin' must be true or false")
+    _timestamp(row, 'created_at')
+
+
+def validate_video(row):
+    for field in ('id', 'title', 'video_url'):
+        _text(row, field)
+    for field in ('description', 'category', 'thumbnail_url'):
+        if not isinstance(row.get(field, ''), str):
+            raise InvalidRecord('%r must be a string' % field)
+    _count(row, 'views')
+    _count(row, 'likes_count')
+    _timestamp(row, 'uploaded_at')
+
+
+def validate_enrollment(row):
+    for field in ('id', 'user_id', 'video_id'):
+        _text(row, field)
+    _timestamp(row, 'timestamp', required=True)
+
+
+def validate_like(row):
+    for field in ('user_id', 'video_id'):
+        _text(row, field)
+    _timestamp(row, 'timestamp')
+
+
+VALIDATORS = {
+    'users': validate_user,
+    'videos': validate_video,
+    'enrollments': validate_enrollment,
+    'likes': validate_like,
+}
+
+# Fields that must name an existing record of another collection
+REFERENCES = {
+    'enrollments': {'user_id': 'users', 'video_id': 'videos'},
+    'likes': {'user_id': 'users', 'video_id': 'videos'},
+}
+
+
+def unique_keys(name, row):
+    """Returns the keys no two records of collection name may share."""
+    if name == 'users':
+        return [('id', row.get('id')), ('email', normalize_email(row.get('email')))]
+    if name == 'likes':
+        return [('pair', row.get('user_id'), row.get('video_id'))]
+    if name == 'enrollments':
+        return [('id', row.get('id')), ('pair', row.get('user_id'), row.get('video_id'))]
+    return [('id', row.get('id'))]
+
+
+def export_collection(store, filepath, out_path):
+    """Writes the collection at filepath to out_path as JSON Lines. Returns the number of records."""
+    tmp_path = out_path + '.tmp'
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for row in store.iter_rows(filepath):
+            f.write(json.dumps(row, separators=(',', ':')) + '\n')
+            count += 1
+    os.replace(tmp_path, out_path)
+    return count
+
+
+def find_sources(paths):
+    """Maps collection names to the .jsonl files among paths, looking inside directories."""
+    sources = {}
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name + '.jsonl') for name in COLLECTIONS]
+            candidates = [candidate for candidate in candidates if os.path.exists(candidate)]
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            name = os.path.splitext(os.path.basename(candidate))[0]
+            if name not in COLLECTIONS:
+                raise InvalidRecord('%s is not named after a collection (%s)' % (candidate, ', '.join(COLLECTIONS)))
+            sources[name] = candidate
+    return sources
+
+
+def import_collections(store, filepaths, sources, replace=False, skip_invalid=False,
+                       batch_size=IMPORT_BATCH_SIZE, warn=None):
+    """Imports JSON Lines files into store, all of them or none.
+
+    filepaths maps collection names to store paths and sources maps them to input files. Records
+    sharing a key with an existing record, or an earlier one in the input, are skipped. An invalid
+    record raises InvalidRecord and leaves the store untouched, unless skip_invalid is set, in which
+    case it is passed to warn(message) and skipped.
+    Returns {collection: {'imported': n, 'duplicates': n, 'invalid': n}}.
+    """
+    names = [name for name in COLLECTIONS if name in sources]
+    keys = {}  # collection -> unique keys present after this import
+
+    def existing_keys(name):
+        if name not in keys:
+            keys[name] = set()
+            for row in store.iter_rows(filepaths[name]):
+                keys[name].update(unique_keys(name, row))
+        return keys[name]
+
+    stats = {}
+    with store.bulk_import(*(filepaths[name] for name in names)) as writer:
+        for name in names:
+            filepath = filepaths[name]
+            if replace:
+                keys[name] = set()
+            seen = existing_keys(name)
+            writer.begin(filepath, keep=not replace)
+            counts = stats[name] = {'imported': 0, 'duplicates': 0, 'invalid': 0}
+            batch = []
+            with open(sources[name], encoding='utf-8') as f:
+                for lineno, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        row = _parse(line)
+                        VALIDATORS[name](row)
+                        for field, target in REFERENCES.get(name, {}).items():
+                            if ('id', row[field]) not in existing_keys(target):
+                                raise InvalidRecord('%s %r does not exist' % (field, row[field]))
+                    except InvalidRecord as e:
+                        message = '%s line %d: %s' % (sources[name], lineno, e)
+                        if not skip_invalid:
+                            raise InvalidRecord(message)
+                        counts['invalid'] += 1
+                        if warn is not None:
+                            warn(message)
+                        continue
+                    row_keys = unique_keys(name, row)
+                    if any(key in seen for key in row_keys):
+                        counts['duplicates'] += 1
+                        continue
+                    seen.update(row_keys)
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        writer.append(filepath, batch)
+                        counts['imported'] += len(batch)
+                        batch = []
+            writer.append(filepath, batch)
+            counts['imported'] += len(batch)
+    return stats
+
+
+def _parse(line):
+    try:
+        row = json.loads(line)
+    except ValueError as e:
+        raise InvalidRecord('not valid JSON (%s)' % e)
+    if not isinstance(row, dict):
+        raise InvalidRecord('a record must be a JSON object')
+    return row
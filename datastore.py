@@ -0,0 +1,560 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+from metrics import count_read, count_written, span
+
+# --- Cached JSON Store ---
+# Keeps parsed collections in memory and re-reads a file only when its
+# stat signature (inode, mtime, size) changes, so read-only routes don't pay
+# for a full json.load on every request.
+#
+# Writes go to a temp file in the same directory and are renamed over the
+# target, so readers never see a half-written file. Read-modify-write cycles
+# hold an exclusive flock on a sidecar '<file>.lock' for their whole duration,
+# which keeps them correct across gunicorn worker processes.
+#
+# Changes made through Transaction.insert/update/delete are recorded as
+# events and handed to subscribers after commit, so derived structures (see
+# indexes.py) can update incrementally instead of rebuilding. update_many and
+# delete_many batch many single-key changes into one event, applied in one
+# pass over the rows.
+#
+# Collections listed in log_files don't rewrite their file for those events:
+# they are appended as JSON lines to '<name>.jsonl', and readers replay the
+# snapshot plus the log. A write that pushes the log past compact_threshold
+# folds it back into the snapshot (see also `flask compact-logs`).
+
+
+def row_matches(row, match):
+    return all(row.get(k) == v for k, v in match.items())
+
+
+def apply_event(rows, event):
+    """Applies a change event to a list of rows in place."""
+    op = event['op']
+    if op == 'insert':
+        rows.append(event['row'])
+    elif op == 'update':
+        for row in rows:
+            if row_matches(row, event['match']):
+                row.update(event['fields'])
+    elif op == 'delete':
+        rows[:] = [row for row in rows if not row_matches(row, event['match'])]
+    elif op == 'update_many':
+        changes = event['changes']
+        for row in rows:
+            fields = changes.get(row.get(event['field']))
+            if fields is not None:
+                row.update(fields)
+    elif op == 'delete_many':
+        values = set(event['values'])
+        rows[:] = [row for row in rows if row.get(event['field']) not in values]
+    else:
+        raise ValueError('Unknown event op: %r' % op)
+
+
+def expand_event(event):
+    """Yields the single-row-match events a batched update_many/delete_many event stands for."""
+    op = event['op']
+    if op == 'update_many':
+        for value, fields in event['changes'].items():
+            yield {'op': 'update', 'match': {event['field']: value}, 'fields': fields}
+    elif op == 'delete_many':
+        for value in event['values']:
+            yield {'op': 'delete', 'match': {event['field']: value}}
+    else:
+        yield event
+
+
+class Transaction:
+    """Fresh copies of a set of locked collections, written back when the transaction commits.
+
+    Collections are loaded on first access, and only those touched are written back. Changes made
+    with insert/update/delete are also recorded as events for subscribers; a collection edited
+    directly through tx[filepath] is reported as rewritten.
+    """
+
+    def __init__(self, store, filepaths):
+        self._store = store
+        self._filepaths = filepaths
+        self._data = {}
+        self.events = {}
+        self.discarded = False
+
+    def __getitem__(self, filepath):
+        if filepath not in self._filepaths:
+            raise KeyError('%s is not part of this transaction' % filepath)
+        if filepath not in self._data:
+            self._data[filepath] = self._store.load(filepath)
+        return self._data[filepath]
+
+    def __setitem__(self, filepath, data):
+        if filepath not in self._filepaths:
+            raise KeyError('%s is not part of this transaction' % filepath)
+        self._data[filepath] = data
+
+    def insert(self, filepath, row):
+        self._record(filepath, {'op': 'insert', 'row': row})
+
+    def update(self, filepath, match, fields):
+        """Sets fields on every row whose values equal those in match."""
+        self._record(filepath, {'op': 'update', 'match': match, 'fields': fields})
+
+    def delete(self, filepath, match):
+        """Removes every row whose values equal those in match."""
+        self._record(filepath, {'op': 'delete', 'match': match})
+
+    def update_many(self, filepath, field, changes):
+        """Sets changes[value] on every row whose field equals value, in one pass; values must be strings."""
+        self._record(filepath, {'op': 'update_many', 'field': field, 'changes': changes})
+
+    def delete_many(self, filepath, field, values):
+        """Removes every row whose field is one of values, in one pass."""
+        self._record(filepath, {'op': 'delete_many', 'field': field, 'values': list(values)})
+
+    def discard(self):
+        """Leaves the files untouched when the transaction block exits."""
+        self.discarded = True
+
+    def _record(self, filepath, event):
+        # Stores that can commit events directly only need the rows if the block already loaded them
+        if filepath in self._data or not self._store.applies_events(filepath):
+            apply_event(self[filepath], event)
+        self.events.setdefault(filepath, []).append(event)
+
+
+class JsonBulkWriter:
+    """Streams rows into temp files next to a set of locked collections, renamed into place on commit."""
+
+    def __init__(self, store, filepaths):
+        self._store = store
+        self._filepaths = filepaths
+        self._files = {}  # filepath -> [tmp path, file object, rows written]
+
+    def begin(self, filepath, keep=True):
+        """Starts rewriting filepath, first copying its current rows unless keep is False."""
+        if filepath not in self._filepaths:
+            raise KeyError('%s is not part of this import' % filepath)
+        dirname = os.path.dirname(filepath) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filepath) + '.', suffix='.tmp')
+        self._files[filepath] = [tmp_path, os.fdopen(fd, 'w'), 0]
+        self._files[filepath][1].write('[')
+        if keep:
+            self.append(filepath, self._store.read(filepath))
+
+    def append(self, filepath, rows):
+        entry = self._files[filepath]
+        f = entry[1]
+        written = 0
+        with span('save_json'):
+            # Laid out exactly as json.dumps would lay out the whole list
+            for row in rows:
+                if filepath in self._store.compact_files:
+                    text = (',' if entry[2] else '') + json.dumps(row, separators=(',', ':'))
+                else:
+                    text = (',\n    ' if entry[2] else '\n    ') + json.dumps(row, indent=4).replace('\n', '\n    ')
+                f.write(text)
+                written += len(text)
+                entry[2] += 1
+        count_written(filepath, written)
+
+    def commit(self):
+        """Completes every file, then renames them into place and notifies subscribers."""
+        for filepath, (tmp_path, f, count) in self._files.items():
+            f.write(']' if filepath in self._store.compact_files or not count else '\n]')
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            try:
+                os.chmod(tmp_path, os.stat(filepath).st_mode & 0o777)
+            except FileNotFoundError:
+                os.chmod(tmp_path, 0o644)
+        for filepath, (tmp_path, f, count) in self._files.items():
+            old_version = self._store.version(filepath)
+            os.replace(tmp_path, filepath)
+            if filepath in self._store.log_files:
+                # The copied rows already include the log
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._store.log_path(filepath))
+            self._store.invalidate(filepath)
+            self._store._notify(filepath, None, old_version)
+        for dirname in {os.path.dirname(filepath) or '.' for filepath in self._files}:
+            _fsync_dir(dirname)
+
+    def abort(self):
+        for tmp_path, f, count in self._files.values():
+            f.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+
+
+class JsonStore:
+    def __init__(self, compact_files=(), log_files=(), compact_threshold=1 << 20, on_log_full=None):
+        self._cache = {}  # filepath -> (version, data)
+        self._lock = threading.Lock()
+        self._held = threading.local()
+        self._subscribers = []
+        self._log_bases = {}  # filepath -> (log inode, snapshot version the log applies to)
+        # Files written without indentation; used for large collections rewritten on hot paths
+        self.compact_files = set(compact_files)
+        # Collections whose transaction events are appended to an event log instead of rewriting the file
+        self.log_files = set(log_files)
+        # Log size in bytes past which a write folds the log back into the snapshot
+        self.compact_threshold = compact_threshold
+        # Called with the filepath instead of compacting inline, e.g. to hand compaction to a background job
+        self.on_log_full = on_log_full
+
+    def version(self, filepath):
+        """Returns a token that changes whenever the collection at filepath changes on disk."""
+        snapshot = _stat_version(filepath)
+        if filepath not in self.log_files:
+            return snapshot
+        try:
+            st = os.stat(self.log_path(filepath))
+        except FileNotFoundError:
+            return (snapshot, None)
+        return (snapshot, (st.st_ino, st.st_size))
+
+    def log_path(self, filepath):
+        """Returns the event log kept next to a log-backed collection, e.g. likes.json -> likes.jsonl."""
+        return os.path.splitext(filepath)[0] + '.jsonl'
+
+    def read(self, filepath):
+        """Returns the parsed collection at filepath from cache, reloading it only if the file changed.
+
+        For log-backed collections only the log tail written since the cached copy is replayed.
+        The returned list is shared between callers and must not be mutated; use load() for a private copy.
+        """
+        return self.read_versioned(filepath)[1]
+
+    def read_versioned(self, filepath):
+        """Returns (version, rows) like read(), with the version the rows are exactly as of."""
+        while True:
+            version = self.version(filepath)
+            entry = self._cache.get(filepath)
+            if entry is not None and version is not None and entry[0] == version:
+                return entry
+
+            if entry is not None and filepath in self.log_files:
+                tail = self.events_since(filepath, entry[0])
+                if tail is not None:
+                    events, version = tail
+                    data = replayed(entry[1], events)
+                    self._remember(filepath, data, version)
+                    return version, data
+
+            data = self.load(filepath)
+            # Re-stat after parsing; a write that raced the read means reading again
+            if self.version(filepath) == version:
+                self._remember(filepath, data, version)
+                return version, data
+
+    def load(self, filepath):
+        """Parses filepath from disk and returns a fresh, mutable copy of its contents."""
+        if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+            # Ensure file exists and contains an empty JSON array if it was empty/missing
+            with self.lock(filepath):
+                if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+                    self._write(filepath, [])
+        with open(filepath, 'r') as f, span('load_json'):
+            data = json.load(f)
+            # The version of the file actually read, in case it was replaced meanwhile
+            snapshot = _fd_version(f.fileno())
+        count_read(filepath, snapshot[2])
+        if filepath in self.log_files:
+            for event in self._log_events(filepath, snapshot, 0)[0]:
+                apply_event(data, event)
+        return data
+
+    def iter_rows(self, filepath):
+        """Yields the collection's rows in order. They are shared with read() and must not be mutated."""
+        # A JSON array can only be parsed whole, so this walks the cached copy
+        return iter(self.read(filepath))
+
+    @contextlib.contextmanager
+    def bulk_import(self, *filepaths):
+        """Locks filepaths and yields a JsonBulkWriter for streaming rows into them.
+
+        Every file is written out in full before any of them is renamed into place, and an exception
+        leaves all of them untouched.
+        """
+        with self.lock(*filepaths):
+            writer = JsonBulkWriter(self, filepaths)
+            try:
+                yield writer
+            except BaseException:
+                writer.abort()
+                raise
+            writer.commit()
+
+    def events_since(self, filepath, version):
+        """Returns (events, new_version) for changes made after version, or None if they aren't available.
+
+        Only log-backed collections can answer; anything else, or a snapshot rewrite in between, returns None.
+        """
+        if filepath not in self.log_files or version is None:
+            return None
+        current = self.version(filepath)
+        snapshot, log = version
+        if snapshot is None or current[0] != snapshot:
+            return None
+        if current[1] is None or current[1] == log:
+            return ([], current) if current[1] == log else None
+        if log is not None and (current[1][0] != log[0] or current[1][1] < log[1]):
+            return None
+        events, offset = self._log_events(filepath, snapshot, log[1] if log else 0, current[1][1])
+        if offset is None:
+            return None
+        return events, (snapshot, (current[1][0], offset))
+
+    def compact(self, filepath):
+        """Folds the event log of filepath into its snapshot file."""
+        with self.lock(filepath):
+            old_version = self.version(filepath)
+            data = self.load(filepath)
+            self._write(filepath, data)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.log_path(filepath))
+            self._remember(filepath, data)
+            # The rows didn't change, so subscribers only need to adopt the new version
+            self._notify(filepath, [], old_version)
+
+    def save(self, filepath, data):
+        """Atomically replaces the contents of filepath with data."""
+        with self.lock(filepath):
+            old_version = self.version(filepath)
+            self._write(filepath, data)
+            if filepath in self.log_files:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self.log_path(filepath))
+            self.invalidate(filepath)
+            self._notify(filepath, None, old_version)
+
+    def invalidate(self, filepath=None):
+        with self._lock:
+            if filepath is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(filepath, None)
+
+    def applies_events(self, filepath):
+        """Whether a transaction can commit events for filepath without loading its rows first."""
+        return filepath in self.log_files
+
+    def subscribe(self, callback):
+        """Registers callback(filepath, events, old_version, new_version), called after each write.
+
+        events is the list of change events, or None when the whole collection was rewritten. Callbacks
+        run while the collection is still locked, so new_version is exactly the committed state.
+        """
+        self._subscribers.append(callback)
+
+    @contextlib.contextmanager
+    def lock(self, *filepaths):
+        """Holds an exclusive cross-process lock on each of filepaths, acquired in a fixed order."""
+        held = self._held.__dict__.setdefault('paths', set())
+        handles = []
+        try:
+            for filepath in sorted(set(filepaths) - held):
+                handle = open(filepath + '.lock', 'a')
+                handles.append((filepath, handle))
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                held.add(filepath)
+            yield
+        finally:
+            for filepath, handle in reversed(handles):
+                held.discard(filepath)
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+    @contextlib.contextmanager
+    def transaction(self, *filepaths):
+        """Locks filepaths and yields a Transaction holding fresh copies of their contents.
+
+        Every collection the block touched is written back atomically when it exits normally, unless
+        discard() was called; an exception leaves all of them untouched. Events on a log-backed
+        collection the block didn't load are appended to its log instead. The committed data is
+        adopted as the cached copy, so callers must not mutate it after the block.
+        """
+        with self.lock(*filepaths):
+            tx = Transaction(self, filepaths)
+            yield tx
+            if tx.discarded:
+                return
+            for filepath in filepaths:
+                events = tx.events.get(filepath)
+                if filepath in tx._data:
+                    old_version = self.version(filepath)
+                    self._write(filepath, tx[filepath])
+                    if filepath in self.log_files:
+                        # The rows already include the log, which is now superseded by the new snapshot
+                        with contextlib.suppress(FileNotFoundError):
+                            os.unlink(self.log_path(filepath))
+                    self._remember(filepath, tx[filepath])
+                    self._notify(filepath, events, old_version)
+                elif events:
+                    old_version = self.version(filepath)
+                    size = self._append_events(filepath, events)
+                    self._notify(filepath, events, old_version)
+                    if size > self.compact_threshold:
+                        if self.on_log_full is not None:
+                            self.on_log_full(filepath)
+                        else:
+                            self.compact(filepath)
+
+    def _append_events(self, filepath, events):
+        """Appends events to the log of filepath as JSON lines. Returns the new log size."""
+        log_path = self.log_path(filepath)
+        snapshot = _stat_version(filepath)
+        if snapshot is None:
+            self._write(filepath, [])
+            snapshot = _stat_version(filepath)
+        if not self._log_is_current(filepath, snapshot):
+            # Start a log for the current snapshot; a log left over from an earlier one is already folded in
+            self._write_raw(log_path, _log_header(snapshot))
+        payload = ''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events).encode('utf-8')
+        with span('append_json_log'):
+            fd = os.open(log_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, payload)
+                os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        count_written(log_path, len(payload))
+        return size
+
+    def _log_is_current(self, filepath, snapshot):
+        """Whether the log of filepath exists and was started on top of the given snapshot version."""
+        try:
+            ino = os.stat(self.log_path(filepath)).st_ino
+        except FileNotFoundError:
+            return False
+        if self._log_bases.get(filepath) == (ino, snapshot):
+            return True
+        with open(self.log_path(filepath), 'rb') as f:
+            header = f.readline()
+        try:
+            current = json.loads(header).get('snapshot') == list(snapshot)
+        except (ValueError, AttributeError):
+            current = False
+        if current:
+            self._log_bases[filepath] = (ino, snapshot)
+        return current
+
+    def _log_events(self, filepath, snapshot, start, end=None):
+        """Returns (events, offset) for complete log lines between byte offsets start and end.
+
+        A log that doesn't apply to snapshot yields no events, and a range ending mid-line yields
+        ([], None).
+        """
+        try:
+            f = open(self.log_path(filepath), 'rb')
+        except FileNotFoundError:
+            return [], 0
+        with f:
+            if not self._log_is_current(filepath, snapshot):
+                return [], os.fstat(f.fileno()).st_size if end is None else end
+            f.seek(start)
+            chunk = f.read() if end is None else f.read(end - start)
+        count_read(self.log_path(filepath), len(chunk))
+        if end is not None and chunk and not chunk.endswith(b'\n'):
+            return [], None
+        end = start + chunk.rfind(b'\n') + 1
+        lines = chunk[:end - start].splitlines()
+        if start == 0:
+            lines = lines[1:]  # header
+        return [json.loads(line) for line in lines if line.strip()], end
+
+    def _notify(self, filepath, events, old_version):
+        new_version = self.version(filepath)
+        for callback in self._subscribers:
+            callback(filepath, events, old_version, new_version)
+
+    def _remember(self, filepath, data, version=None):
+        if version is None:
+            version = self.version(filepath)
+        with self._lock:
+            self._cache[filepath] = (version, data)
+
+    def _write(self, filepath, data):
+        """Writes data to a temp file next to filepath, fsyncs it and renames it into place."""
+        indent = None if filepath in self.compact_files else 4
+        separators = (',', ':') if indent is None else None
+        with span('save_json'):
+            self._write_raw(filepath, json.dumps(data, indent=indent, separators=separators))
+
+    def _write_raw(self, filepath, text):
+        dirname = os.path.dirname(filepath) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filepath) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp_path, os.stat(filepath).st_mode & 0o777)
+            except FileNotFoundError:
+                os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filepath)
+            # json.dumps escapes non-ASCII by default, so characters are bytes
+            count_written(filepath, len(text))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
+        _fsync_dir(dirname)
+
+
+def replayed(rows, events):
+    """Returns a new list with events applied to rows, leaving rows and their dicts untouched."""
+    rows = list(rows)
+    for event in events:
+        op = event['op']
+        if op == 'insert':
+            rows.append(event['row'])
+        elif op == 'update':
+            rows = [dict(row, **event['fields']) if row_matches(row, event['match']) else row for row in rows]
+        elif op == 'delete':
+            rows = [row for row in rows if not row_matches(row, event['match'])]
+        elif op == 'update_many':
+            changes, field = event['changes'], event['field']
+            rows = [dict(row, **changes[row.get(field)]) if row.get(field) in changes else row for row in rows]
+        elif op == 'delete_many':
+            values = set(event['values'])
+            rows = [row for row in rows if row.get(event['field']) not in values]
+        else:
+            raise ValueError('Unknown event op: %r' % op)
+    return rows
+
+
+def _stat_version(filepath):
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _fd_version(fd):
+    st = os.fstat(fd)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _log_header(snapshot):
+    # Ties the log to the snapshot it applies on top of. Once the snapshot is rewritten the header
+    # no longer matches, so a log that a crash left behind is never replayed twice.
+    return json.dumps({'snapshot': list(snapshot)}) + '\n'
+
+
+def _fsync_dir(dirname):
+    """Makes a rename inside dirname durable."""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
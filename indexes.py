@@ -0,0 +1,843 @@
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+
+from datastore import expand_event, row_matches
+
+# --- Derived Indexes ---
+# In-memory structures built from store collections. An index checks the
+# version of its source collections on every query. Writes made through this
+# process's store arrive as change events and are applied incrementally; a
+# change made behind its back (e.g. by another worker) is caught up from the
+# collection's event log when the store keeps one, and otherwise rebuilds
+# the part of the index that comes from that collection (the whole index if
+# its parts can't be told apart). The common case never rescans a collection.
+#
+# Rebuilds and applied events run under the index's lock, and queries read
+# under it too, so a request thread never sees an index half rebuilt.
+
+
+class DerivedIndex:
+    def __init__(self, store, *sources):
+        self.store = store
+        self.sources = sources
+        self._versions = {}
+        self._lock = threading.RLock()
+        store.subscribe(self._on_commit)
+
+    def rebuild(self, collections):
+        """Rebuilds the index from scratch; collections maps each source path to its rows."""
+        raise NotImplementedError
+
+    def apply(self, filepath, event):
+        """Applies one change event. Returns False if the event can't be applied incrementally.
+
+        Batched update_many/delete_many events arrive expanded into single-key update/delete events.
+        """
+        return False
+
+    def refresh(self, filepath, rows):
+        """Rebuilds only what the index derives from filepath. Returns False if that takes a full rebuild.
+
+        Called when filepath changed in a way its events don't cover, possibly after some of them were applied.
+        """
+        return False
+
+    def _apply_all(self, filepath, events):
+        return all(self.apply(filepath, e) for event in events for e in expand_event(event))
+
+    def _ensure(self):
+        """Brings the index up to date with its sources; call at the start of every query."""
+        versions = {filepath: self.store.version(filepath) for filepath in self.sources}
+        if versions == self._versions:
+            return
+        with self._lock:
+            if self._catch_up():
+                return
+            # Each source is recorded at the version of the rows actually read; a commit landing
+            # meanwhile is then either in the rows or still to come, never both
+            collections = {}
+            versions = {}
+            for filepath in self.sources:
+                versions[filepath], collections[filepath] = self.store.read_versioned(filepath)
+            self.rebuild(collections)
+            self._versions = versions
+
+    def _catch_up(self):
+        """Brings each stale source up to date on its own. Returns False if the index needs a full rebuild."""
+        if not self._versions:
+            # Never built, or every source went stale
+            return False
+        for filepath in self.sources:
+            if self.store.version(filepath) == self._versions.get(filepath):
+                continue
+            tail = self.store.events_since(filepath, self._versions.get(filepath))
+            if tail is not None and self._apply_all(filepath, tail[0]):
+                self._versions[filepath] = tail[1]
+                continue
+            version, rows = self.store.read_versioned(filepath)
+            if not self.refresh(filepath, rows):
+                return False
+            self._versions[filepath] = version
+        return True
+
+    def _on_commit(self, filepath, events, old_version, new_version):
+        if filepath not in self.sources:
+            return
+        with self._lock:
+            if self._versions.get(filepath) == new_version:
+                # Already read from the store by a rebuild or refresh that ran while this commit waited
+                return
+            in_sync = self._versions.get(filepath) == old_version
+            if in_sync and events is not None and self._apply_all(filepath, events):
+                self._versions[filepath] = new_version
+            else:
+                # Refreshed or rebuilt on the next query
+                self._versions.pop(filepath, None)
+
+
+class EngagementIndex(DerivedIndex):
+    """(user, video) membership sets, with per-user and per-video lists, for likes, enrollments and suggestions."""
+
+    def __init__(self, store, likes_file, enrollments_file, suggestions_file):
+        self.likes_file = likes_file
+        self.enrollments_file = enrollments_file
+        self.suggestions_file = suggestions_file
+        super().__init__(store, likes_file, enrollments_file, suggestions_file)
+
+    def rebuild(self, collections):
+        for filepath in self.sources:
+            self.refresh(filepath, collections[filepath])
+
+    def refresh(self, filepath, rows):
+        if filepath == self.likes_file:
+            self._likes = set()
+            self._liked_by_user = {}
+            self._likers_by_video = {}
+            for like in rows:
+                self._add(self._likes, self._liked_by_user, self._likers_by_video, like)
+        elif filepath == self.enrollments_file:
+            self._enrollments = set()
+            self._enrolled_by_user = {}
+            self._enrollees_by_video = {}
+            for enrollment in rows:
+                self._add(self._enrollments, self._enrolled_by_user, self._enrollees_by_video, enrollment)
+        else:
+            self._suggestions = {}
+            self._suggestion_keys = {}
+            self._suggested_by_user = {}
+            self._suggesters_by_video = {}
+            for suggestion in rows:
+                self._set_suggestion(suggestion)
+        return True
+
+    def apply(self, filepath, event):
+        op = event['op']
+        if filepath == self.suggestions_file:
+            if op == 'insert':
+                self._set_suggestion(event['row'])
+                return True
+            key = self._suggestion_keys.get(event['match'].get('id'))
+            if op == 'update' and key and set(event['fields']).isdisjoint(('id', 'user_id', 'video_id')):
+                self._set_suggestion(dict(self._suggestions[key], **event['fields']))
+                return True
+            if op == 'delete' and set(event['match']) == {'id'}:
+                if key:
+                    self._remove_suggestion(*key)
+                return True
+            pairs = self._matching_pairs(self._suggestions, self._suggested_by_user, self._suggesters_by_video,
+                                         event['match']) if op == 'delete' else None
+            if pairs is None:
+                return False
+            for user_id, video_id in pairs:
+                self._remove_suggestion(user_id, video_id)
+            return True
+
+        if filepath == self.likes_file:
+            pairs, by_user, by_video = self._likes, self._liked_by_user, self._likers_by_video
+        else:
+            pairs, by_user, by_video = self._enrollments, self._enrolled_by_user, self._enrollees_by_video
+        if op == 'insert':
+            self._add(pairs, by_user, by_video, event['row'])
+            return True
+        matched = self._matching_pairs(pairs, by_user, by_video, event['match']) if op == 'delete' else None
+        if matched is None:
+            return False
+        for user_id, video_id in matched:
+            self._remove(pairs, by_user, by_video, user_id, video_id)
+        return True
+
+    # Likes
+
+    def has_liked(self, user_id, video_id):
+        self._ensure()
+        with self._lock:
+            return (user_id, video_id) in self._likes
+
+    def like_count(self, video_id):
+        self._ensure()
+        with self._lock:
+            return len(self._likers_by_video.get(video_id, ()))
+
+    def liked_videos(self, user_id):
+        """Returns the ids of videos liked by user_id, oldest like first."""
+        self._ensure()
+        with self._lock:
+            return list(self._liked_by_user.get(user_id, ()))
+
+    def liked_page(self, user_id, offset=0, limit=20):
+        """Returns (video ids, total) for a page of the videos user_id liked, most recent like first."""
+        return self._page('_liked_by_user', user_id, offset, limit)
+
+    # Enrollments
+
+    def is_enrolled(self, user_id, video_id):
+        self._ensure()
+        with self._lock:
+            return (user_id, video_id) in self._enrollments
+
+    def enrollment_count(self, video_id):
+        self._ensure()
+        with self._lock:
+            return len(self._enrollees_by_video.get(video_id, ()))
+
+    def enrolled_videos(self, user_id):
+        """Returns the ids of videos user_id is enrolled in, oldest enrollment first."""
+        self._ensure()
+        with self._lock:
+            return list(self._enrolled_by_user.get(user_id, ()))
+
+    def enrolled_page(self, user_id, offset=0, limit=20):
+        """Returns (video ids, total) for a page of the videos user_id is enrolled in, most recent first."""
+        return self._page('_enrolled_by_user', user_id, offset, limit)
+
+    # Suggestions
+
+    def suggestion(self, user_id, video_id):
+        """Returns the suggestion row user_id left on video_id, or None."""
+        self._ensure()
+        with self._lock:
+            return self._suggestions.get((user_id, video_id))
+
+    def suggested_videos(self, user_id):
+        """Returns the ids of videos user_id left a suggestion on."""
+        self._ensure()
+        with self._lock:
+            return list(self._suggested_by_user.get(user_id, ()))
+
+    def suggestion_count(self, video_id):
+        self._ensure()
+        with self._lock:
+            return len(self._suggesters_by_video.get(video_id, ()))
+
+    def _page(self, attr, user_id, offset, limit):
+        self._ensure()
+        with self._lock:
+            # Looked up by name, after _ensure() may have rebuilt the index
+            videos = getattr(self, attr).get(user_id, {})
+            return list(itertools.islice(reversed(videos), offset, offset + limit)), len(videos)
+
+    @staticmethod
+    def _add(pairs, by_user, by_video, row):
+        key = (row['user_id'], row['video_id'])
+        if key in pairs:
+            return
+        pairs.add(key)
+        # dicts double as insertion-ordered sets
+        by_user.setdefault(row['user_id'], {})[row['video_id']] = None
+        by_video.setdefault(row['video_id'], {})[row['user_id']] = None
+
+    @staticmethod
+    def _remove(pairs, by_user, by_video, user_id, video_id):
+        if (user_id, video_id) not in pairs:
+            return
+        pairs.discard((user_id, video_id))
+        _discard(by_user, user_id, video_id)
+        _discard(by_video, video_id, user_id)
+
+    @staticmethod
+    def _matching_pairs(pairs, by_user, by_video, match):
+        """Returns the (user, video) pairs a delete matching on user_id and/or video_id removes, or None."""
+        if set(match) == {'user_id', 'video_id'}:
+            key = (match['user_id'], match['video_id'])
+            return [key] if key in pairs else []
+        if set(match) == {'user_id'}:
+            return [(match['user_id'], video_id) for video_id in by_user.get(match['user_id'], ())]
+        if set(match) == {'video_id'}:
+            return [(user_id, match['video_id']) for user_id in by_video.get(match['video_id'], ())]
+        return None
+
+    def _set_suggestion(self, suggestion):
+        key = (suggestion['user_id'], suggestion['video_id'])
+        self._suggestions[key] = suggestion
+        self._suggested_by_user.setdefault(key[0], {})[key[1]] = None
+        self._suggesters_by_video.setdefault(key[1], {})[key[0]] = None
+        if 'id' in suggestion:
+            self._suggestion_keys[suggestion['id']] = key
+
+    def _remove_suggestion(self, user_id, video_id):
+        suggestion = self._suggestions.pop((user_id, video_id))
+        self._suggestion_keys.pop(suggestion.get('id'), None)
+        _discard(self._suggested_by_user, user_id, video_id)
+        _discard(self._suggesters_by_video, video_id, user_id)
+
+
+def _discard(groups, key, member):
+    """Removes member from the insertion-ordered set groups[key], dropping the set once it's empty."""
+    members = groups.get(key)
+    if members is not None:
+        members.pop(member, None)
+        if not members:
+            del groups[key]
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class CatalogIndex(DerivedIndex):
+    """The catalog kept in every library sort order, overall and per category, for keyset pagination.
+
+    Each ordering is a sorted list of (sort key, video id) so that a page is located with one
+    bisect. Ties keep catalog order, as the sorted() calls they replace did.
+    """
+
+    # sort_by -> row field, all ordered descending
+    SORT_FIELDS = {'recently_uploaded': 'uploaded_at', 'most_liked': 'likes_count', 'most_viewed': 'views'}
+
+    def __init__(self, store, videos_file):
+        self.videos_file = videos_file
+        super().__init__(store, videos_file)
+
+    def rebuild(self, collections):
+        self._rows = {}  # id -> row
+        self._keys = {}  # id -> {sort_by: key}
+        self._orders = {}  # (category, sort_by) -> sorted [(key, id)]; category None is the whole catalog
+        self._categories = {}  # category -> videos
+        self._seq = 0
+        for video in collections[self.videos_file]:
+            self._add(dict(video), bulk=True)
+        for order in self._orders.values():
+            order.sort()
+
+    def apply(self, filepath, event):
+        op = event['op']
+        if op == 'insert':
+            self._add(dict(event['row']))
+            return True
+        if set(event['match']) != {'id'}:
+            return False
+        video_id = event['match']['id']
+        if video_id not in self._rows:
+            return True
+        if op == 'update':
+            row = self._rows[video_id]
+            seq = self._remove(video_id)
+            row.update(event['fields'])
+            self._add(row, seq=seq)
+        else:
+            self._remove(video_id)
+        return True
+
+    def categories(self):
+        self._ensure()
+        with self._lock:
+            return sorted(self._categories)
+
+    def get(self, video_id):
+        """Returns the video row for video_id, or None. The row must not be mutated."""
+        self._ensure()
+        with self._lock:
+            return self._rows.get(video_id)
+
+    def page(self, category=None, sort_by='recently_uploaded', after=None, limit=24, pending=None):
+        """Returns (videos, next_cursor) for the page following the video id `after`.
+
+        next_cursor is the id to pass as `after` for the next page, or None on the last page.
+        An unknown `after` starts from the first page. The rows must not be mutated.
+        pending {video_id: views} not yet in the rows counts towards the most_viewed order.
+        """
+        self._ensure()
+        if sort_by not in self.SORT_FIELDS:
+            sort_by = 'recently_uploaded'
+        with self._lock:
+            order = self._orders.get((category, sort_by), [])
+            if sort_by == 'most_viewed' and pending:
+                ids = self._page_with_pending(order, category, after, limit, pending)
+            else:
+                start = 0
+                if after in self._keys:
+                    start = bisect.bisect_right(order, (self._keys[after][sort_by], after))
+                ids = [video_id for _, video_id in order[start:start + limit + 1]]
+            next_cursor = ids[limit - 1] if len(ids) > limit else None
+            return [self._rows[video_id] for video_id in ids[:limit]], next_cursor
+
+    def _page_with_pending(self, order, category, after, limit, pending):
+        """Returns up to limit + 1 ids following `after` in the most viewed order, counting pending views.
+
+        Pending views only move a video ahead, so the videos without any keep their place in the stored
+        order, and the few with some are ranked separately and merged in.
+        """
+        def key(video_id):
+            views, seq = self._keys[video_id]['most_viewed']
+            return (views - pending.get(video_id, 0), seq), video_id
+
+        bound = key(after) if after in self._keys else None
+        viewed = sorted(key(video_id) for video_id in pending if video_id in self._rows
+                        and category in self._scopes(self._rows[video_id]))
+        if bound is not None:
+            viewed = viewed[bisect.bisect_right(viewed, bound):]
+        rest = []
+        i = 0 if bound is None else bisect.bisect_right(order, bound)
+        while len(rest) <= limit and i < len(order):
+            if order[i][1] not in pending:
+                rest.append(order[i])
+            i += 1
+        return [video_id for _, video_id in heapq.merge(viewed, rest)][:limit + 1]
+
+    def _add(self, row, bulk=False, seq=None):
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        video_id = row['id']
+        keys = {sort_by: (-self._sort_value(row, field), seq) for sort_by, field in self.SORT_FIELDS.items()}
+        self._rows[video_id] = row
+        self._keys[video_id] = keys
+        category = row.get('category', 'Uncategorized')
+        self._categories[category] = self._categories.get(category, 0) + 1
+        for scope in self._scopes(row):
+            for sort_by, key in keys.items():
+                order = self._orders.setdefault((scope, sort_by), [])
+                # rebuild() sorts once at the end instead of inserting in order
+                if bulk:
+                    order.append((key, video_id))
+                else:
+                    bisect.insort(order, (key, video_id))
+
+    def _remove(self, video_id):
+        """Drops video_id from every ordering and returns its tie-breaking sequence number."""
+        row = self._rows.pop(video_id)
+        keys = self._keys.pop(video_id)
+        category = row.get('category', 'Uncategorized')
+        self._categories[category] -= 1
+        if not self._categories[category]:
+            del self._categories[category]
+        for scope in self._scopes(row):
+            for sort_by, key in keys.items():
+                order = self._orders[(scope, sort_by)]
+                del order[bisect.bisect_left(order, (key, video_id))]
+        return keys['recently_uploaded'][1]
+
+    @staticmethod
+    def _scopes(row):
+        # Videos without a category only appear in the unfiltered orderings
+        return (None,) if row.get('category') is None else (None, row['category'])
+
+    @staticmethod
+    def _sort_value(row, field):
+        if field == 'uploaded_at':
+            return (parse_timestamp(row.get('uploaded_at', '1970-01-01T00:00:00')) - EPOCH).total_seconds()
+        return row.get(field, 0)
+
+
+class TrendingIndex(DerivedIndex):
+    """Videos ranked by recent likes, enrollments and views, each counting half as much after every half_life.
+
+    Scores use forward decay: an event at time t adds weight * 2 ** ((t - landmark) / half_life) to its
+    video once, and is never decayed afterwards, because scaling every score by the same factor as time
+    passes leaves their order as it is. An event therefore moves only its own video, found with one
+    bisect in each sorted order it appears in. Views aren't kept in a collection; record_view() adds
+    them as the view log is read, and their totals survive rebuilds.
+
+    A score is kept as the sum of its views, likes and enrollments parts, so a change to one collection
+    that can't be caught up from events redoes only that part. Counter updates to videos (views,
+    likes_count) don't move the ranking and are ignored.
+    """
+
+    # Events further back than this many half-lives add under 0.1% of a new one and are skipped on rebuild
+    HORIZON = 10
+    # Past this many half-lives from the landmark the scores are rescaled, long before floats overflow
+    REBASE_AFTER = 512
+
+    def __init__(self, store, videos_file, likes_file, enrollments_file, half_life=86400, weights=None):
+        self.videos_file = videos_file
+        self.likes_file = likes_file
+        self.enrollments_file = enrollments_file
+        self.half_life = half_life
+        self.weights = weights or {'like': 3, 'enrollment': 5, 'view': 1}
+        self._landmark = (datetime.now() - EPOCH).total_seconds()
+        self._view_scores = {}  # video id -> decayed views
+        super().__init__(store, videos_file, likes_file, enrollments_file)
+
+    def rebuild(self, collections):
+        self._like_scores = {}  # video id -> decayed likes
+        self._like_credits = {}  # (user, video) -> what the like added, to take back on unlike
+        self._enrollment_scores = {}  # video id -> decayed enrollments
+        self._load_videos(collections[self.videos_file])
+        self._load_likes(collections[self.likes_file])
+        self._load_enrollments(collections[self.enrollments_file])
+        self._sum_scores()
+
+    def refresh(self, filepath, rows):
+        if filepath == self.videos_file:
+            self._load_videos(rows)
+        elif filepath == self.likes_file:
+            self._load_likes(rows)
+        else:
+            self._load_enrollments(rows)
+        self._sum_scores()
+        return True
+
+    def _load_videos(self, videos):
+        self._tiebreaks = {}  # video id -> -upload time, so newer videos lead among equal scores
+        self._scopes = {}  # video id -> orders it appears in
+        for video in videos:
+            self._tiebreaks[video['id']] = -CatalogIndex._sort_value(video, 'uploaded_at')
+            self._scopes[video['id']] = CatalogIndex._scopes(video)
+        # Scores of videos that are gone go with them; the rows are read as of their current version, so
+        # a video missing from them was deleted rather than not seen yet
+        for part in (self._view_scores, self._like_scores, self._enrollment_scores):
+            for video_id in part.keys() - self._tiebreaks.keys():
+                del part[video_id]
+        self._like_credits = {key: credit for key, credit in self._like_credits.items() if key[1] in self._tiebreaks}
+
+    def _load_likes(self, likes):
+        self._like_scores = {}
+        self._like_credits = {}
+        cutoff = self._landmark - self.HORIZON * self.half_life
+        for like in likes:
+            credit = self._credit('like', like.get('timestamp'), cutoff)
+            if credit:
+                self._like_scores[like['video_id']] = self._like_scores.get(like['video_id'], 0.0) + credit
+                self._like_credits[like['user_id'], like['video_id']] = credit
+
+    def _load_enrollments(self, enrollments):
+        self._enrollment_scores = {}
+        cutoff = self._landmark - self.HORIZON * self.half_life
+        for enrollment in enrollments:
+            credit = self._credit('enrollment', enrollment.get('timestamp'), cutoff)
+            if credit:
+                video_id = enrollment['video_id']
+                self._enrollment_scores[video_id] = self._enrollment_scores.get(video_id, 0.0) + credit
+
+    def apply(self, filepath, event):
+        op = event['op']
+        if filepath == self.videos_file:
+            if op == 'insert':
+                self._add_video(event['row'])
+                return True
+            if set(event['match']) != {'id'}:
+                return False
+            video_id = event['match']['id']
+            if video_id not in self._scores:
+                return True
+            if op == 'delete':
+                self._remove_video(video_id)
+            elif {'category', 'uploaded_at'} & set(event['fields']):
+                fields = event['fields']
+                self._unlink(video_id)
+                if 'category' in fields:
+                    self._scopes[video_id] = CatalogIndex._scopes(fields)
+                if 'uploaded_at' in fields:
+                    self._tiebreaks[video_id] = -CatalogIndex._sort_value(fields, 'uploaded_at')
+                self._link(video_id)
+            return True
+        if op == 'insert':
+            row = event['row']
+            kind = 'like' if filepath == self.likes_file else 'enrollment'
+            credit = self._credit(kind, row.get('timestamp'))
+            if credit:
+                part = self._like_scores if kind == 'like' else self._enrollment_scores
+                self._add_credit(row['video_id'], credit, part)
+                if kind == 'like':
+                    self._like_credits[row['user_id'], row['video_id']] = credit
+            return True
+        match = event['match']
+        if set(match) == {'video_id'}:
+            # Only when the video itself goes, which removes it from the ranking
+            return True
+        if filepath == self.likes_file and set(match) == {'user_id', 'video_id'}:
+            credit = self._like_credits.pop((match['user_id'], match['video_id']), None)
+            if credit:
+                self._add_credit(match['video_id'], -credit, self._like_scores)
+            return True
+        return False
+
+    def record_view(self, video_id, timestamp):
+        """Adds a view at timestamp (ISO 8601) to video_id's score."""
+        with self._lock:
+            credit = self._credit('view', timestamp)
+            if credit:
+                self._add_credit(video_id, credit, self._view_scores)
+
+    def page(self, category=None, after=None, limit=24):
+        """Returns (video ids, next_cursor) for the page of trending videos following the video id `after`."""
+        self._ensure()
+        with self._lock:
+            order = self._orders.get(category, [])
+            start = 0
+            if after in self._scores and category in self._scopes[after]:
+                start = bisect.bisect_right(order, self._key(after))
+            ids = [video_id for _, _, video_id in order[start:start + limit + 1]]
+            next_cursor = ids[limit - 1] if len(ids) > limit else None
+            return ids[:limit], next_cursor
+
+    def _credit(self, kind, timestamp, cutoff=None):
+        if not timestamp:
+            return 0.0
+        try:
+            seconds = (parse_timestamp(timestamp) - EPOCH).total_seconds()
+        except (TypeError, ValueError):
+            return 0.0
+        if cutoff is not None and seconds < cutoff:
+            return 0.0
+        if (seconds - self._landmark) / self.half_life > self.REBASE_AFTER:
+            self._rebase(seconds)
+        return self.weights[kind] * 2 ** ((seconds - self._landmark) / self.half_life)
+
+    def _rebase(self, seconds):
+        """Moves the landmark up to seconds, rescaling every score to match."""
+        factor = 2 ** (-(seconds - self._landmark) / self.half_life)
+        self._landmark = seconds
+        self._view_scores = {video_id: score * factor for video_id, score in self._view_scores.items()}
+        if hasattr(self, '_tiebreaks'):
+            self._like_scores = {video_id: score * factor for video_id, score in self._like_scores.items()}
+            self._like_credits = {key: credit * factor for key, credit in self._like_credits.items()}
+            self._enrollment_scores = {video_id: score * factor
+                                       for video_id, score in self._enrollment_scores.items()}
+            self._sum_scores()
+
+    def _sum_scores(self):
+        self._scores = {video_id: self._total(video_id) for video_id in self._tiebreaks}
+        self._sort_all()
+
+    def _total(self, video_id):
+        return (self._view_scores.get(video_id, 0.0) + self._like_scores.get(video_id, 0.0) +
+                self._enrollment_scores.get(video_id, 0.0))
+
+    def _key(self, video_id):
+        return (-self._scores[video_id], self._tiebreaks[video_id], video_id)
+
+    def _sort_all(self):
+        self._orders = {}
+        for video_id in self._scores:
+            key = self._key(video_id)
+            for scope in self._scopes[video_id]:
+                self._orders.setdefault(scope, []).append(key)
+        for order in self._orders.values():
+            order.sort()
+
+    def _add_credit(self, video_id, amount, part):
+        """Adds amount to the part of video_id's score (views, likes or enrollments) it comes from.
+
+        A video this index doesn't know yet, e.g. one another worker just added, keeps the credit in
+        its part until its insert is caught up; before the first build, rebuild() picks up the views.
+        """
+        part[video_id] = part.get(video_id, 0.0) + amount
+        if video_id in getattr(self, '_scores', ()):
+            self._unlink(video_id)
+            self._scores[video_id] += amount
+            self._link(video_id)
+
+    def _add_video(self, row):
+        video_id = row['id']
+        self._scores[video_id] = self._total(video_id)
+        self._tiebreaks[video_id] = -CatalogIndex._sort_value(row, 'uploaded_at')
+        self._scopes[video_id] = CatalogIndex._scopes(row)
+        self._link(video_id)
+
+    def _remove_video(self, video_id):
+        self._unlink(video_id)
+        del self._scores[video_id], self._tiebreaks[video_id], self._scopes[video_id]
+        for part in (self._view_scores, self._like_scores, self._enrollment_scores):
+            part.pop(video_id, None)
+
+    def _link(self, video_id):
+        key = self._key(video_id)
+        for scope in self._scopes[video_id]:
+            bisect.insort(self._orders.setdefault(scope, []), key)
+
+    def _unlink(self, video_id):
+        key = self._key(video_id)
+        for scope in self._scopes[video_id]:
+            order = self._orders[scope]
+            del order[bisect.bisect_left(order, key)]
+
+
+class AdIndex(DerivedIndex):
+    """Active ads and who dismissed them, with each user's visible ads worked out once.
+
+    Users are interned to small integers and each ad keeps the set of numbers that dismissed it.
+    Dismissals legacy-stored in an ad's 'dismissed_by_users' list are honoured as well.
+    """
+
+    def __init__(self, store, ads_file, dismissals_file):
+        self.ads_file = ads_file
+        self.dismissals_file = dismissals_file
+        super().__init__(store, ads_file, dismissals_file)
+
+    def rebuild(self, collections):
+        self._user_numbers = {}
+        self._active = {}  # user number -> visible ads
+        self._ads = [ad for ad in collections[self.ads_file] if ad.get('is_active')]
+        self._dismissed = {ad['id']: set() for ad in collections[self.ads_file]}
+        for ad in collections[self.ads_file]:
+            for user_id in ad.get('dismissed_by_users', ()):
+                self._dismissed[ad['id']].add(self._number(user_id))
+        for dismissal in collections[self.dismissals_file]:
+            self._dismiss(dismissal['user_id'], dismissal['ad_id'])
+
+    def apply(self, filepath, event):
+        # Ads themselves change rarely, through the admin pages; those rebuild
+        if filepath != self.dismissals_file:
+            return False
+        if event['op'] == 'insert':
+            self._dismiss(event['row']['user_id'], event['row']['ad_id'])
+            return True
+        if event['op'] == 'delete' and set(event['match']) == {'ad_id'}:
+            self._dismissed.pop(event['match']['ad_id'], None)
+            self._active.clear()
+            return True
+        if event['op'] == 'delete' and set(event['match']) == {'user_id'}:
+            number = self._user_numbers.get(event['match']['user_id'])
+            if number is not None:
+                for numbers in self._dismissed.values():
+                    numbers.discard(number)
+                self._active.pop(number, None)
+            return True
+        return False
+
+    def active_ads(self, user_id=None):
+        """Returns the active ads user_id hasn't dismissed (all active ads for anonymous visitors)."""
+        self._ensure()
+        with self._lock:
+            if user_id is None:
+                return self._ads
+            number = self._number(user_id)
+            if number not in self._active:
+                self._active[number] = [ad for ad in self._ads if number not in self._dismissed[ad['id']]]
+            return self._active[number]
+
+    def has_dismissed(self, user_id, ad_id):
+        self._ensure()
+        with self._lock:
+            return self._number(user_id) in self._dismissed.get(ad_id, ())
+
+    def exists(self, ad_id):
+        self._ensure()
+        with self._lock:
+            return ad_id in self._dismissed
+
+    def has_dismissals(self, user_id):
+        """Whether user_id dismissed any ad."""
+        self._ensure()
+        with self._lock:
+            number = self._user_numbers.get(user_id)
+            return number is not None and any(number in numbers for numbers in self._dismissed.values())
+
+    def _number(self, user_id):
+        return self._user_numbers.setdefault(user_id, len(self._user_numbers))
+
+    def _dismiss(self, user_id, ad_id):
+        number = self._number(user_id)
+        # Dismissals of deleted ads have nothing left to hide
+        if ad_id in self._dismissed:
+            self._dismissed[ad_id].add(number)
+            self._active.pop(number, None)
+
+
+class UserDirectory(DerivedIndex):
+    """Users by id and by case-normalized email, plus a short-lived cache of admin flags.
+
+    is_admin() answers from its cache for up to admin_ttl seconds without checking the users
+    collection, so a flag changed by another worker takes up to that long to apply. Changes
+    committed through this process clear the cache straight away.
+    """
+
+    def __init__(self, store, users_file, admin_ttl=5):
+        self.users_file = users_file
+        self.admin_ttl = admin_ttl
+        self._admin_flags = {}  # user id -> (is_admin, expires at)
+        super().__init__(store, users_file)
+
+    def rebuild(self, collections):
+        self._by_id = {}
+        self._by_email = {}  # normalized email -> users, oldest first
+        for user in collections[self.users_file]:
+            self._add(dict(user))
+        self._admin_flags = {}
+
+    def apply(self, filepath, event):
+        op = event['op']
+        if op == 'insert':
+            self._add(dict(event['row']))
+            return True
+        if 'id' not in event['match']:
+            return False
+        user = self._by_id.get(event['match']['id'])
+        if user is None or not row_matches(user, event['match']):
+            return True
+        self._remove(user)
+        if op == 'update':
+            user.update(event['fields'])
+            self._add(user)
+        return True
+
+    def by_id(self, user_id):
+        """Returns the user row for user_id, or None. The row must not be mutated."""
+        self._ensure()
+        with self._lock:
+            return self._by_id.get(user_id)
+
+    def by_email(self, email):
+        """Returns the user registered with email, ignoring case and surrounding spaces, or None.
+
+        An exact match wins if older data holds several accounts differing only in case.
+        """
+        self._ensure()
+        with self._lock:
+            users = self._by_email.get(normalize_email(email), ())
+            return next((u for u in users if u['email'] == email), users[0] if users else None)
+
+    def is_admin(self, user_id):
+        now = time.monotonic()
+        cached = self._admin_flags.get(user_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        user = self.by_id(user_id)
+        flag = bool(user and user.get('is_admin'))
+        self._admin_flags[user_id] = (flag, now + self.admin_ttl)
+        return flag
+
+    def _on_commit(self, filepath, events, old_version, new_version):
+        super()._on_commit(filepath, events, old_version, new_version)
+        if filepath == self.users_file:
+            self._admin_flags = {}
+
+    def _add(self, user):
+        self._by_id[user['id']] = user
+        self._by_email.setdefault(normalize_email(user.get('email')), []).append(user)
+
+    def _remove(self, user):
+        del self._by_id[user['id']]
+        key = normalize_email(user.get('email'))
+        self._by_email[key] = [u for u in self._by_email[key] if u is not user]
+        if not self._by_email[key]:
+            del self._by_email[key]
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp as a naive local time, like the ones the app writes.
+
+    Imported data may carry a UTC offset; comparing such a value with a naive one raises TypeError.
+    """
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from metrics import REGISTRY, span
+
+# --- Background Jobs ---
+# A small persistent job queue kept in its own SQLite file, so request
+# handlers can hand off follow-up work (recounting, flushing, compaction) and
+# return straight away. `flask jobs work` runs the worker next to gunicorn.
+#
+# A job is a registered task name plus JSON keyword arguments. Jobs enqueued
+# with a key are coalesced: while one with that key is still queued, enqueuing
+# it again is a no-op, so a burst of likes on a video leaves one recount.
+# Failed jobs are retried with exponential backoff and kept as 'failed' once
+# they run out of attempts. Periodic tasks are enqueued by whichever worker
+# first sees them due, so several workers can share one queue.
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    key TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    run_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_queued_key ON jobs (key) WHERE status = 'queued';
+CREATE TABLE IF NOT EXISTS schedules (name TEXT PRIMARY KEY, next_run_at REAL NOT NULL);
+'''
+
+
+class JobQueue:
+    def __init__(self, database, inline=False, retry_delay=5, max_retry_delay=600, stale_after=600):
+        self.database = database
+        self.inline = inline  # run jobs as they are enqueued, for development without a worker
+        self.retry_delay = retry_delay  # seconds before the first retry, doubled on each later one
+        self.max_retry_delay = max_retry_delay
+        self.stale_after = stale_after  # seconds after which a running job is assumed lost with its worker
+        self.tasks = {}  # name -> (function, max attempts)
+        self.schedules = {}  # name -> interval in seconds
+        self._local = threading.local()
+
+    def task(self, name, max_attempts=5):
+        """Registers the decorated function as the task called name."""
+        def decorator(fn):
+            self.tasks[name] = (fn, max_attempts)
+            return fn
+        return decorator
+
+    def every(self, seconds, name):
+        """Runs the task called name (without arguments) every given number of seconds."""
+        self.schedules[name] = seconds
+
+    def enqueue(self, name, key=None, delay=0, **kwargs):
+        """Queues the task called name with kwargs. Returns False if a queued job already has key."""
+        if name not in self.tasks:
+            raise KeyError('Unknown task: %r' % name)
+        if self.inline:
+            self._execute(name, kwargs)
+            return True
+        cursor = self._conn().execute(
+            'INSERT OR IGNORE INTO jobs (name, args, key, run_at) VALUES (?, ?, ?, ?)',
+            (name, json.dumps(kwargs), key, time.time() + delay))
+        return cursor.rowcount == 1
+
+    def run_due(self, limit=None):
+        """Runs jobs that are due, one at a time, until none are left or limit ran. Returns how many ran."""
+        ran = 0
+        while limit is None or ran < limit:
+            job = self._claim()
+            if job is None:
+                break
+            self._run(*job)
+            ran += 1
+        return ran
+
+    def work(self, poll_interval=1.0, should_stop=lambda: False):
+        """Runs due jobs until should_stop() returns True, polling for new ones every poll_interval seconds."""
+        while not should_stop():
+            if not self.run_due(limit=1):
+                time.sleep(poll_interval)
+
+    def counts(self):
+        """Returns {status: jobs} for the jobs in the queue."""
+        rows = self._conn().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+        return dict(rows.fetchall())
+
+    def failed(self, limit=20):
+        """Returns [(id, name, args, attempts, last_error)] for jobs that ran out of attempts, newest first."""
+        return self._conn().execute(
+            "SELECT id, name, args, attempts, last_error FROM jobs WHERE status = 'failed' ORDER BY id DESC LIMIT ?",
+            (limit,)).fetchall()
+
+    def retry_failed(self):
+        """Queues every failed job again with fresh attempts. Returns how many were queued."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # A queued job with the same key already covers a failed one
+            cursor = conn.execute("UPDATE OR IGNORE jobs SET status = 'queued', attempts = 0, run_at = ? "
+                                  "WHERE status = 'failed'", (time.time(),))
+            conn.execute("DELETE FROM jobs WHERE status = 'failed'")
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor.rowcount
+
+    def _claim(self):
+        """Marks the next due job running and returns (id, name, args, attempts), or None."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._enqueue_scheduled(conn, now)
+            self._requeue_stale(conn, now)
+            row = conn.execute("SELECT id, name, args, attempts FROM jobs WHERE status = 'queued' AND run_at <= ? "
+                               "ORDER BY run_at, id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? "
+                             "WHERE id = ?", (now, row[0]))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job_id, name, args, attempts = row
+        return job_id, name, json.loads(args), attempts + 1
+
+    def _enqueue_scheduled(self, conn, now):
+        for name, interval in self.schedules.items():
+            conn.execute('INSERT OR IGNORE INTO schedules (name, next_run_at) VALUES (?, ?)', (name, now))
+            cursor = conn.execute('UPDATE schedules SET next_run_at = ? WHERE name = ? AND next_run_at <= ?',
+                                  (now + interval, name, now))
+            if cursor.rowcount:
+                conn.execute('INSERT OR IGNORE INTO jobs (name, args, key, run_at) VALUES (?, ?, ?, ?)',
+                             (name, '{}', 'schedule:' + name, now))
+
+    def _requeue_stale(self, conn, now):
+        conn.execute("UPDATE OR IGNORE jobs SET status = 'queued', run_at = ? WHERE status = 'running' AND started_at < ?",
+                     (now, now - self.stale_after))
+        conn.execute("DELETE FROM jobs WHERE status = 'running' AND started_at < ?", (now - self.stale_after,))
+
+    def _run(self, job_id, name, args, attempt):
+        conn = self._conn()
+        try:
+            self._execute(name, args, raise_errors=True)
+        except Exception:
+            error = traceback.format_exc()
+            max_attempts = self.tasks[name][1] if name in self.tasks else 1
+            if attempt >= max_attempts:
+                log.error('Job %s %s failed for good after %d attempts:\n%s', name, args, attempt, error)
+                conn.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+                return
+            delay = min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay)
+            log.warning('Job %s %s failed (attempt %d), retrying in %ds:\n%s', name, args, attempt, delay, error)
+            try:
+                conn.execute("UPDATE jobs SET status = 'queued', run_at = ?, last_error = ? WHERE id = ?",
+                             (time.time() + delay, error, job_id))
+            except sqlite3.IntegrityError:
+                # An identical job was queued meanwhile and will do the work
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            return
+        conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def _execute(self, name, args, raise_errors=False):
+        if name not in self.tasks:
+            raise KeyError('Unknown task: %r' % name)
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            with span('job'):
+                self.tasks[name][0](**args)
+        except Exception:
+            status = 'error'
+            if raise_errors:
+                raise
+            log.exception('Job %s %s failed', name, args)
+        finally:
+            REGISTRY.observe('gis_job_duration_seconds', time.perf_counter() - start, task=name)
+            REGISTRY.inc('gis_jobs_total', task=name, status=status)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be shared across threads or inherited by forked workers
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,222 @@
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+# --- Metrics ---
+# Timing spans, latency histograms and byte counters kept in process memory
+# and rendered in the Prometheus text format. Each gunicorn worker keeps its
+# own numbers, so a scrape sees the worker that answered it.
+#
+# span(name) times a block of work (parsing a collection, writing it,
+# rendering a template, hashing a password). The time goes into the span
+# histogram, and into the current request's breakdown when the block runs
+# inside one.
+
+# Upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'gis_request_duration_seconds': 'Request latency by endpoint.',
+    'gis_requests_total': 'Requests by endpoint, method and status.',
+    'gis_response_bytes_total': 'Response body bytes by endpoint.',
+    'gis_request_span_seconds': 'Time each request spent in instrumented work, by endpoint.',
+    'gis_span_duration_seconds': 'Time spent in instrumented work (storage, rendering, hashing).',
+    'gis_job_duration_seconds': 'Background job run time by task.',
+    'gis_jobs_total': 'Background job runs by task and outcome.',
+    'gis_storage_read_bytes_total': 'Bytes read from collections.',
+    'gis_storage_written_bytes_total': 'Bytes written to collections.',
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.buckets), h.count, h.sum)) for key, h in self._histograms.items())
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, hits in zip(BUCKETS, buckets):
+                cumulative += hits
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', _number(bound)),)), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+_request = threading.local()
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def record_span(name, elapsed):
+    """Records elapsed seconds of work timed by the caller, for work that can't be wrapped in span()."""
+    REGISTRY.observe('gis_span_duration_seconds', elapsed, span=name)
+    spans = getattr(_request, 'spans', None)
+    if spans is not None:
+        spans[name] = spans.get(name, 0) + elapsed
+
+
+def count_read(filepath, size):
+    REGISTRY.inc('gis_storage_read_bytes_total', size, collection=os.path.basename(filepath))
+
+
+def count_written(filepath, size):
+    REGISTRY.inc('gis_storage_written_bytes_total', size, collection=os.path.basename(filepath))
+
+
+def begin_request():
+    _request.spans = {}
+    _request.start = time.perf_counter()
+
+
+def end_request(endpoint, method, status, size):
+    """Records a finished request. Returns (elapsed seconds, {span: seconds}) for it."""
+    elapsed = time.perf_counter() - _request.start
+    spans = _request.spans
+    _request.spans = None
+    REGISTRY.observe('gis_request_duration_seconds', elapsed, endpoint=endpoint, method=method)
+    REGISTRY.inc('gis_requests_total', endpoint=endpoint, method=method, status=str(status))
+    if size:
+        REGISTRY.inc('gis_response_bytes_total', size, endpoint=endpoint)
+    for name, seconds in spans.items():
+        REGISTRY.observe('gis_request_span_seconds', seconds, endpoint=endpoint, span=name)
+    return elapsed, spans
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                            for k, v in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- Sampling Profiler ---
+# Opt-in: a background thread snapshots the stacks of threads that are
+# serving requests every `interval` seconds. When a request takes longer than
+# `threshold` seconds its samples are written to `directory` as collapsed
+# stacks ("outer;inner;leaf count" per line), which flamegraph.pl, speedscope
+# and most flame-graph viewers read directly. Faster requests are discarded.
+
+
+class SamplingProfiler:
+    def __init__(self, directory, threshold=0.5, interval=0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self._samples = {}  # thread id -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self):
+        """Starts sampling the calling thread."""
+        self._start()
+        with self._lock:
+            self._samples[threading.get_ident()] = collections.Counter()
+
+    def end(self, name, elapsed):
+        """Stops sampling the calling thread; writes its profile if elapsed passed the threshold.
+
+        Returns the path of the profile written, or None.
+        """
+        with self._lock:
+            samples = self._samples.pop(threading.get_ident(), None)
+        if not samples or elapsed < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '%s-%d-%s-%dms.folded' % (
+            datetime.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), name, elapsed * 1000))
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+    def _start(self):
+        # Started lazily so each forked worker gets its own sampler thread
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
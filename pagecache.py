@@ -0,0 +1,66 @@
+import collections
+import hashlib
+import threading
+import time
+
+# --- Rendered Page Cache ---
+# Keeps fully rendered pages keyed by the inputs they depend on, together
+# with the version of the data they were rendered from. An entry is served
+# while that version is current, or for up to `tolerance` seconds after it
+# changed, so a busy page is re-rendered at most once per tolerance window
+# however often views and likes arrive. Writes that must show up at once
+# call clear(). Entries are evicted least recently used first once either
+# the entry count or the total body size passes its limit.
+
+
+class CachedPage:
+    def __init__(self, body, version):
+        self.body = body
+        self.version = version
+        self.etag = hashlib.md5(body).hexdigest()
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=128, max_bytes=8 * 1024 * 1024, tolerance=5):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance  # seconds an entry outlives a change to its data
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Returns the CachedPage for key if it is still fresh for version, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version and time.monotonic() - entry.created > self.tolerance:
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, body):
+        """Caches body (bytes) rendered from version under key and returns its CachedPage."""
+        entry = CachedPage(body, version)
+        if len(body) > self.max_bytes:
+            return entry
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.body)
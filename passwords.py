@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+from metrics import span
+
+# --- Password Hashing ---
+# bcrypt is deliberately slow (about 250ms of CPU at cost 12), so hashing and
+# checking run on a small process pool instead of the request thread. At most
+# `workers + max_queue` jobs may be in flight per web worker; beyond that
+# callers get HasherBusy straight away rather than queueing behind a burst of
+# logins, which the app turns into a 429.
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing pool already has as many jobs as it will queue."""
+
+
+class PasswordHasher:
+    def __init__(self, rounds=12, workers=2, max_queue=16):
+        self.rounds = rounds  # bcrypt work factor for new hashes
+        self.workers = workers  # 0 hashes on the calling thread (no pool, no limit)
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(workers + max_queue) if workers else None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        """Returns a bcrypt hash of password at the configured cost."""
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Returns True if password matches hashed; a malformed hash never matches."""
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Returns True if hashed was made with a different cost than the configured one."""
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (AttributeError, IndexError, ValueError):
+            return False
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            with span('bcrypt'):
+                return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Includes time queued behind other hashes, which is what the request waits for
+        with span('bcrypt'):
+            return future.result()
+
+    def _executor(self):
+        with self._lock:
+            # A pool can't be used from a process forked after it was started (e.g. gunicorn workers)
+            if self._pool is None or self._pool_pid != os.getpid():
+                # Forked rather than spawned: spawned workers would re-run the launching script
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('fork'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        return False
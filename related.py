@@ -0,0 +1,144 @@
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # optional: the pure-Python build gives the same table, only slower
+    np = sparse = None
+
+from metrics import span
+
+# --- Related Videos ---
+# Item-to-item recommendations from co-engagement: two videos are related
+# when the same users liked or enrolled in both. Each user is a row of a
+# sparse user x video matrix, weighted down by how many videos they engaged
+# with, and the similarity of two videos is the cosine of their columns.
+# The batch build keeps the best `k` neighbours of each video and writes
+# them to one JSON file, so a detail page only looks up a short list.
+#
+# With numpy and scipy installed the co-occurrence is a sparse matrix
+# product computed a block of videos at a time, which handles millions of
+# engagement rows in seconds on one core. Without them the same scores are
+# counted pair by pair in Python.
+
+TOP_K = 20
+
+# Videos per block of the co-occurrence product; bounds the memory it takes
+BLOCK_SIZE = 2048
+
+# Users engaged with more videos than this (crawlers, test accounts) say little
+# about any pair and cost the square of their count, so they are left out
+MAX_USER_VIDEOS = 1000
+
+
+def build_related(store, filepaths, k=TOP_K):
+    """Returns {video_id: [(related_id, score), ...]} with the k best neighbours of each video.
+
+    filepaths are collections of rows with user_id and video_id, such as likes and enrollments.
+    """
+    with span('build_related'):
+        user_videos = defaultdict(set)
+        for filepath in filepaths:
+            for row in store.iter_rows(filepath):
+                user_videos[row['user_id']].add(row['video_id'])
+        baskets = [videos for videos in user_videos.values() if 1 < len(videos) <= MAX_USER_VIDEOS]
+        if sparse is not None:
+            return _build_sparse(baskets, k)
+        return _build_python(baskets, k)
+
+
+def _user_weight(count):
+    return 1 / math.log2(1 + count)
+
+
+def _build_sparse(baskets, k):
+    video_ids = sorted({video_id for videos in baskets for video_id in videos})
+    numbers = {video_id: i for i, video_id in enumerate(video_ids)}
+    lengths = np.fromiter((len(videos) for videos in baskets), dtype=np.int64, count=len(baskets))
+    cols = np.fromiter((numbers[video_id] for videos in baskets for video_id in videos), dtype=np.int32,
+                       count=int(lengths.sum()))
+    rows = np.repeat(np.arange(len(baskets), dtype=np.int32), lengths)
+    weights = np.repeat(1 / np.log2(1 + lengths.astype(np.float32)), lengths).astype(np.float32)
+    matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(len(baskets), len(video_ids)))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    columns = matrix.tocsc()
+
+    related = {}
+    for start in range(0, len(video_ids), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(video_ids))
+        block = (columns[:, start:stop].T @ matrix).tocsr()
+        block = sparse.diags(1 / norms[start:stop]) @ block @ sparse.diags(1 / norms)
+        block = block.tocsr()
+        for offset in range(stop - start):
+            video = start + offset
+            lo, hi = block.indptr[offset], block.indptr[offset + 1]
+            neighbours, scores = block.indices[lo:hi], block.data[lo:hi]
+            keep = neighbours != video
+            neighbours, scores = neighbours[keep], scores[keep]
+            if len(scores) > k:
+                best = np.argpartition(-scores, k)[:k]
+                neighbours, scores = neighbours[best], scores[best]
+            order = np.lexsort((neighbours, -scores))
+            if len(order):
+                related[video_ids[video]] = [(video_ids[neighbours[i]], round(float(scores[i]), 4)) for i in order]
+    return related
+
+
+def _build_python(baskets, k):
+    pairs = defaultdict(float)
+    squares = defaultdict(float)
+    for videos in baskets:
+        weight = _user_weight(len(videos))
+        videos = sorted(videos)
+        for i, video_id in enumerate(videos):
+            squares[video_id] += weight * weight
+            for other in videos[i + 1:]:
+                pairs[video_id, other] += weight * weight
+    neighbours = defaultdict(list)
+    for (a, b), total in pairs.items():
+        score = total / math.sqrt(squares[a] * squares[b])
+        neighbours[a].append((b, score))
+        neighbours[b].append((a, score))
+    related = {}
+    for video_id, candidates in neighbours.items():
+        candidates.sort(key=lambda candidate: (-candidate[1], candidate[0]))
+        related[video_id] = [(other, round(score, 4)) for other, score in candidates[:k]]
+    return related
+
+
+class RelatedVideos:
+    """The table written by build_related, reloaded whenever another process rewrites its file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._table = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def save(self, table):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(table, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def get(self, video_id):
+        """Returns the ids related to video_id, most related first."""
+        return [related_id for related_id, _ in self._current().get(video_id, ())]
+
+    def _current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self.path, encoding='utf-8') as f:
+                        self._table = json.load(f)
+                    self._mtime = mtime
+        return self._table
@@ -0,0 +1,202 @@
+import bisect
+import heapq
+import math
+import re
+
+from indexes import DerivedIndex
+
+# --- Full-Text Search ---
+# An in-process inverted index over video titles, descriptions and categories
+# (and, for admins, suggestion text), ranked with BM25. The last word of a
+# query also matches as a prefix, so the same index serves as-you-type
+# autocomplete. Like the other derived indexes it follows the store's change
+# events, so adding, editing or deleting a video only reindexes that video.
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Terms a query prefix may expand to
+MAX_PREFIX_TERMS = 50
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+class InvertedIndex:
+    """Term postings for a set of documents, scored with BM25."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # term -> {doc_id: term frequency}
+        self._lengths = {}  # doc_id -> tokens
+        self._doc_terms = {}  # doc_id -> distinct terms
+        self._total_length = 0
+        self._terms = []  # sorted terms, for prefix lookups
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        tokens = tokenize(text)
+        self._lengths[doc_id] = len(tokens)
+        self._total_length += len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        self._doc_terms[doc_id] = tuple(counts)
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                bisect.insort(self._terms, term)
+            postings[doc_id] = tf
+
+    def remove(self, doc_id):
+        if doc_id not in self._lengths:
+            return
+        self._total_length -= self._lengths.pop(doc_id)
+        for term in self._doc_terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def expand(self, prefix, limit=MAX_PREFIX_TERMS):
+        """Returns up to limit indexed terms starting with prefix, most frequent first."""
+        start = bisect.bisect_left(self._terms, prefix)
+        end = bisect.bisect_left(self._terms, prefix + '\uffff')
+        terms = self._terms[start:end]
+        if len(terms) > limit:
+            terms = heapq.nlargest(limit, terms, key=lambda t: len(self._postings[t]))
+        return sorted(terms, key=lambda t: (-len(self._postings[t]), t))
+
+    def search(self, query, limit=20, prefix=True):
+        """Returns [(doc_id, score)] for the best matches of query, best first.
+
+        With prefix set the last query word also matches longer terms, scoring as its best expansion.
+        """
+        words = tokenize(query)
+        if not words or not self._lengths:
+            return []
+        scores = {}
+        for i, word in enumerate(words):
+            terms = self.expand(word) if prefix and i == len(words) - 1 else [word]
+            best = {}
+            for term in terms:
+                for doc_id, score in self._score(term).items():
+                    if score > best.get(doc_id, 0):
+                        best[doc_id] = score
+            for doc_id, score in best.items():
+                scores[doc_id] = scores.get(doc_id, 0) + score
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def _score(self, term):
+        postings = self._postings.get(term)
+        if not postings:
+            return {}
+        n = len(self._lengths)
+        idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+        average = self._total_length / n or 1
+        return {doc_id: idf * tf * (self.k1 + 1) /
+                (tf + self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / average))
+                for doc_id, tf in postings.items()}
+
+
+class SearchIndex(DerivedIndex):
+    """Searchable videos and suggestions, kept in step with their collections."""
+
+    VIDEO_FIELDS = ('title', 'description', 'category')
+
+    def __init__(self, store, videos_file, suggestions_file):
+        self.videos_file = videos_file
+        self.suggestions_file = suggestions_file
+        super().__init__(store, videos_file, suggestions_file)
+
+    def rebuild(self, collections):
+        for filepath in self.sources:
+            self.refresh(filepath, collections[filepath])
+
+    def refresh(self, filepath, rows):
+        if filepath == self.videos_file:
+            self._videos = {}  # id -> row
+            self._video_index = InvertedIndex()
+            for video in rows:
+                self._add_video(dict(video))
+        else:
+            self._suggestions = {}  # id -> row
+            self._suggestion_index = InvertedIndex()
+            for suggestion in rows:
+                self._add_suggestion(dict(suggestion))
+        return True
+
+    def apply(self, filepath, event):
+        if filepath == self.videos_file:
+            rows, add, index = self._videos, self._add_video, self._video_index
+        else:
+            rows, add, index = self._suggestions, self._add_suggestion, self._suggestion_index
+        op = event['op']
+        if op == 'insert':
+            add(dict(event['row']))
+            return True
+        match = event['match']
+        if set(match) == {'id'}:
+            row = rows.get(match['id'])
+            if row is None:
+                return True
+            if op == 'update':
+                text_changed = any(field in event['fields'] for field in self._text_fields(filepath))
+                row.update(event['fields'])
+                # Counter updates (likes, views) leave the indexed text alone
+                if text_changed or row['id'] != match['id']:
+                    del rows[match['id']]
+                    index.remove(match['id'])
+                    add(row)
+            else:
+                del rows[match['id']]
+                index.remove(match['id'])
+            return True
+        if op == 'delete' and filepath == self.suggestions_file and set(match) in ({'video_id'}, {'user_id'}):
+            (field, value), = match.items()
+            for row in [s for s in rows.values() if s[field] == value]:
+                del rows[row['id']]
+                index.remove(row['id'])
+            return True
+        return False
+
+    def videos(self, query, limit=20):
+        """Returns [(video, score)] best first. The rows must not be mutated."""
+        self._ensure()
+        with self._lock:
+            return [(self._videos[video_id], score) for video_id, score in self._video_index.search(query, limit)]
+
+    def suggestions(self, query, limit=20):
+        """Returns [(suggestion, score)] best first. The rows must not be mutated."""
+        self._ensure()
+        with self._lock:
+            return [(self._suggestions[suggestion_id], score)
+                    for suggestion_id, score in self._suggestion_index.search(query, limit)]
+
+    def complete(self, prefix, limit=10):
+        """Returns up to limit words from video text starting with the last word of prefix."""
+        words = tokenize(prefix)
+        if not words:
+            return []
+        self._ensure()
+        with self._lock:
+            return self._video_index.expand(words[-1], limit)
+
+    def _text_fields(self, filepath):
+        return self.VIDEO_FIELDS if filepath == self.videos_file else ('suggestion_text',)
+
+    def _add_video(self, video):
+        self._videos[video['id']] = video
+        self._video_index.add(video['id'], ' '.join(str(video.get(f) or '') for f in self.VIDEO_FIELDS))
+
+    def _add_suggestion(self, suggestion):
+        # Suggestions written before ids were assigned can't be addressed by events, only rebuilt
+        suggestion_id = suggestion.setdefault('id', '%s:%s' % (suggestion['user_id'], suggestion['video_id']))
+        self._suggestions[suggestion_id] = suggestion
+        self._suggestion_index.add(suggestion_id, suggestion.get('suggestion_text'))
@@ -0,0 +1,330 @@
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from datastore import Transaction, expand_event, row_matches
+from metrics import count_read, count_written, span
+
+# --- SQLite Store ---
+# Drop-in replacement for JsonStore that keeps each collection in a table of
+# the same name (users.json -> users). Rows are stored as JSON documents, with
+# id, email, user_id and video_id copied into indexed columns so that
+# transaction events can be applied by key instead of rewriting the table.
+#
+# The database runs in WAL mode: readers never block, and a transaction takes
+# the database write lock (BEGIN IMMEDIATE) for its whole duration, which
+# serializes read-modify-write cycles across gunicorn workers.
+
+INDEXED_COLUMNS = ('id', 'email', 'user_id', 'video_id')
+
+# Keys bound per IN (...) clause, well under SQLite's parameter limit
+MAX_SQL_PARAMS = 500
+
+
+class SqliteBulkWriter:
+    """Inserts rows into a set of collections inside the surrounding database transaction."""
+
+    def __init__(self, store, filepaths):
+        self._store = store
+        self._filepaths = filepaths
+        self._begun = []
+
+    def begin(self, filepath, keep=True):
+        """Starts writing filepath, first removing its current rows unless keep is False."""
+        if filepath not in self._filepaths:
+            raise KeyError('%s is not part of this import' % filepath)
+        self._begun.append((filepath, self._store.version(filepath)))
+        if not keep:
+            self._store._conn().execute('DELETE FROM "%s"' % self._store._table(filepath))
+
+    def append(self, filepath, rows):
+        values = [_columns(row) for row in rows]
+        with span('save_sqlite'):
+            self._store._conn().executemany(
+                'INSERT INTO "%s" (id, email, user_id, video_id, doc) VALUES (?, ?, ?, ?, ?)'
+                % self._store._table(filepath), values)
+        count_written(filepath, sum(len(v[-1]) for v in values))
+
+    def commit(self):
+        for filepath, old_version in self._begun:
+            self._store._bump(filepath, None, old_version)
+
+
+class SqliteStore:
+    def __init__(self, database):
+        self.database = database
+        self._cache = {}  # filepath -> (version, data)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._subscribers = []
+        self._tables = set()
+
+    def version(self, filepath):
+        """Returns a counter that is bumped by every committed write to the collection."""
+        row = self._conn().execute('SELECT version FROM versions WHERE collection = ?',
+                                   (self._table(filepath),)).fetchone()
+        return row[0] if row else 0
+
+    def read(self, filepath):
+        """Returns the collection's rows from cache, reloading them only if the collection changed.
+
+        The returned list is shared between callers and must not be mutated; use load() for a private copy.
+        """
+        return self.read_versioned(filepath)[1]
+
+    def read_versioned(self, filepath):
+        """Returns (version, rows) like read(), with the version the rows are exactly as of."""
+        while True:
+            version = self.version(filepath)
+            entry = self._cache.get(filepath)
+            if entry is not None and entry[0] == version:
+                return entry
+            data = self.load(filepath)
+            # A write that raced the read means reading again
+            if self.version(filepath) == version:
+                self._remember(filepath, version, data)
+                return version, data
+
+    def load(self, filepath):
+        """Returns a fresh, mutable copy of the collection's rows in insertion order."""
+        table = self._table(filepath)
+        with span('load_sqlite'):
+            docs = [doc for (doc,) in self._conn().execute('SELECT doc FROM "%s" ORDER BY pos' % table)]
+            data = [json.loads(doc) for doc in docs]
+        count_read(filepath, sum(len(doc) for doc in docs))
+        return data
+
+    def iter_rows(self, filepath):
+        """Yields fresh copies of the collection's rows in order, without loading them all at once."""
+        cursor = self._conn().execute('SELECT doc FROM "%s" ORDER BY pos' % self._table(filepath))
+        size = 0
+        try:
+            for (doc,) in cursor:
+                size += len(doc)
+                yield json.loads(doc)
+        finally:
+            count_read(filepath, size)
+
+    @contextlib.contextmanager
+    def bulk_import(self, *filepaths):
+        """Yields a SqliteBulkWriter whose inserts commit together in one transaction when the block exits."""
+        with self.lock(*filepaths):
+            writer = SqliteBulkWriter(self, filepaths)
+            yield writer
+            writer.commit()
+
+    def save(self, filepath, data):
+        """Replaces the whole collection with data."""
+        with self.lock(filepath):
+            old_version = self.version(filepath)
+            with span('save_sqlite'):
+                self._replace(filepath, data)
+            self._bump(filepath, None, old_version)
+        self.invalidate(filepath)
+
+    def invalidate(self, filepath=None):
+        with self._lock:
+            if filepath is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(filepath, None)
+
+    def applies_events(self, filepath):
+        return True
+
+    def events_since(self, filepath, version):
+        """Change history isn't kept in the database, so derived structures rebuild from read()."""
+        return None
+
+    def subscribe(self, callback):
+        """Registers callback(filepath, events, old_version, new_version), called after each commit.
+
+        events is the list of change events, or None when the whole collection was rewritten.
+        """
+        self._subscribers.append(callback)
+
+    @contextlib.contextmanager
+    def lock(self, *filepaths):
+        """Holds the database write lock. SQLite locks the whole database, so filepaths only document intent.
+
+        Nested calls join the outermost transaction; subscribers are notified once it commits.
+        """
+        for filepath in filepaths:
+            self._table(filepath)
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        self._local.pending = []
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+            for filepath, events, old_version, new_version, data in self._local.pending:
+                if data is not None:
+                    self._remember(filepath, new_version, data)
+                for callback in self._subscribers:
+                    callback(filepath, events, old_version, new_version)
+        finally:
+            self._local.depth = 0
+            self._local.pending = []
+
+    @contextlib.contextmanager
+    def transaction(self, *filepaths):
+        """Takes the write lock and yields a Transaction over filepaths, committed when the block exits.
+
+        Collections the block loaded through tx[filepath] are replaced wholesale; otherwise their
+        recorded events are applied row by row using the indexed columns.
+        """
+        with self.lock(*filepaths):
+            tx = Transaction(self, filepaths)
+            yield tx
+            if tx.discarded:
+                return
+            for filepath in filepaths:
+                loaded = filepath in tx._data
+                events = tx.events.get(filepath)
+                if not loaded and not events:
+                    continue
+                old_version = self.version(filepath)
+                with span('save_sqlite'):
+                    if loaded:
+                        self._replace(filepath, tx[filepath])
+                    else:
+                        for event in events:
+                            self._apply(filepath, event)
+                self._bump(filepath, events, old_version, tx._data.get(filepath))
+
+    def _bump(self, filepath, events, old_version, data=None):
+        table = self._table(filepath)
+        self._conn().execute(
+            'INSERT INTO versions (collection, version) VALUES (?, 1) '
+            'ON CONFLICT(collection) DO UPDATE SET version = version + 1', (table,))
+        self._local.pending.append((filepath, events, old_version, self.version(filepath), data))
+
+    def _remember(self, filepath, version, data):
+        with self._lock:
+            self._cache[filepath] = (version, data)
+
+    def _replace(self, filepath, rows):
+        table = self._table(filepath)
+        conn = self._conn()
+        conn.execute('DELETE FROM "%s"' % table)
+        written = [0]
+
+        def columns():
+            for row in rows:
+                values = _columns(row)
+                written[0] += len(values[-1])
+                yield values
+        conn.executemany('INSERT INTO "%s" (id, email, user_id, video_id, doc) VALUES (?, ?, ?, ?, ?)' % table,
+                         columns())
+        count_written(filepath, written[0])
+
+    def _apply(self, filepath, event):
+        table = self._table(filepath)
+        conn = self._conn()
+        op = event['op']
+        if op in ('update_many', 'delete_many'):
+            self._apply_many(filepath, event)
+            return
+        if op == 'insert':
+            values = _columns(event['row'])
+            conn.execute('INSERT INTO "%s" (id, email, user_id, video_id, doc) VALUES (?, ?, ?, ?, ?)' % table, values)
+            count_written(filepath, len(values[-1]))
+            return
+        matched = self._select(table, event['match'])
+        if op == 'update':
+            for pos, row in matched:
+                row.update(event['fields'])
+                values = _columns(row)
+                conn.execute('UPDATE "%s" SET id = ?, email = ?, user_id = ?, video_id = ?, doc = ? WHERE pos = ?'
+                             % table, values + (pos,))
+                count_written(filepath, len(values[-1]))
+        elif op == 'delete':
+            conn.executemany('DELETE FROM "%s" WHERE pos = ?' % table, ((pos,) for pos, _ in matched))
+        else:
+            raise ValueError('Unknown event op: %r' % op)
+
+    def _apply_many(self, filepath, event):
+        """Applies an update_many/delete_many event, a chunk of keys per statement when the field is indexed."""
+        table = self._table(filepath)
+        conn = self._conn()
+        field = event['field']
+        keys = list(event['changes'] if event['op'] == 'update_many' else event['values'])
+        if field not in INDEXED_COLUMNS:
+            for single in expand_event(event):
+                self._apply(filepath, single)
+            return
+        for start in range(0, len(keys), MAX_SQL_PARAMS):
+            chunk = [_text(key) for key in keys[start:start + MAX_SQL_PARAMS]]
+            where = '%s IN (%s)' % (field, ', '.join('?' * len(chunk)))
+            if event['op'] == 'delete_many':
+                conn.execute('DELETE FROM "%s" WHERE %s' % (table, where), chunk)
+                continue
+            for pos, doc in conn.execute('SELECT pos, doc FROM "%s" WHERE %s' % (table, where), chunk).fetchall():
+                row = json.loads(doc)
+                row.update(event['changes'][row[field]])
+                values = _columns(row)
+                conn.execute('UPDATE "%s" SET id = ?, email = ?, user_id = ?, video_id = ?, doc = ? WHERE pos = ?'
+                             % table, values + (pos,))
+                count_written(filepath, len(values[-1]))
+
+    def _select(self, table, match):
+        """Returns (pos, row) for rows matching every field in match, narrowed through the indexed columns."""
+        keys = [k for k in match if k in INDEXED_COLUMNS]
+        sql = 'SELECT pos, doc FROM "%s"' % table
+        if keys:
+            sql += ' WHERE ' + ' AND '.join('%s = ?' % k for k in keys)
+        rows = self._conn().execute(sql, [_text(match[k]) for k in keys])
+        return [(pos, row) for pos, row in ((pos, json.loads(doc)) for pos, doc in rows)
+                if row_matches(row, match)]
+
+    def _table(self, filepath):
+        table = os.path.splitext(os.path.basename(filepath))[0]
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', table):
+            raise ValueError('Invalid collection name: %r' % filepath)
+        if table not in self._tables:
+            conn = self._conn()
+            conn.execute('CREATE TABLE IF NOT EXISTS "%s" (pos INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'id TEXT, email TEXT, user_id TEXT, video_id TEXT, doc TEXT NOT NULL)' % table)
+            for column in INDEXED_COLUMNS:
+                conn.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" (%s)' % (table, column, table, column))
+            conn.execute('CREATE INDEX IF NOT EXISTS "%s_user_video" ON "%s" (user_id, video_id)' % (table, table))
+            self._tables.add(table)
+        return table
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be shared across threads or inherited by forked workers
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS versions (collection TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+            self._local.pending = []
+        return conn
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _columns(row):
+    return tuple(_text(row.get(column)) for column in INDEXED_COLUMNS) + (json.dumps(row),)
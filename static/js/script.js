@@ -150,6 +150,45 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     });
 
+    // Search autocomplete: offer completions of the word being typed
+    const searchInput = document.getElementById('search-query');
+    if (searchInput) {
+        const completions = document.getElementById('search-completions');
+        let completeTimer = null;
+        searchInput.addEventListener('input', function () {
+            clearTimeout(completeTimer);
+            completeTimer = setTimeout(async () => {
+                const value = this.value;
+                if (!value.trim()) {
+                    completions.innerHTML = '';
+                    return;
+                }
+                try {
+                    const response = await fetch(`${this.dataset.completeUrl}?q=${encodeURIComponent(value)}`);
+                    const data = await response.json();
+                    const head = value.replace(/\S*$/, '');
+                    completions.innerHTML = '';
+                    data.completions.forEach(word => {
+                        const option = document.createElement('option');
+                        option.value = head + word;
+                        completions.appendChild(option);
+                    });
+                } catch (error) {
+                    console.error('Error:', error);
+                }
+            }, 150);
+        });
+    }
+
+    // Bulk selection in admin tables: the header checkbox selects every row of its form
+    document.querySelectorAll('.select-all').forEach(selectAll => {
+        selectAll.addEventListener('change', () => {
+            document.querySelectorAll(`input[type="checkbox"][form="${selectAll.dataset.form}"]`).forEach(checkbox => {
+                checkbox.checked = selectAll.checked;
+            });
+        });
+    });
+
     // Navigation toggle for mobile
     const navToggle = document.querySelector('.nav-toggle');
     if (navToggle) {
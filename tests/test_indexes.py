@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from aggregates import DashboardAggregates
+from datastore import JsonStore
+from indexes import TrendingIndex, UserDirectory
+from sqlitestore import SqliteStore
+
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name in ('users', 'videos', 'enrollments', 'likes'):
+            setattr(self, name, os.path.join(self.dir, name + '.json'))
+
+    def json_store(self):
+        return self.created(JsonStore(log_files=[self.videos, self.likes, self.enrollments]))
+
+    def sqlite_store(self):
+        return self.created(SqliteStore(os.path.join(self.dir, 'test.sqlite3')))
+
+    def created(self, store):
+        for filepath in (self.users, self.videos, self.enrollments, self.likes):
+            store.read(filepath)
+        return store
+
+    def like(self, store, user_id, video_id, timestamp='2024-01-01T00:00:00'):
+        with store.transaction(self.likes) as tx:
+            tx.insert(self.likes, {'user_id': user_id, 'video_id': video_id, 'timestamp': timestamp})
+
+    def add_video(self, store, video_id, uploaded_at):
+        with store.transaction(self.videos) as tx:
+            tx.insert(self.videos, {'id': video_id, 'title': video_id, 'category': 'GIS', 'uploaded_at': uploaded_at})
+
+
+class CommitDuringRebuildTest(IndexTestCase):
+    """A commit that lands while a rebuild reads its sources is counted once."""
+
+    def commit_on_read(self, store, writer):
+        """Makes the next read of likes through store commit a like through writer first.
+
+        The rebuild has already compared versions by then, as with a commit from another thread
+        or worker landing between the two.
+        """
+        committed = []
+
+        def wrap(read):
+            def read_after_commit(filepath):
+                if filepath == self.likes and not committed:
+                    committed.append(True)
+                    self.like(writer, 'u1', 'v1')
+                return read(filepath)
+            return read_after_commit
+
+        store.read = wrap(store.read)
+        store.read_versioned = wrap(store.read_versioned)
+
+    def check(self, store, writer):
+        stats = DashboardAggregates(store, self.users, self.videos, self.enrollments, self.likes)
+        self.commit_on_read(store, writer)
+        self.assertEqual(stats.totals()['total_likes'], 1)
+        self.assertEqual(stats.totals()['total_likes'], 1)
+        self.like(writer, 'u2', 'v1')
+        self.assertEqual(stats.totals()['total_likes'], 2)
+        self.assertEqual(len(store.read(self.likes)), 2)
+
+    def test_json_store(self):
+        store = self.json_store()
+        self.check(store, store)
+
+    def test_sqlite_store(self):
+        store = self.sqlite_store()
+        self.check(store, store)
+
+    def test_json_store_commit_from_another_worker(self):
+        self.check(self.json_store(), self.json_store())
+
+    def test_sqlite_store_commit_from_another_worker(self):
+        self.check(self.sqlite_store(), self.sqlite_store())
+
+
+class TrendingLikesOfUnseenVideoTest(IndexTestCase):
+    """Likes of a video another worker added count once this worker's index catches up with it."""
+
+    def check(self, store, other):
+        now = datetime.now().isoformat()
+        self.add_video(store, 'old', '2024-01-02T00:00:00')
+        self.like(store, 'u0', 'old', now)
+        trending = TrendingIndex(store, self.videos, self.likes, self.enrollments)
+        self.assertEqual(trending.page()[0], ['old'])
+
+        self.add_video(other, 'new', '2024-01-01T00:00:00')
+        # Liked through this worker before its index has seen the video
+        self.like(store, 'u1', 'new', now)
+        self.like(store, 'u2', 'new', now)
+        self.assertEqual(trending.page()[0], ['new', 'old'])
+        fresh = TrendingIndex(other, self.videos, self.likes, self.enrollments)
+        self.assertEqual(fresh.page()[0], ['new', 'old'])
+
+    def test_json_store(self):
+        self.check(self.json_store(), self.json_store())
+
+    def test_sqlite_store(self):
+        self.check(self.sqlite_store(), self.sqlite_store())
+
+
+class UserUpdateMatchedOnPasswordTest(IndexTestCase):
+    """An update matched on a user's old password hash only applies while that hash is current."""
+
+    def check(self, store):
+        users = UserDirectory(store, self.users)
+        with store.transaction(self.users) as tx:
+            tx.insert(self.users, {'id': 'u1', 'email': 'a@example.com', 'password': 'old'})
+        self.assertEqual(users.by_id('u1')['password'], 'old')
+        with store.transaction(self.users) as tx:
+            tx.update(self.users, {'id': 'u1'}, {'password': 'changed'})
+        with store.transaction(self.users) as tx:
+            tx.update(self.users, {'id': 'u1', 'password': 'old'}, {'password': 'rehashed'})
+        self.assertEqual(users.by_id('u1')['password'], 'changed')
+        self.assertEqual(store.read(self.users)[0]['password'], 'changed')
+        with store.transaction(self.users) as tx:
+            tx.update(self.users, {'id': 'u1', 'password': 'changed'}, {'password': 'rehashed'})
+        self.assertEqual(users.by_id('u1')['password'], 'rehashed')
+        self.assertEqual(store.read(self.users)[0]['password'], 'rehashed')
+
+    def test_json_store(self):
+        self.check(self.json_store())
+
+    def test_sqlite_store(self):
+        self.check(self.sqlite_store())
+
+
+if __name__ == '__main__':
+    unittest.main()
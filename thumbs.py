@@ -0,0 +1,287 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import time
+import urllib.parse
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional: without Pillow thumbnails link straight to their source
+    Image = None
+
+from metrics import span
+
+# --- Thumbnails ---
+# Video thumbnails and ad images are pasted in as URLs of any size. The
+# first request for one at a given width queues a job that fetches the
+# source once, scales it down and writes a WebP and a JPEG rendition;
+# until that has run, the request is redirected to the source. Renditions
+# are named after a hash of the source URL and their size, so one is never
+# rewritten in place and its name doubles as its ETag.
+#
+# Renditions and fetched sources share a cache of max_bytes, evicted least
+# recently used first (a hit refreshes the file's mtime, at most once a
+# minute). Uploaded images are the only copy and are never evicted.
+#
+# Source URLs come from admins and ads, but the server fetches them, so a
+# fetch only goes to public addresses: the host is resolved first, refused
+# if any of its addresses is private, loopback, link-local or otherwise not
+# globally routable, and the connection is made to the address checked.
+# Redirects are followed by hand and checked the same way.
+
+# Widths a rendition can be asked for; anything else is rounded up to the next one
+WIDTHS = (320, 480, 960)
+
+# Rendition format -> (Pillow format, mimetype, file extension, save options)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', '.webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# Leading bytes of the image types accepted as uploads or sources -> mimetype
+SIGNATURES = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'GIF87a': 'image/gif',
+    b'GIF89a': 'image/gif',
+    b'RIFF': 'image/webp',  # followed by the size and 'WEBP'
+}
+
+# How stale a cached file's mtime may get before a hit refreshes it
+TOUCH_INTERVAL = 60
+
+# Redirects followed when fetching a source
+MAX_REDIRECTS = 3
+
+# Largest source image decoded, in pixels; a small file can declare a huge canvas
+MAX_SOURCE_PIXELS = 40 * 1000 * 1000
+
+
+class InvalidImage(ValueError):
+    """Raised for an upload or source that isn't an image this cache can read."""
+
+
+def available():
+    return Image is not None
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:20]
+
+
+def pick_width(width):
+    for candidate in WIDTHS:
+        if width <= candidate:
+            return candidate
+    return WIDTHS[-1]
+
+
+class ThumbnailCache:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_source_bytes=10 * 1024 * 1024,
+                 fetch_timeout=10, uploads_url='/thumb/uploads/'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        self.fetch_timeout = fetch_timeout
+        self.uploads_url = uploads_url  # URLs under this prefix name files in the uploads directory
+        self.cache_dir = os.path.join(directory, 'cache')
+        self.uploads_dir = os.path.join(directory, 'uploads')
+
+    def rendition_path(self, url, width, fmt, crop):
+        name = '%s-%d%s%s' % (url_key(url), width, 'c' if crop else '', FORMATS[fmt][2])
+        return os.path.join(self.cache_dir, name)
+
+    def lookup(self, url, width, fmt, crop):
+        """Returns the path of a rendition when it is cached, or None. Counts as a use of it."""
+        path = self.rendition_path(url, width, fmt, crop)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        now = time.time()
+        if now - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                return None
+        return path
+
+    def render(self, url, width, crop):
+        """Writes every format of a rendition of the image at url, then evicts to stay under max_bytes."""
+        if Image is None:
+            return
+        if all(os.path.exists(self.rendition_path(url, width, fmt, crop)) for fmt in FORMATS):
+            return
+        data = self.source(url)
+        with span('render_thumbnail'):
+            try:
+                image = Image.open(io.BytesIO(data))
+                if image.width * image.height > MAX_SOURCE_PIXELS:
+                    raise InvalidImage('%s is larger than %d pixels' % (url, MAX_SOURCE_PIXELS))
+                image = ImageOps.exif_transpose(image)
+                image = image.convert('RGB')
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                raise InvalidImage('Could not read the image at %s: %s' % (url, e))
+            if crop:
+                # Library cards are 16:9, so video thumbnails are cropped to fill them
+                image = ImageOps.fit(image, (width, width * 9 // 16), Image.LANCZOS)
+            elif image.width > width:
+                image = image.resize((width, max(1, image.height * width // image.width)), Image.LANCZOS)
+            for fmt, (pil_format, _, _, options) in FORMATS.items():
+                out = io.BytesIO()
+                image.save(out, pil_format, **options)
+                _write(self.rendition_path(url, width, fmt, crop), out.getvalue())
+        self.evict()
+
+    def source(self, url):
+        """Returns the bytes of the image at url, fetching it into the cache the first time."""
+        if url.startswith(self.uploads_url):
+            path = self.upload_path(url[len(self.uploads_url):])
+            if path is None:
+                raise InvalidImage('No such upload: %s' % url)
+            with open(path, 'rb') as f:
+                return f.read()
+        path = os.path.join(self.cache_dir, url_key(url) + '.src')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        with span('fetch_thumbnail'):
+            data = self._fetch(url)
+        check_image(data)
+        _write(path, data)
+        return data
+
+    def _fetch(self, url):
+        """Returns the body of url, following redirects, from public addresses only."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise InvalidImage('Not an http(s) URL: %s' % url)
+            try:
+                port = parts.port or (443 if parts.scheme == 'https' else 80)
+            except ValueError:
+                raise InvalidImage('Not an http(s) URL: %s' % url)
+            address = public_address(parts.hostname, port)
+            connection_class = _PinnedHTTPSConnection if parts.scheme == 'https' else _PinnedHTTPConnection
+            connection = connection_class(parts.hostname, port, address, self.fetch_timeout)
+            try:
+                target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+                connection.request('GET', target, headers={'User-Agent': 'gis-thumbnailer'})
+                response = connection.getresponse()
+                if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                    url = urllib.parse.urljoin(url, response.getheader('Location'))
+                    continue
+                if response.status != 200:
+                    raise InvalidImage('%s answered HTTP %d' % (url, response.status))
+                # Checked before reading, and the read stops one byte past the limit whatever the header said
+                length = response.getheader('Content-Length', '')
+                if length.isdigit() and int(length) > self.max_source_bytes:
+                    raise InvalidImage('%s is larger than %d bytes' % (url, self.max_source_bytes))
+                data = response.read(self.max_source_bytes + 1)
+                if len(data) > self.max_source_bytes:
+                    raise InvalidImage('%s is larger than %d bytes' % (url, self.max_source_bytes))
+                return data
+            finally:
+                connection.close()
+        raise InvalidImage('Too many redirects fetching %s' % url)
+
+    def save_upload(self, data):
+        """Stores an uploaded image and returns the name to pass to upload_path."""
+        if len(data) > self.max_source_bytes:
+            raise InvalidImage('Images can be at most %d MB.' % (self.max_source_bytes // (1024 * 1024)))
+        check_image(data)
+        name = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.uploads_dir, name)
+        if not os.path.exists(path):
+            _write(path, data)
+        return name
+
+    def upload_path(self, name):
+        """Returns the path of an uploaded image, or None if there is none by that name."""
+        if len(name) != 64 or not all(c in '0123456789abcdef' for c in name):
+            return None
+        path = os.path.join(self.uploads_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def evict(self):
+        """Removes least recently used files until the cache is back under max_bytes."""
+        try:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return 0
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def public_address(host, port):
+    """Returns an address of host to connect to. Raises InvalidImage unless all its addresses are public."""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise InvalidImage('Could not resolve %s: %s' % (host, e))
+    addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if not ip.is_global or ip.is_multicast:
+            raise InvalidImage('%s resolves to %s, which is not a public address' % (host, address))
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """Connects to an address resolved and checked beforehand, so a second lookup can't lead elsewhere."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout, context=ssl.create_default_context())
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        # The certificate is still checked against the host name
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def image_mimetype(data):
+    """Returns the mimetype of the image data starts with, or None."""
+    for signature, mimetype in SIGNATURES.items():
+        if data.startswith(signature) and (signature != b'RIFF' or data[8:12] == b'WEBP'):
+            return mimetype
+    return None
+
+
+def check_image(data):
+    if image_mimetype(data) is None:
+        raise InvalidImage('Only JPEG, PNG, GIF and WebP images are supported.')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,194 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# --- Buffered View Counter ---
+# A page view appends one small line to an append-only log instead of
+# rewriting videos.json. Every worker appends to the same file, so the log is
+# the shared buffer; once it passes a size or age threshold one worker folds
+# it into the video records and starts a fresh log.
+#
+# Appends and reads hold a shared flock on '<log>.lock' and flushes hold it
+# exclusively, so a reader never sees the video records and the log from
+# different sides of a flush.
+
+
+class ViewCounter:
+    def __init__(self, store, log_path, videos_file, flush_threshold=1000, flush_interval=60, on_flush_due=None):
+        self.store = store
+        self.log_path = log_path
+        self.videos_file = videos_file
+        self.flush_threshold = flush_threshold  # views buffered before a flush
+        self.flush_interval = flush_interval  # seconds between flushes while views keep coming
+        # Called instead of flushing inline when a flush is due, e.g. to hand it to a background job
+        self.on_flush_due = on_flush_due
+        self._flush_requested = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._ino = None
+        self._offset = 0
+        self._counts = {}
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, video_id):
+        """Buffers one view of video_id, flushing the log into videos.json when it is due."""
+        line = json.dumps({'video_id': video_id, 'timestamp': datetime.now().isoformat()}) + '\n'
+        with self._shared_lock():
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+            self._catch_up()
+            buffered = self._buffered
+        now = time.monotonic()
+        if buffered >= self.flush_threshold or now - self._last_flush >= self.flush_interval:
+            if self.on_flush_due is None:
+                self.flush()
+            elif now - self._flush_requested >= 1:
+                # Asked at most once a second until the flush lands
+                self._flush_requested = now
+                self.on_flush_due()
+
+    def subscribe(self, callback):
+        """Calls callback(video_id, timestamp) for each view as this process reads it from the log.
+
+        Views recorded by other workers arrive the next time this process catches up with the log;
+        ones a flush folded away before that are not seen.
+        """
+        self._subscribers.append(callback)
+
+    def catch_up(self):
+        """Reads views appended to the log since this process last did, passing them to subscribers."""
+        with self._shared_lock():
+            self._catch_up()
+
+    def pending(self):
+        """Returns {video_id: views} buffered in the log but not yet folded into videos.json."""
+        with self._shared_lock():
+            self._catch_up()
+            return dict(self._counts)
+
+    def pending_for(self, video_ids):
+        """Returns {video_id: views} buffered for just the given videos."""
+        with self._shared_lock():
+            self._catch_up()
+            return {video_id: self._counts[video_id] for video_id in video_ids if video_id in self._counts}
+
+    def snapshot(self):
+        """Returns (videos, pending) read consistently with each other."""
+        with self._shared_lock():
+            self._catch_up()
+            return self.store.read(self.videos_file), dict(self._counts)
+
+    def merged_videos(self):
+        """Returns the cached video list with buffered views added to each 'views' total.
+
+        Videos without buffered views are the shared cached dicts; the others are shallow copies.
+        """
+        videos, pending = self.snapshot()
+        if not pending:
+            return videos
+        return [dict(v, views=v.get('views', 0) + pending[v['id']]) if v['id'] in pending else v
+                for v in videos]
+
+    def version(self):
+        """Returns a value that changes whenever a view is recorded or the log is flushed."""
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size)
+
+    def flush(self, block=False):
+        """Folds the buffered views into videos.json and starts a new log. Returns the number of views applied.
+
+        Unless block is set, returns 0 straight away if another worker is already flushing.
+        """
+        with open(self.log_path + '.lock', 'a') as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return 0
+            try:
+                self._catch_up()
+                counts = dict(self._counts)
+                if counts:
+                    with self.store.transaction(self.videos_file) as tx:
+                        # Views of videos deleted since they were recorded are dropped
+                        views = {video['id']: video.get('views', 0) for video in self.store.read(self.videos_file)
+                                 if video['id'] in counts}
+                        if views:
+                            tx.update_many(self.videos_file, 'id', {video_id: {'views': total + counts[video_id]}
+                                                                    for video_id, total in views.items()})
+                self._start_new_log()
+                self._last_flush = time.monotonic()
+                return sum(counts.values())
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _start_new_log(self):
+        dirname = os.path.dirname(self.log_path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(self.log_path) + '.', suffix='.tmp')
+        os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.log_path)
+        with self._lock:
+            self._reset(os.stat(self.log_path).st_ino)
+
+    def _reset(self, ino):
+        self._ino = ino
+        self._offset = 0
+        self._counts = {}
+        self._buffered = 0
+
+    def _catch_up(self):
+        """Reads log lines appended since the last call into the in-memory counts."""
+        with self._lock:
+            try:
+                st = os.stat(self.log_path)
+            except FileNotFoundError:
+                self._reset(None)
+                return
+            if st.st_ino != self._ino or st.st_size < self._offset:
+                # Another worker flushed and started a new log
+                self._reset(st.st_ino)
+                self._last_flush = time.monotonic()
+            if st.st_size == self._offset:
+                return
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._offset)
+                chunk = f.read(st.st_size - self._offset)
+            # Only consume complete lines; a partial one is picked up on the next call
+            end = chunk.rfind(b'\n') + 1
+            for line in chunk[:end].splitlines():
+                if not line.strip():
+                    continue
+                view = json.loads(line)
+                video_id = view['video_id']
+                self._counts[video_id] = self._counts.get(video_id, 0) + 1
+                self._buffered += 1
+                for callback in self._subscribers:
+                    callback(video_id, view.get('timestamp'))
+            self._offset += end
+
+    def _shared_lock(self):
+        return _SharedFileLock(self.log_path + '.lock')
+
+
+class _SharedFileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._handle = open(self.path, 'a')
+        fcntl.flock(self._handle, fcntl.LOCK_SH)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._handle, fcntl.LOCK_UN)
+        self._handle.close()